@@ -0,0 +1,79 @@
+import argparse
+import time
+import numpy as np
+from astropy.wcs import WCS, utils
+from astropy.coordinates import SkyCoord
+
+from image_reduction.astrometry import wcs as lcowcs
+
+def make_dataset(nstars, noise, rng):
+    """
+    Simulate matched pixel and sky positions of stars in a Sinistro-like frame
+    """
+
+    true_wcs = WCS(naxis=2)
+    true_wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    true_wcs.wcs.crval = [266.0433, -39.1132]
+    true_wcs.wcs.crpix = [2048.5 + rng.normal(0, 20), 2048.5 + rng.normal(0, 20)]
+    angle = np.radians(rng.normal(0, 0.1))
+    true_wcs.wcs.cd = 0.389 / 3600.0 * np.array([[-np.cos(angle), np.sin(angle)],
+                                                 [np.sin(angle), np.cos(angle)]])
+
+    true_pixels = rng.uniform(0, 4096, (2, nstars))
+    coords = true_wcs.pixel_to_world(true_pixels[0], true_pixels[1])
+    pixels = true_pixels + rng.normal(0, noise, true_pixels.shape)
+
+    return pixels, coords, true_pixels
+
+def run_benchmark(ntrials=20, nstars=500, noise=0.1, seed=1):
+    """
+    Compare the runtime and accuracy of fit_wcs_from_points and fit_wcs_linear with sip_degree=1, as used
+    in refine_image_wcs
+
+    Returns
+    -------
+    results : dict, mean runtime [s] and mean RMS of the residuals from the true positions [pix] for each
+              solver, plus the mean RMS difference between the two solutions [pix]
+    """
+
+    rng = np.random.default_rng(seed)
+    results = {'astropy_time': [], 'linear_time': [], 'astropy_rms': [], 'linear_rms': [], 'difference_rms': []}
+
+    for trial in range(ntrials):
+        pixels, coords, true_pixels = make_dataset(nstars, noise, rng)
+
+        start = time.perf_counter()
+        astropy_wcs = utils.fit_wcs_from_points(pixels, coords, sip_degree=1)
+        results['astropy_time'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        linear_wcs = lcowcs.fit_wcs_linear(pixels, coords.ra.deg, coords.dec.deg, sip_degree=1)
+        results['linear_time'].append(time.perf_counter() - start)
+
+        astropy_pixels = np.array(astropy_wcs.world_to_pixel(coords))
+        linear_pixels = np.array(linear_wcs.world_to_pixel(coords))
+        results['astropy_rms'].append(np.sqrt(((astropy_pixels - true_pixels)**2).sum(axis=0).mean()))
+        results['linear_rms'].append(np.sqrt(((linear_pixels - true_pixels)**2).sum(axis=0).mean()))
+        results['difference_rms'].append(np.sqrt(((linear_pixels - astropy_pixels)**2).sum(axis=0).mean()))
+
+    return {key: np.mean(values) for key, values in results.items()}
+
+def get_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ntrials', help='Number of simulated frames', type=int, default=20)
+    parser.add_argument('--nstars', help='Number of matched stars per frame', type=int, default=500)
+    parser.add_argument('--noise', help='Centroid noise in pixels', type=float, default=0.1)
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == '__main__':
+    args = get_args()
+    results = run_benchmark(ntrials=args.ntrials, nstars=args.nstars, noise=args.noise)
+    print('fit_wcs_from_points: ' + str(round(results['astropy_time'] * 1000.0, 2)) + ' ms per frame, RMS '
+          + str(round(results['astropy_rms'], 4)) + ' pix')
+    print('fit_wcs_linear:      ' + str(round(results['linear_time'] * 1000.0, 2)) + ' ms per frame, RMS '
+          + str(round(results['linear_rms'], 4)) + ' pix')
+    print('RMS difference between solutions: ' + str(round(results['difference_rms'], 5)) + ' pix')
@@ -27,6 +27,50 @@ def aperture_timeseries(params, star_catalog, obs_set, dataset, log=None):
     ASCII format lightcurve file without suffix (path with root filename only)
     """
 
+    return target_timeseries(params, star_catalog, obs_set, dataset.flux, dataset.flux_err, log=log)
+
+@task
+def dia_timeseries(params, star_catalog, obs_set, flux, flux_err, log=None):
+    """
+    Function to output the difference image photometry timeseries of the target
+
+    Parameters
+    ----------
+    params    dict      Program arguments:
+        'target_ra', 'target_dec', 'filter', 'lc_path'
+    star_catalog StarCatalog Source table for the dataset
+    obs_set ObservationSet Set of frames in the dataset
+    flux    arr     DIA flux of all stars in all frames, in the flux units of the reference
+    flux_err arr    Uncertainties on the DIA flux
+    log  Logger     Logger object
+
+    Outputs
+    -------
+    ASCII format lightcurve file without suffix (path with root filename only)
+    """
+
+    return target_timeseries(params, star_catalog, obs_set, flux, flux_err, log=log)
+
+def target_timeseries(params, star_catalog, obs_set, flux, flux_err, log=None):
+    """
+    Function to output the timeseries of the star closest to the target from arrays of
+    flux measurements of all stars
+
+    Parameters
+    ----------
+    params    dict      Program arguments:
+        'target_ra', 'target_dec', 'filter', 'lc_path'
+    star_catalog StarCatalog Source table for the dataset
+    obs_set ObservationSet Set of frames in the dataset
+    flux    arr     Timeseries flux array
+    flux_err arr    Uncertainties on flux array
+    log  Logger     Logger object
+
+    Returns
+    -------
+    success  bool   True if a lightcurve was output
+    """
+
     # Target coordinates can be in sexigesimal or decimal degree format, so handle both
     try:
         target_ra = float(params['target_ra'])
@@ -49,13 +93,13 @@ def aperture_timeseries(params, star_catalog, obs_set, dataset, log=None):
 
     # Search the catalog for the nearest entry
     star_idx, entry = crossmatching.find_nearest(
-        star_catalog.sources, target_ra, target_dec, log=log
+        star_catalog.sources, target_ra, target_dec, index=star_catalog.get_index(), log=log
     )
 
     # If a valid entry exists, extract the lightcurve and output
     if entry:
         lc, tom_lc = get_lightcurve(
-            obs_set, dataset.flux, dataset.flux_err, star_idx, params['filter'], log=log
+            obs_set, flux, flux_err, star_idx, params['filter'], log=log
         )
 
         if lc:
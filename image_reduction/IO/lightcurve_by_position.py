@@ -28,17 +28,11 @@ def find_nearest_star_by_pixel(star_catalog, target_x, target_y, radius=5.0, log
                     first image of the set
     """
 
-    # The first image in a dataset is normally used as the reference.  Use this to
-    # calculate the separation of all objects from the target location
-    separations = np.sqrt(
-        #(positions[:,image_index,0] - target_x)**2 + (positions[:,image_index,1] - target_y)**2
-        (star_catalog.sources['x'] - target_x)**2 + (star_catalog.sources['y'] - target_y)**2
-    )
-
-    # Find the closest match within the search radius
-    idx = np.argsort(separations)
+    # The first image in a dataset is normally used as the reference.  The spatial index of the
+    # star catalog gives the nearest object to the target location in this image
+    idx, separations = star_catalog.get_index().query_nearest_pixel(target_x, target_y)
 
-    if separations[idx[0]] <= radius:
+    if separations[0] <= radius:
         star_idx = idx[0]
         match_position = (star_catalog.sources['x'][idx[0]], star_catalog.sources['y'][idx[0]])
         lcologs.log(
@@ -50,7 +44,7 @@ def find_nearest_star_by_pixel(star_catalog, target_x, target_y, radius=5.0, log
 
     else:
         lcologs.log(
-            'Nearest star =' + str(idx[0]) + ' which lies at a separation of ' + str(round(separations[idx[0]],3)) + 'pix',
+            'Nearest star =' + str(idx[0]) + ' which lies at a separation of ' + str(round(separations[0],3)) + 'pix',
             'info',
             log=log
         )
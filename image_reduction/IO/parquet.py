@@ -17,6 +17,9 @@ def make_output_directories(red_dir_path, log=None):
 
     sub_dirs = [
         os.path.join(red_dir_path, 'raw_flux'),
+        os.path.join(red_dir_path, 'astrometry_qc'),
+        os.path.join(red_dir_path, 'dia_flux'),
+        os.path.join(red_dir_path, 'dia_candidates'),
     ]
 
     for dir_path in sub_dirs:
@@ -42,6 +45,51 @@ def load_raw_flux(red_dir_path):
 
     return raw_flux
 
+def load_astrometry_qc(red_dir_path):
+    """
+    Function to load the astrometric QC summaries of all images
+
+    :param red_dir_path: str Path to reduction directory
+
+    Returns
+    :param qc: Table  One row of QC metrics per image
+    """
+
+    dir_path = os.path.join(red_dir_path, "astrometry_qc")
+    qc_arrow = pq.read_table(dir_path)
+
+    return Table.from_pandas(qc_arrow.to_pandas())
+
+def load_dia_flux(red_dir_path):
+    """
+    Function to load the difference image photometry of all images
+
+    :param red_dir_path: str Path to reduction directory
+
+    Returns
+    :param dia_flux: Table  One row per star and image, with the difference flux and kernel sum
+    """
+
+    dir_path = os.path.join(red_dir_path, "dia_flux")
+    dia_arrow = pq.read_table(dir_path)
+
+    return Table.from_pandas(dia_arrow.to_pandas())
+
+def load_dia_candidates(red_dir_path):
+    """
+    Function to load the transient candidates detected in the difference images of all images
+
+    :param red_dir_path: str Path to reduction directory
+
+    Returns
+    :param candidates: Table  One row per candidate, with its position, flux and catalog cross-match
+    """
+
+    dir_path = os.path.join(red_dir_path, "dia_candidates")
+    candidates_arrow = pq.read_table(dir_path)
+
+    return Table.from_pandas(candidates_arrow.to_pandas())
+
 def load_norm_flux(red_dir_path):
     """
     Function to load the normalized flux data
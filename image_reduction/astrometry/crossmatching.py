@@ -1,9 +1,12 @@
+import os
+import pickle
 from scipy.spatial import cKDTree
 import numpy as np
 from astropy.coordinates import SkyCoord
 from astropy import units as u
 
 import image_reduction.infrastructure.logs as lcologs
+from image_reduction.astrometry import projection as lcoproj
 
 def merge_positions(positions1, positions2, tolerance=1.0):
     """
@@ -44,7 +47,7 @@ def merge_positions(positions1, positions2, tolerance=1.0):
     merged = np.vstack([positions1, unique_to_p2])
     return merged, unique_index
 
-def find_nearest(sources, ra, dec, radius=(2.0 / 3600.0) * u.deg, log=None):
+def find_nearest(sources, ra, dec, radius=(2.0 / 3600.0) * u.deg, index=None, log=None):
     """
     Method to identify the nearest source catalog entry to the given coordinates,
     within a cut-off radius
@@ -55,6 +58,7 @@ def find_nearest(sources, ra, dec, radius=(2.0 / 3600.0) * u.deg, log=None):
     ra float    RA of location to search at [decimal deg]
     dec float   Dec of location to search at [decimal deg]
     radius float Search cut-off radius [decimal deg, default = 2 arcsec]
+    index SpatialIndex [optional] Spatial index of the source catalog, built if not given
 
     Returns
     -------
@@ -63,17 +67,16 @@ def find_nearest(sources, ra, dec, radius=(2.0 / 3600.0) * u.deg, log=None):
                     within the search radius
     """
 
-    sources = SkyCoord(sources['ra'], sources['dec'], frame='icrs', unit=(u.deg, u.deg))
-    target = SkyCoord(ra, dec, frame='icrs', unit=(u.deg, u.deg))
+    if index is None:
+        index = SpatialIndex(ra=sources['ra'], dec=sources['dec'])
 
-    separations = target.separation(sources)
+    radius = u.Quantity(radius, u.deg).value
+    idx, separations = index.query_nearest_sky(ra, dec, radius=radius)
 
-    idx = np.where(separations <= radius)[0]
-
-    if len(idx) > 0:
+    if idx[0] >= 0:
         lcologs.log(
             'Found nearest matching star ' + str(idx[0]) + ' ' \
-            + repr(sources[idx[0]]) + ', separation=' + str(separations[idx[0]]) + 'deg',
+            + repr(sources[idx[0]]) + ', separation=' + str(separations[0]) + 'deg',
             'info',
             log=log
         )
@@ -86,3 +89,172 @@ def find_nearest(sources, ra, dec, radius=(2.0 / 3600.0) * u.deg, log=None):
             log=log
         )
         return None, None
+
+class SpatialIndex(object):
+    """
+    Spatial index of a star catalog, for nearest neighbour and cone searches on the sky and in the
+    pixel frame of the reference image.  Sky positions are indexed as 3D unit vectors, so that distances
+    are chord lengths and searches are valid over the whole sphere.
+
+    Attributes
+    ----------
+    vectors : array, (N,3) unit vectors of the stars
+    pixels : array, (N,2) x,y positions of the stars in the reference image, NaN outside the image, or None
+    sky_tree : scipy.spatial.cKDTree, the index of the unit vectors
+    pixel_tree : scipy.spatial.cKDTree, the index of the finite pixel positions, or None
+    pixel_index : array, the indices of the stars with finite pixel positions, in the order of pixel_tree
+    """
+
+    def __init__(self, ra=None, dec=None, x=None, y=None, file_path=None, log=None):
+
+        self.vectors = None
+        self.pixels = None
+        self.sky_tree = None
+        self.pixel_tree = None
+        self.pixel_index = None
+
+        if ra is not None and dec is not None:
+            self.build(ra, dec, x=x, y=y)
+
+        elif file_path:
+            if os.path.isfile(file_path):
+                self.load(file_path, log=log)
+            else:
+                lcologs.log('No spatial index found at ' + file_path, 'info', log=log)
+
+    def build(self, ra, dec, x=None, y=None):
+        """
+        Build the index from the sky positions (deg) and optionally the reference image pixel positions
+        of the stars
+        """
+
+        self.vectors = lcoproj.radec_to_unit_vectors(np.asarray(ra, dtype=float), np.asarray(dec, dtype=float))
+        self.sky_tree = cKDTree(self.vectors)
+
+        if x is not None and y is not None:
+            self.pixels = np.c_[np.asarray(x, dtype=float), np.asarray(y, dtype=float)]
+            self.pixel_index = np.flatnonzero(np.isfinite(self.pixels).all(axis=1))
+            self.pixel_tree = cKDTree(self.pixels[self.pixel_index])
+        else:
+            self.pixels = None
+            self.pixel_tree = None
+            self.pixel_index = None
+
+    def __len__(self):
+        return 0 if self.vectors is None else len(self.vectors)
+
+    def load(self, file_path, log=None):
+
+        with open(file_path, 'rb') as f:
+            index = pickle.load(f)
+        self.vectors = index['vectors']
+        self.pixels = index['pixels']
+        self.sky_tree = index['sky_tree']
+        self.pixel_tree = index['pixel_tree']
+        self.pixel_index = index.get('pixel_index')
+        if self.pixel_index is None and self.pixels is not None:
+            self.pixel_index = np.arange(len(self.pixels))
+        lcologs.log('Loaded spatial index of ' + str(len(self)) + ' stars from ' + file_path, 'info', log=log)
+
+    def save(self, file_path, log=None):
+
+        index = {
+            'vectors': self.vectors,
+            'pixels': self.pixels,
+            'sky_tree': self.sky_tree,
+            'pixel_tree': self.pixel_tree,
+            'pixel_index': self.pixel_index
+        }
+        with open(file_path, 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        lcologs.log('Saved spatial index to ' + file_path, 'info', log=log)
+
+    def matches_catalog(self, ra, dec, x=None, y=None, tolerance=1e-9):
+        """
+        Verify that the index was built from the given sky positions (deg) and pixel positions
+        """
+
+        if self.vectors is None or len(self.vectors) != len(ra):
+            return False
+
+        if x is not None and (self.pixels is None
+                              or not np.allclose(self.pixels, np.c_[x, y], equal_nan=True)):
+            return False
+
+        return np.allclose(self.vectors, lcoproj.radec_to_unit_vectors(ra, dec), atol=tolerance)
+
+    def query_nearest_sky(self, ra, dec, radius=None):
+        """
+        Find the nearest star to each of a set of sky positions
+
+        Parameters
+        ----------
+        ra, dec : float or array, the sky positions in degrees
+        radius : float, [optional] the search radius in degrees
+
+        Returns
+        -------
+        idx : array, the indices of the nearest stars, -1 where there is none within the radius
+        separations : array, the angular separations in degrees, inf where there is no match
+        """
+
+        vectors = lcoproj.radec_to_unit_vectors(ra, dec)
+        max_chord = np.inf if radius is None else 2.0 * np.sin(np.radians(min(radius, 180.0)) / 2.0)
+        chords, idx = self.sky_tree.query(vectors, k=1, distance_upper_bound=max_chord)
+
+        found = np.isfinite(chords)
+        idx = np.where(found, idx, -1)
+        separations = np.full(len(chords), np.inf)
+        separations[found] = np.degrees(2.0 * np.arcsin(np.clip(chords[found] / 2.0, 0.0, 1.0)))
+
+        return idx, separations
+
+    def query_cone(self, ra, dec, radius):
+        """
+        Find the stars within a radius (deg) of each of a set of sky positions
+
+        Returns
+        -------
+        idx : list of arrays, the indices of the stars within each cone, sorted by index
+        """
+
+        vectors = lcoproj.radec_to_unit_vectors(ra, dec)
+        max_chord = 2.0 * np.sin(np.radians(min(radius, 180.0)) / 2.0)
+
+        return [np.sort(np.array(i, dtype=int)) for i in self.sky_tree.query_ball_point(vectors, max_chord)]
+
+    def query_nearest_pixel(self, x, y, radius=None):
+        """
+        Find the nearest star to each of a set of pixel positions in the reference image
+
+        Parameters
+        ----------
+        x, y : float or array, the pixel positions
+        radius : float, [optional] the search radius in pixels
+
+        Returns
+        -------
+        idx : array, the indices of the nearest stars, -1 where there is none within the radius
+        separations : array, the separations in pixels, inf where there is no match
+        """
+
+        positions = np.c_[np.atleast_1d(x), np.atleast_1d(y)].astype(float)
+        separations, idx = self.pixel_tree.query(positions, k=1,
+                                                 distance_upper_bound=np.inf if radius is None else radius)
+
+        # Missing neighbours have the index len(pixel_index), mapped to -1
+        return np.append(self.pixel_index, -1)[idx], separations
+
+    def query_cone_pixel(self, x, y, radius):
+        """
+        Find the stars within a radius (pix) of each of a set of pixel positions in the reference image
+
+        Returns
+        -------
+        idx : list of arrays, the indices of the stars within each circle, sorted by index
+        """
+
+        positions = np.c_[np.atleast_1d(x), np.atleast_1d(y)].astype(float)
+
+        return [np.sort(self.pixel_index[np.array(i, dtype=int)])
+                for i in self.pixel_tree.query_ball_point(positions, radius)]
@@ -0,0 +1,152 @@
+import os
+import numpy as np
+from astropy.wcs import Sip
+from astropy.table import Table, Column
+
+from image_reduction.infrastructure import logs as lcologs
+
+
+class DistortionModelCache(object):
+    """
+    Per-instrument cache of the optical distortion of the cameras, expressed as the SIP terms of WCS fits
+    referenced to the center of the detector.  Candidate fits from the best-fitting frames of any dataset taken
+    with an instrument are stored in one FITS table per facility_code, and the distortion model of the
+    instrument is the median of their coefficients once enough candidates have been collected.  Frames can then
+    be fitted for the linear terms of their WCS only, holding the distortion fixed.
+
+    Attributes
+    ----------
+    cache_dir : str, the directory of the cached candidate tables
+    ncandidates : int, the number of candidate fits kept for each instrument, and required to build the model
+    max_rms : float, the maximum residual RMS in pixels of an accepted candidate fit
+    min_stars : int, the minimum number of stars of an accepted candidate fit
+    candidates : dict, the candidate tables loaded, keyed by facility_code
+    """
+
+    def __init__(self, cache_dir, ncandidates=10, max_rms=0.5, min_stars=100, log=None):
+
+        self.cache_dir = cache_dir
+        self.ncandidates = ncandidates
+        self.max_rms = max_rms
+        self.min_stars = min_stars
+        self.candidates = {}
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+            lcologs.log('Created distortion model cache at ' + self.cache_dir, 'info', log=log)
+
+    def get_file_path(self, facility_code):
+        return os.path.join(self.cache_dir, facility_code + '_distortion.fits')
+
+    def load(self, facility_code, log=None):
+        """
+        Load the candidate fits of an instrument from the cache, returning None if there are none
+        """
+
+        file_path = self.get_file_path(facility_code)
+        if os.path.isfile(file_path):
+            self.candidates[facility_code] = Table.read(file_path, format='fits')
+            lcologs.log(
+                'Loaded ' + str(len(self.candidates[facility_code])) + ' distortion candidates for '
+                + facility_code + ' from ' + file_path,
+                'info', log=log
+            )
+        else:
+            self.candidates[facility_code] = None
+
+        return self.candidates[facility_code]
+
+    def save(self, facility_code, log=None):
+        """
+        Save the candidate fits of an instrument.  The table is written to a temporary file first, so that
+        reductions running in parallel never read a partially written cache.
+        """
+
+        file_path = self.get_file_path(facility_code)
+        tmp_path = file_path + '.' + str(os.getpid()) + '.tmp'
+        self.candidates[facility_code].write(tmp_path, format='fits', overwrite=True)
+        os.replace(tmp_path, file_path)
+        lcologs.log('Saved distortion candidates for ' + facility_code + ' to ' + file_path, 'info', log=log)
+
+    def get_model(self, facility_code, log=None):
+        """
+        Return the distortion model of an instrument as an astropy.wcs.Sip, or None if fewer than
+        ncandidates fits are available
+        """
+
+        candidates = self.candidates[facility_code] if facility_code in self.candidates.keys() \
+            else self.load(facility_code, log=log)
+
+        if candidates is None or len(candidates) < self.ncandidates:
+            return None
+
+        a = np.median(np.array(candidates['a']), axis=0)
+        b = np.median(np.array(candidates['b']), axis=0)
+        crpix = np.array([candidates.meta['CRPIX1'], candidates.meta['CRPIX2']])
+
+        return Sip(a, b, None, None, crpix)
+
+    def add_candidate(self, facility_code, image_name, new_wcs, fit_stats, log=None):
+        """
+        Add the SIP terms of a WCS fit to the candidates of an instrument, if the fit is good enough.
+        Only the ncandidates fits with the lowest residual RMS are kept.
+
+        Parameters
+        ----------
+        facility_code : str, the instrument identifier
+        image_name : str, the name of the fitted image
+        new_wcs : astropy.wcs, the fitted WCS, with SIP terms referenced to the detector center
+        fit_stats : dict, the number of inlier stars ('ninliers') and residual RMS in pixels ('rms') of the fit
+        log : object pipeline log
+
+        Returns
+        -------
+        status : bool, True if the candidate was added
+        """
+
+        if new_wcs.sip is None:
+            lcologs.log('No SIP terms in the WCS of ' + image_name + '; not a distortion candidate',
+                        'warning', log=log)
+            return False
+
+        if fit_stats['rms'] > self.max_rms or fit_stats['ninliers'] < self.min_stars:
+            lcologs.log(
+                'WCS fit of ' + image_name + ' rejected as a distortion candidate: ' + str(fit_stats['ninliers'])
+                + ' stars, residual RMS = ' + str(fit_stats['rms']) + ' pix',
+                'info', log=log
+            )
+            return False
+
+        # Reload the cache, which may have been updated by another reduction
+        candidates = self.load(facility_code, log=log)
+
+        row = [image_name, fit_stats['rms'], fit_stats['ninliers'], new_wcs.sip.a, new_wcs.sip.b]
+        if candidates is None:
+            candidates = Table([
+                Column(name='image', data=[image_name], dtype='U100'),
+                Column(name='rms', data=[fit_stats['rms']], dtype='float64'),
+                Column(name='nstars', data=[fit_stats['ninliers']], dtype='int'),
+                Column(name='a', data=[new_wcs.sip.a]),
+                Column(name='b', data=[new_wcs.sip.b])
+            ])
+            candidates.meta['CRPIX1'] = new_wcs.sip.crpix[0]
+            candidates.meta['CRPIX2'] = new_wcs.sip.crpix[1]
+
+        elif candidates['a'].shape[1:] != new_wcs.sip.a.shape \
+                or not np.allclose(new_wcs.sip.crpix, [candidates.meta['CRPIX1'], candidates.meta['CRPIX2']]):
+            lcologs.log(
+                'SIP terms of ' + image_name + ' inconsistent with the distortion candidates of ' + facility_code,
+                'warning', log=log
+            )
+            return False
+
+        else:
+            if image_name in candidates['image']:
+                candidates.remove_rows(np.where(candidates['image'] == image_name)[0])
+            candidates.add_row(row)
+
+        candidates.sort('rms')
+        self.candidates[facility_code] = candidates[:self.ncandidates]
+        self.save(facility_code, log=log)
+
+        return True
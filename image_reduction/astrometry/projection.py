@@ -0,0 +1,397 @@
+import numpy as np
+from astropy.coordinates import SkyCoord
+import astropy.units as u
+
+
+def radec_to_unit_vectors(ra, dec):
+    """
+    Convert equatorial coordinates to cartesian unit vectors
+
+    Parameters
+    ----------
+    ra : array, right ascension in degrees
+    dec : array, declination in degrees
+
+    Returns
+    -------
+    vectors : array, (N,3) unit vectors
+    """
+
+    ra = np.radians(np.atleast_1d(np.asarray(ra, dtype=float)))
+    dec = np.radians(np.atleast_1d(np.asarray(dec, dtype=float)))
+
+    return np.c_[np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)]
+
+def tangent_plane_basis(ra_center, dec_center):
+    """
+    Return the unit vectors pointing East, North and towards the tangent point, as the rows of a (3,3) array
+
+    Parameters
+    ----------
+    ra_center : float, right ascension of the tangent point in degrees
+    dec_center : float, declination of the tangent point in degrees
+
+    Returns
+    -------
+    basis : array, (3,3) rotation matrix to the East, North, center frame
+    """
+
+    ra0 = np.radians(ra_center)
+    dec0 = np.radians(dec_center)
+
+    return np.array([
+        [-np.sin(ra0), np.cos(ra0), 0.0],
+        [-np.sin(dec0) * np.cos(ra0), -np.sin(dec0) * np.sin(ra0), np.cos(dec0)],
+        [np.cos(dec0) * np.cos(ra0), np.cos(dec0) * np.sin(ra0), np.sin(dec0)]
+    ])
+
+def standard_coordinates(vectors, ra_center, dec_center):
+    """
+    Gnomonic projection of unit vectors about a tangent point
+
+    Parameters
+    ----------
+    vectors : array, (N,3) unit vectors
+    ra_center : float, right ascension of the tangent point in degrees
+    dec_center : float, declination of the tangent point in degrees
+
+    Returns
+    -------
+    xi, eta : array, the standard coordinates in degrees
+    """
+
+    rotated = vectors @ tangent_plane_basis(ra_center, dec_center).T
+
+    xi = np.degrees(rotated[:,0] / rotated[:,2])
+    eta = np.degrees(rotated[:,1] / rotated[:,2])
+
+    return xi, eta
+
+def standard_to_radec(xi, eta, ra_center, dec_center):
+    """
+    Inverse gnomonic projection of standard coordinates about a tangent point
+
+    Parameters
+    ----------
+    xi, eta : array, the standard coordinates in degrees
+    ra_center : float, right ascension of the tangent point in degrees
+    dec_center : float, declination of the tangent point in degrees
+
+    Returns
+    -------
+    ra, dec : array, the equatorial coordinates in degrees
+    """
+
+    xi = np.radians(np.atleast_1d(xi))
+    eta = np.radians(np.atleast_1d(eta))
+
+    vectors = np.c_[xi, eta, np.ones(len(xi))] @ tangent_plane_basis(ra_center, dec_center)
+    vectors = vectors / np.linalg.norm(vectors, axis=1)[:, np.newaxis]
+
+    ra = np.degrees(np.arctan2(vectors[:,1], vectors[:,0])) % 360.0
+    dec = np.degrees(np.arcsin(vectors[:,2]))
+
+    return ra, dec
+
+def wcs_pixel_scale_matrix(image_wcs):
+    """
+    Return the CD matrix of a WCS, whether it is expressed as CD or PC and CDELT keywords
+    """
+
+    if image_wcs.wcs.has_cd():
+        return np.array(image_wcs.wcs.cd)
+    else:
+        return np.array(image_wcs.wcs.cdelt)[:, np.newaxis] * image_wcs.wcs.get_pc()
+
+def sip_correction(coeffs, u, v):
+    """
+    Evaluate a SIP polynomial sum(coeffs[p,q] * u**p * v**q) using Horner's scheme in v
+
+    Parameters
+    ----------
+    coeffs : array, the SIP coefficients
+    u : array, pixel offsets from CRPIX in x
+    v : array, pixel offsets from CRPIX in y
+
+    Returns
+    -------
+    values : array, the polynomial evaluated at each position
+    """
+
+    values = np.zeros(np.shape(u))
+    upow = np.ones(np.shape(u))
+    for p in range(coeffs.shape[0]):
+        column = np.zeros(np.shape(u))
+        for q in range(coeffs.shape[1] - 1, -1, -1):
+            column = column * v + coeffs[p, q]
+        values = values + column * upow
+        upow = upow * u
+
+    return values
+
+def intermediate_to_pixel(xi, eta, crpix, cd, sip=None, max_iterations=20, tolerance=1e-6):
+    """
+    Convert intermediate world coordinates to pixel positions for a TAN(-SIP) WCS, inverting the forward SIP
+    distortion by fixed point iteration where present.
+
+    Parameters
+    ----------
+    xi, eta : array, the intermediate world coordinates in degrees
+    crpix : array, the FITS (1-based) reference pixel
+    cd : array, (2,2) CD matrix
+    sip : astropy.wcs.Sip, [optional] SIP distortion of the WCS
+    max_iterations : int, the maximum number of iterations of the SIP inversion
+    tolerance : float, the convergence limit of the SIP inversion in pixels
+
+    Returns
+    -------
+    x, y : array, the 0-based pixel positions
+    """
+
+    u_lin, v_lin = np.linalg.inv(cd) @ np.vstack([xi, eta])
+
+    u_pix = u_lin.copy()
+    v_pix = v_lin.copy()
+    if sip is not None:
+        if sip.ap is not None and np.any(sip.ap) and np.any(sip.bp):
+            u_pix = u_lin + sip_correction(sip.ap, u_lin, v_lin)
+            v_pix = v_lin + sip_correction(sip.bp, u_lin, v_lin)
+
+        for it in range(max_iterations):
+            u_new = u_lin - sip_correction(sip.a, u_pix, v_pix)
+            v_new = v_lin - sip_correction(sip.b, u_pix, v_pix)
+            change = max(np.abs(u_new - u_pix).max(initial=0.0), np.abs(v_new - v_pix).max(initial=0.0))
+            u_pix = u_new
+            v_pix = v_new
+            if change < tolerance:
+                break
+
+    return u_pix + crpix[0] - 1.0, v_pix + crpix[1] - 1.0
+
+class CatalogProjection(object):
+    """
+    Per-field cache of the unit vectors of the catalog stars and their separations from the field center, so that
+    projecting the catalog into each frame reduces to a rotation, a gnomonic projection and an affine + SIP
+    transform on plain arrays.
+
+    Attributes
+    ----------
+    ra, dec : array, the catalog coordinates in degrees
+    vectors : array, (N,3) unit vectors of the catalog stars
+    separations : array, angular separations of the stars from the field center in degrees
+    """
+
+    def __init__(self, ra, dec, ra_center, dec_center):
+
+        self.ra = np.asarray(ra, dtype=float)
+        self.dec = np.asarray(dec, dtype=float)
+        self.vectors = radec_to_unit_vectors(self.ra, self.dec)
+
+        center = radec_to_unit_vectors(ra_center, dec_center)[0]
+        self.separations = np.degrees(np.arccos(np.clip(self.vectors @ center, -1.0, 1.0)))
+
+    def world_to_pixel(self, image_wcs, idx=None):
+        """
+        Compute the pixel positions of the catalog stars in a frame
+
+        Parameters
+        ----------
+        image_wcs : astropy.wcs, the WCS of the frame
+        idx : array, [optional] boolean mask or indices of the stars to project
+
+        Returns
+        -------
+        x, y : array, the 0-based pixel positions of the stars
+        """
+
+        vectors = self.vectors if idx is None else self.vectors[idx]
+
+        # Only the gnomonic projection with the default pole is handled here, otherwise use astropy
+        lonpole = image_wcs.wcs.lonpole
+        if 'TAN' not in image_wcs.wcs.ctype[0] or not (np.isnan(lonpole) or lonpole == 180.0):
+            ra = self.ra if idx is None else self.ra[idx]
+            dec = self.dec if idx is None else self.dec[idx]
+            x, y = image_wcs.world_to_pixel(SkyCoord(ra=ra, dec=dec, unit=(u.degree, u.degree), frame='icrs'))
+            return np.asarray(x), np.asarray(y)
+
+        xi, eta = standard_coordinates(vectors, image_wcs.wcs.crval[0], image_wcs.wcs.crval[1])
+
+        return intermediate_to_pixel(xi, eta, image_wcs.wcs.crpix, wcs_pixel_scale_matrix(image_wcs),
+                                     sip=image_wcs.sip)
+
+    def project_frames(self, wcs_stack, file_path=None, star_chunk=20000, frame_chunk=50):
+        """
+        Compute the pixel positions of the catalog stars in all the frames of a dataset at once, in chunks of
+        stars and frames to bound the memory used
+
+        Parameters
+        ----------
+        wcs_stack : WCSStack, the stacked WCS parameters of the frames
+        file_path : str, [optional] path of a .npy file in which the positions are stored as a memory map,
+                    otherwise they are returned in memory
+        star_chunk : int, the number of stars projected together
+        frame_chunk : int, the number of frames projected together
+
+        Returns
+        -------
+        positions : array, (N_stars, N_frames, 2) float32 0-based pixel positions
+        """
+
+        shape = (len(self.vectors), len(wcs_stack.crpix), 2)
+        if file_path:
+            positions = np.lib.format.open_memmap(file_path, mode='w+', dtype=np.float32, shape=shape)
+        else:
+            positions = np.empty(shape, dtype=np.float32)
+
+        for j in range(0, shape[1], frame_chunk):
+            frames = slice(j, j + frame_chunk)
+            for i in range(0, shape[0], star_chunk):
+                x, y = wcs_stack.world_to_pixel(self.vectors[i:i + star_chunk], frames=frames)
+                positions[i:i + star_chunk, frames, 0] = x
+                positions[i:i + star_chunk, frames, 1] = y
+
+        if file_path:
+            positions.flush()
+
+        return positions
+
+class WCSStack(object):
+    """
+    The TAN(-SIP) parameters of the frames of a dataset, stacked into arrays so that positions can be projected
+    into all of the frames in one vectorized operation, without building a WCS object per frame.
+
+    Attributes
+    ----------
+    crpix : array, (N_frames,2) the FITS (1-based) reference pixels
+    crval : array, (N_frames,2) the sky positions of the reference pixels in degrees
+    cd : array, (N_frames,2,2) the CD matrices
+    sip_a, sip_b : array, (N_frames,order+1,order+1) the forward SIP coefficients, zero for frames without
+                   distortion
+    """
+
+    def __init__(self):
+
+        self.crpix = None
+        self.crval = None
+        self.cd = None
+        self.sip_a = None
+        self.sip_b = None
+
+    def set_from_wcs_list(self, wcs_list):
+        """
+        Stack the parameters of a list of astropy WCS objects with TAN or TAN-SIP projections
+        """
+
+        for image_wcs in wcs_list:
+            if 'TAN' not in image_wcs.wcs.ctype[0]:
+                raise ValueError('Batch projection requires TAN projections, got ' + image_wcs.wcs.ctype[0])
+
+        self.crpix = np.array([image_wcs.wcs.crpix for image_wcs in wcs_list], dtype=float)
+        self.crval = np.array([image_wcs.wcs.crval for image_wcs in wcs_list], dtype=float)
+        self.cd = np.array([wcs_pixel_scale_matrix(image_wcs) for image_wcs in wcs_list], dtype=float)
+
+        # Pad the SIP coefficients of all frames to the highest order present
+        order = max([image_wcs.sip.a_order for image_wcs in wcs_list if image_wcs.sip is not None], default=0)
+        self.sip_a = np.zeros((len(wcs_list), order + 1, order + 1))
+        self.sip_b = np.zeros((len(wcs_list), order + 1, order + 1))
+        for k, image_wcs in enumerate(wcs_list):
+            if image_wcs.sip is not None:
+                na = image_wcs.sip.a.shape[0]
+                nb = image_wcs.sip.b.shape[0]
+                self.sip_a[k, :na, :na] = image_wcs.sip.a
+                self.sip_b[k, :nb, :nb] = image_wcs.sip.b
+
+    def set_from_obs_set(self, obs_set):
+        """
+        Stack the linear WCS parameters recorded for each frame in the table of an ObservationSet
+        """
+
+        table = obs_set.table
+        self.crpix = np.c_[table['CRPIX1'].data, table['CRPIX2'].data].astype(float)
+        self.crval = np.c_[table['CRVAL1'].data, table['CRVAL2'].data].astype(float)
+        self.cd = np.stack([
+            np.c_[table['CD1_1'].data, table['CD1_2'].data],
+            np.c_[table['CD2_1'].data, table['CD2_2'].data]
+        ], axis=1).astype(float)
+        self.sip_a = np.zeros((len(table), 1, 1))
+        self.sip_b = np.zeros((len(table), 1, 1))
+
+    def world_to_pixel(self, vectors, frames=slice(None), max_iterations=20, tolerance=1e-6):
+        """
+        Project unit vectors into a set of frames
+
+        Parameters
+        ----------
+        vectors : array, (N,3) unit vectors of the stars
+        frames : slice or array, [optional] the frames to project into, by default all of them
+        max_iterations : int, the maximum number of iterations of the SIP inversion
+        tolerance : float, the convergence limit of the SIP inversion in pixels
+
+        Returns
+        -------
+        x, y : array, (N_stars, N_frames) 0-based pixel positions, NaN for stars more than 90 degrees from the
+               tangent point
+        """
+
+        crpix = self.crpix[frames]
+        crval = np.radians(self.crval[frames])
+        sip_a = self.sip_a[frames]
+        sip_b = self.sip_b[frames]
+
+        # East, North and center unit vectors of the tangent point of each frame, as in tangent_plane_basis
+        sin_ra, cos_ra = np.sin(crval[:,0]), np.cos(crval[:,0])
+        sin_dec, cos_dec = np.sin(crval[:,1]), np.cos(crval[:,1])
+        east = np.c_[-sin_ra, cos_ra, np.zeros(len(crval))]
+        north = np.c_[-sin_dec * cos_ra, -sin_dec * sin_ra, cos_dec]
+        center = np.c_[cos_dec * cos_ra, cos_dec * sin_ra, sin_dec]
+
+        denominator = vectors @ center.T
+        denominator[denominator <= 0.0] = np.nan
+        xi = np.degrees((vectors @ east.T) / denominator)
+        eta = np.degrees((vectors @ north.T) / denominator)
+
+        cd_inv = np.linalg.inv(self.cd[frames])
+        u_lin = cd_inv[:,0,0] * xi + cd_inv[:,0,1] * eta
+        v_lin = cd_inv[:,1,0] * xi + cd_inv[:,1,1] * eta
+
+        # Fixed point inversion of the forward SIP distortion, as in intermediate_to_pixel
+        u_pix = u_lin.copy()
+        v_pix = v_lin.copy()
+        if np.any(sip_a) or np.any(sip_b):
+            for it in range(max_iterations):
+                u_new = u_lin - stacked_sip_correction(sip_a, u_pix, v_pix)
+                v_new = v_lin - stacked_sip_correction(sip_b, u_pix, v_pix)
+                change = max(np.nanmax(np.abs(u_new - u_pix), initial=0.0),
+                             np.nanmax(np.abs(v_new - v_pix), initial=0.0))
+                u_pix = u_new
+                v_pix = v_new
+                if change < tolerance:
+                    break
+
+        return u_pix + crpix[:,0] - 1.0, v_pix + crpix[:,1] - 1.0
+
+def stacked_sip_correction(coeffs, u, v):
+    """
+    Evaluate the SIP polynomials of a set of frames, as sip_correction
+
+    Parameters
+    ----------
+    coeffs : array, (N_frames,order+1,order+1) the SIP coefficients of each frame
+    u : array, (N_stars,N_frames) pixel offsets from CRPIX in x
+    v : array, (N_stars,N_frames) pixel offsets from CRPIX in y
+
+    Returns
+    -------
+    values : array, (N_stars,N_frames) the polynomials evaluated at each position
+    """
+
+    values = np.zeros(np.shape(u))
+    upow = np.ones(np.shape(u))
+    for p in range(coeffs.shape[1]):
+        column = np.zeros(np.shape(u))
+        for q in range(coeffs.shape[2] - 1, -1, -1):
+            column = column * v + coeffs[:, p, q]
+        values = values + column * upow
+        upow = upow * u
+
+    return values
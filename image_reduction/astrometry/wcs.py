@@ -1,4 +1,5 @@
 import os
+import hashlib
 from prefect import task
 from skimage.registration import phase_cross_correlation
 import numpy as np
@@ -7,18 +8,20 @@ import copy
 import scipy.spatial as sspa
 from skimage.measure import ransac
 from skimage import transform as tf
-from astropy.wcs import WCS, utils
+from astropy.wcs import WCS, Sip, utils
+from astropy.io import fits
 import astropy.units as u
 from astropy.coordinates import SkyCoord
 from astropy.table import Table, Column
 
 from image_reduction.logistics import image_tools
+from image_reduction.astrometry import projection as lcoproj
 from image_reduction.data_quality import astrometry_qc
 from image_reduction.infrastructure import logs as lcologs
 from image_reduction.IO import ds9_utils
 
 @task
-def find_images_shifts(reference,image,image_fraction =0.25, upsample_factor=1):
+def find_images_shifts(reference,image,image_fraction =0.25, upsample_factor=1, reference_fft=None):
     """
     Estimate the shifts (X,Y) between two images. Generally a good idea to do only a fraction of the field of view
     centred in the middle, where the effect of rotation is minimal.
@@ -29,6 +32,8 @@ def find_images_shifts(reference,image,image_fraction =0.25, upsample_factor=1):
     image : array,  the image we want to align
     image_fraction : float, the fraction of image around the center we want to analyze
     upsample_factor : float, the degree of upsampling, if one wants subpixel accuracy
+    reference_fft : array, [optional] the precomputed central_subimage_fft of the reference, in which case
+                    reference is not used and only the image is transformed
 
 
     Returns
@@ -37,21 +42,31 @@ def find_images_shifts(reference,image,image_fraction =0.25, upsample_factor=1):
     shifty : float, the shift in pixels in the y direction
     """
 
-    leny, lenx = (np.array(image.shape) * image_fraction).astype(int)
-    starty,startx = (np.array(image.shape)*0.5-[leny/2,lenx/2]).astype(int)
-
-    subref = reference.astype(float)[starty:starty+leny,startx:startx+lenx]
-    subimage = image.astype(float)[starty:starty+leny,startx:startx+lenx]
+    if reference_fft is None:
+        reference_fft = central_subimage_fft(reference, image_fraction)
+    image_fft = central_subimage_fft(image, image_fraction)
 
-    shifts, errors, phasediff = phase_cross_correlation(subref,subimage,
+    shifts, errors, phasediff = phase_cross_correlation(reference_fft,image_fft,
+                                                        space='fourier',
                                                         normalization=None,
                                                         upsample_factor=upsample_factor)
     shifty,shiftx = shifts
 
     return shiftx,shifty
 
+def central_subimage_fft(image, image_fraction=0.25):
+    """
+    Return the Fourier transform of the central fraction of an image, as used by find_images_shifts
+    """
+
+    leny, lenx = (np.array(image.shape) * image_fraction).astype(int)
+    starty,startx = (np.array(image.shape)*0.5-[leny/2,lenx/2]).astype(int)
+
+    return np.fft.fftn(image.astype(float)[starty:starty+leny,startx:startx+lenx])
+
 @task
-def refine_image_wcs(analyst, radius=10, star_limit=10000, log=None, debug=False):
+def refine_image_wcs(analyst, radius=10, star_limit=10000, solver='astropy', matcher='ransac', seed=None,
+                     sip_degree=1, distortion=None, model_cache=None, log=None, debug=False):
     """
     Refine the WCS of an image with Gaia catalog. First, find shifts in X,Y between the image stars catalog and
     a model image of the Gaia catalog. Then compute the full WCS solution using ransac and a affine transform.
@@ -61,27 +76,34 @@ def refine_image_wcs(analyst, radius=10, star_limit=10000, log=None, debug=False
     analyst: AperturePhotometryAnalyst
     radius: float, arcmin  radius of stars from center of image to use for astrometric fit
     star_limit : int, the limit number of stars to use
+    solver : str, 'astropy' to fit the WCS with astropy's fit_wcs_from_points, or 'linear' to use
+             the closed-form fit_wcs_linear
+    matcher : str, 'ransac' to match stars with skimage's RANSAC, or 'consensus' to use the deterministic
+              match_stars_consensus
+    seed : int, [optional] random seed of the RANSAC matching step
+    sip_degree : int, the degree of the WCS fit; distortion terms of degree 2 and above are fitted with
+                 fit_wcs_linear, referenced to the center of the detector
+    distortion : astropy.wcs.Sip, [optional] the distortion of the camera, held fixed while fitting the
+                 linear terms of the WCS with fit_wcs_linear
+    model_cache : ModelImageCache, [optional] cache of the Fourier transforms of the catalog model images of
+                  the field
     log : object pipeline log
 
     Returns
     -------
-    new_wcs : astropy.wcs, an updated astropy WCS object
+    new_wcs : astropy.wcs, an updated astropy WCS object.  The number of matches, inliers and the residual RMS
+              of the fit are stored in analyst.wcs_fit_stats
     """
 
     # Initialize the new WCS from the original image WCS
     new_wcs = copy.deepcopy(analyst.image_original_wcs)
 
-    # List the Gaia stars around the center of the image
+    # List the Gaia stars around the center of the image, using the cached projection of the
+    # catalog for this field
+    projection = analyst.catalog_projection
     mask1 = analyst.sources['gaia_id'] > 0
-    catalog_coords = SkyCoord(ra=analyst.sources['ra'].data,
-                      dec=analyst.sources['dec'].data,
-                      unit=(u.degree, u.degree), frame='icrs')
-
-    center = SkyCoord(ra=analyst.ra_center, dec=analyst.dec_center,
-                      unit=(u.degree, u.degree), frame='icrs')
-    separations = center.separation(catalog_coords)
-    mask2 = separations <= radius * u.arcmin
-    gaia_idx = mask1 & mask2
+    mask2 = projection.separations <= radius / 60.0
+    gaia_idx = np.where(mask1 & mask2)[0]
 
     # List the detected stars around the center of the image
     # Find the center of the positions
@@ -100,7 +122,7 @@ def refine_image_wcs(analyst, radius=10, star_limit=10000, log=None, debug=False
 
     # If the initial WCS fit is so poor that the stars are off the frame, there isn't much we
     # can do here
-    star_pix = new_wcs.world_to_pixel(catalog_coords[gaia_idx])
+    star_pix = projection.world_to_pixel(new_wcs, gaia_idx)
     stars_positions = np.array(star_pix).T
     wcs_check = astrometry_qc.check_stars_within_frame(analyst.image_data.shape, stars_positions, log=log)
 
@@ -112,14 +134,26 @@ def refine_image_wcs(analyst, radius=10, star_limit=10000, log=None, debug=False
             lcologs.log('WCS refinement, iteration ' + str(it+1), 'info', log=log)
 
             # Calculate the image pixel positions of selected Gaia stars in the catalog
-            star_pix = new_wcs.world_to_pixel(catalog_coords[gaia_idx])
+            star_pix = projection.world_to_pixel(new_wcs, gaia_idx)
             stars_positions = np.array(star_pix).T
             lcologs.log('Calculated image coordinates for ' + str(len(star_pix[0])) + ' catalog stars', 'info', log=log)
 
-            # Build a simulated image using the predicted positions of the stars in the catalog
-            model_gaia_image = image_tools.build_image(stars_positions, fluxes, analyst.image_data.shape,
-                                                        image_fraction=1, star_limit = star_limit)
-            if debug:
+            # Build a simulated image using the predicted positions of the stars in the catalog, unless the
+            # transform of one built for a matching WCS is cached
+            model_gaia_image = None
+            reference_fft = None
+            if model_cache is not None:
+                cache_key = model_cache.get_key(new_wcs, analyst.image_data.shape, len(gaia_idx), star_limit)
+                reference_fft = model_cache.get(cache_key, log=log)
+
+            if reference_fft is None:
+                model_gaia_image = image_tools.build_image(stars_positions, fluxes, analyst.image_data.shape,
+                                                            image_fraction=1, star_limit = star_limit)
+                if model_cache is not None:
+                    reference_fft = central_subimage_fft(model_gaia_image, image_fraction=0.25)
+                    model_cache.add(cache_key, reference_fft, log=log)
+
+            if debug and model_gaia_image is not None:
                 file_path = os.path.join(analyst.dir_path, 'debug', analyst.image_name.replace('.fits', '_gaia.fits'))
                 image_tools.output_image(model_gaia_image, file_path)
                 file_path = os.path.join(analyst.dir_path, 'debug', analyst.image_name.replace('.fits', '_gaia.reg'))
@@ -139,7 +173,8 @@ def refine_image_wcs(analyst, radius=10, star_limit=10000, log=None, debug=False
                                              xcol=0, ycol=1)
 
             # Calculate the 2D shift between the model images
-            shiftx, shifty = find_images_shifts(model_gaia_image, model_image, image_fraction=0.25, upsample_factor=1)
+            shiftx, shifty = find_images_shifts(model_gaia_image, model_image, image_fraction=0.25, upsample_factor=1,
+                                                reference_fft=reference_fft)
             lcologs.log('Calculated image shifts in x,y = ' + str(shiftx) + ', ' + str(shifty), 'info', log=log)
 
             # Applying the calculated shifts, calculate the cartesian separations between detected and catalog stars,
@@ -147,20 +182,29 @@ def refine_image_wcs(analyst, radius=10, star_limit=10000, log=None, debug=False
             cat_star_pix_select = np.c_[star_pix[0][:star_limit] - shiftx,
                                         star_pix[1][:star_limit] - shifty]
             det_star_pix_select = det_star_pix[:star_limit,:2]
-            cat_coords_select = catalog_coords[gaia_idx][:star_limit]
-            dists = sspa.distance.cdist(det_star_pix_select, cat_star_pix_select)
+            cat_idx_select = gaia_idx[:star_limit]
+            if matcher == 'consensus':
+                lines, cols, model_robust, inliers = match_stars_consensus(
+                    det_star_pix_select, cat_star_pix_select, max_distance=10, log=log
+                )
+            else:
+                dists = sspa.distance.cdist(det_star_pix_select, cat_star_pix_select)
 
-            mask = dists < 10
-            lines, cols = np.where(mask)
+                mask = dists < 10
+                lines, cols = np.where(mask)
 
             #pts1 = np.c_[star_pix[0], star_pix[1]][:star_limit][cols]
             pts1 = cat_star_pix_select[cols]
             pts2 = det_star_pix_select[lines]
 
             # Use the RANSAC method to find matching detected and catalog stars
-            if len(pts1) > 5 and len(pts2) > 5:
-                model_robust, inliers = ransac((pts2, pts1), tf.AffineTransform, min_samples=10, residual_threshold=5,
-                                           max_trials=300)
+            if matcher == 'consensus' and model_robust is None:
+                lcologs.log('No consensus match found between detected and catalog stars', 'warning', log=log)
+
+            elif len(pts1) > 5 and len(pts2) > 5:
+                if matcher != 'consensus':
+                    model_robust, inliers = ransac((pts2, pts1), tf.AffineTransform, min_samples=10,
+                                                   residual_threshold=5, max_trials=300, rng=seed)
                 lcologs.log(
                     'Found ' + str(len(inliers)) + ' inliers from ' + str(len(pts1)) + ' possible matches',
                     'info', log=log
@@ -177,11 +221,30 @@ def refine_image_wcs(analyst, radius=10, star_limit=10000, log=None, debug=False
                                                  xcol=0, ycol=1)
 
                 # Update the new WCS using the matching stars
-                new_wcs = utils.fit_wcs_from_points(pts2[inliers].T, cat_coords_select[cols][inliers], sip_degree=1)
+                fit_idx = cat_idx_select[cols][inliers]
+                if distortion is not None or sip_degree > 1:
+                    ny, nx = analyst.image_data.shape
+                    new_wcs = fit_wcs_linear(pts2[inliers].T, projection.ra[fit_idx], projection.dec[fit_idx],
+                                             sip_degree=sip_degree, crpix=[(nx + 1) / 2.0, (ny + 1) / 2.0],
+                                             sip=distortion, image_shape=analyst.image_data.shape, log=log)
+                elif solver == 'linear':
+                    new_wcs = fit_wcs_linear(pts2[inliers].T, projection.ra[fit_idx], projection.dec[fit_idx],
+                                             sip_degree=1, image_shape=analyst.image_data.shape, log=log)
+                else:
+                    fit_coords = SkyCoord(ra=projection.ra[fit_idx], dec=projection.dec[fit_idx],
+                                          unit=(u.degree, u.degree), frame='icrs')
+                    new_wcs = utils.fit_wcs_from_points(pts2[inliers].T, fit_coords, sip_degree=1)
                 lcologs.log('New image WCS = ' + repr(new_wcs), 'info', log=log)
 
+                fit_pix = np.array(projection.world_to_pixel(new_wcs, fit_idx)).T
+                analyst.wcs_fit_stats = {
+                    'nmatches': len(pts1),
+                    'ninliers': int(inliers.sum()),
+                    'rms': float(np.sqrt(((fit_pix - pts2[inliers])**2).sum(axis=1).mean()))
+                }
+
                 if debug:
-                    new_star_pix = new_wcs.world_to_pixel(catalog_coords)
+                    new_star_pix = projection.world_to_pixel(new_wcs)
                     new_stars_positions = np.array(new_star_pix).T
                     file_path = os.path.join(analyst.dir_path, 'debug', analyst.image_name.replace('.fits', '_new_gaia.reg'))
                     ds9_utils.output_ds9_overlay(new_stars_positions, file_path, format='array', colour='cyan', xcol=0,
@@ -196,6 +259,533 @@ def refine_image_wcs(analyst, radius=10, star_limit=10000, log=None, debug=False
 
     return new_wcs
 
+@task
+def refine_image_wcs_from_reference(analyst, reference, max_offset=100, match_radius=3.0, min_matches=10,
+                                    nstars=300, matcher='ransac', seed=None, log=None):
+    """
+    Fit the WCS of an image relative to the reference image of the dataset. The stars detected in the image are
+    matched in pixel space to those detected in the reference, a pixel-to-pixel affine transform is fitted to the
+    matches, and this is composed with the refined WCS of the reference. This avoids projecting the whole catalog
+    and fitting a full WCS solution for every frame.
+
+    Parameters
+    ----------
+    analyst: AperturePhotometryAnalyst
+    reference: ReferenceAstrometry, the astrometry of the reference image
+    max_offset: float, the maximum shift in pixels expected between the image and the reference
+    match_radius: float, the radius in pixels within which stars are matched, once the shift is applied
+    min_matches: int, the minimum number of matched stars required to fit the transform
+    nstars: int, the number of brightest stars used to estimate the shift
+    matcher : str, 'ransac' or 'consensus', see refine_image_wcs
+    seed : int, [optional] random seed of the RANSAC matching step
+    log : object pipeline log
+
+    Returns
+    -------
+    new_wcs : astropy.wcs, an updated astropy WCS object or None if the fit failed
+    """
+
+    # Detected stars, brightest first
+    order = np.argsort(analyst.image_source_catalog[:,2])[::-1]
+    det_star_pix = analyst.image_source_catalog[order,:2]
+
+    # Initial guess of the offset from the image header WCS, refined by matching the brightest stars
+    center = np.array(analyst.image_data.shape[::-1]) / 2.0
+    center_coords = analyst.image_original_wcs.pixel_to_world(center[0], center[1])
+    guess = np.array(reference.wcs.world_to_pixel(center_coords)) - center
+    offset = estimate_pixel_offset(reference.positions[:nstars] - guess, det_star_pix[:nstars],
+                                   max_offset=max_offset) + guess
+    lcologs.log('Estimated offset from reference in x,y = ' + repr(offset), 'info', log=log)
+
+    # Match detected stars to the reference stars
+    if matcher == 'consensus':
+        det_idx, ref_idx, model_robust, inliers = match_stars_consensus(
+            det_star_pix + offset, reference.positions, max_distance=match_radius, log=log
+        )
+        pts1 = reference.positions[ref_idx]
+        pts2 = det_star_pix[det_idx]
+        if model_robust is not None:
+            model_robust = tf.AffineTransform(model_robust.params @ tf.AffineTransform(translation=offset).params)
+    else:
+        dists, idx = reference.tree.query(det_star_pix + offset, k=1, distance_upper_bound=match_radius)
+        matched = np.isfinite(dists)
+        pts1 = reference.positions[idx[matched]]
+        pts2 = det_star_pix[matched]
+    lcologs.log('Matched ' + str(len(pts1)) + ' stars with the reference', 'info', log=log)
+
+    if len(pts1) < min_matches:
+        lcologs.log('Insufficient matching stars for relative astrometry', 'warning', log=log)
+        return None
+
+    if matcher != 'consensus':
+        model_robust, inliers = ransac((pts2, pts1), tf.AffineTransform, min_samples=3, residual_threshold=1,
+                                       max_trials=300, rng=seed)
+    if model_robust is None or inliers.sum() < min_matches:
+        lcologs.log('Failed to fit the transform to the reference', 'warning', log=log)
+        return None
+
+    residuals = np.sqrt(((model_robust(pts2[inliers]) - pts1[inliers])**2).sum(axis=1))
+    analyst.wcs_fit_stats = {
+        'nmatches': len(pts1),
+        'ninliers': int(inliers.sum()),
+        'rms': float(np.sqrt((residuals**2).mean()))
+    }
+    lcologs.log(
+        'Found ' + str(inliers.sum()) + ' inliers from ' + str(len(pts1)) + ' matches, residual RMS = '
+        + str(analyst.wcs_fit_stats['rms']) + ' pix',
+        'info', log=log
+    )
+
+    new_wcs = compose_wcs_with_transform(reference.wcs, model_robust, analyst.image_data.shape)
+    lcologs.log('New image WCS = ' + repr(new_wcs), 'info', log=log)
+
+    return new_wcs
+
+def fit_wcs_linear(pixels, ra, dec, sip_degree=1, crpix=None, sip=None, weights=None, sigma_clip=3.0,
+                   max_iterations=5, image_shape=None, log=None):
+    """
+    Fit a TAN(-SIP) WCS to matched pixel and sky positions by linear least squares in standard coordinates.
+    Given a tangent point, the standard coordinates are a polynomial in the pixel offsets from CRPIX whose
+    linear terms give the CD matrix and whose higher order terms give CD times the SIP coefficients, so the
+    fit is closed-form.  The tangent point is then moved to the sky position of CRPIX and the fit repeated,
+    and outliers are sigma-clipped.
+
+    Parameters
+    ----------
+    pixels : array, (2,N) the 0-based x,y pixel positions of the stars
+    ra, dec : array, the sky positions of the stars in degrees
+    sip_degree : int, the degree of the fit; SIP terms are only added for degree 2 and above
+    crpix : array, [optional] the FITS (1-based) reference pixel, by default the center of the positions
+    sip : astropy.wcs.Sip, [optional] a distortion held fixed in the fit, in which case only the linear terms
+          are fitted and the reference pixel is that of the SIP terms
+    weights : array, [optional] the weights of the stars
+    sigma_clip : float, the threshold, in units of the residual RMS, above which stars are rejected
+    max_iterations : int, the maximum number of fit iterations
+    image_shape : tuple, [optional] the (ny, nx) shape of the image, which sets the pixel_shape of the WCS
+    log : object pipeline log
+
+    Returns
+    -------
+    new_wcs : astropy.wcs, the fitted WCS
+    """
+
+    xp = np.asarray(pixels[0], dtype=float)
+    yp = np.asarray(pixels[1], dtype=float)
+    vectors = lcoproj.radec_to_unit_vectors(ra, dec)
+    weights = np.ones(len(xp)) if weights is None else np.asarray(weights, dtype=float)
+
+    if sip is not None:
+        crpix = np.array(sip.crpix)
+        sip_degree = 1
+    elif crpix is None:
+        crpix = np.array([(xp.max() + xp.min()) / 2.0, (yp.max() + yp.min()) / 2.0]) + 1.0
+    crpix = np.asarray(crpix, dtype=float)
+
+    # Initial tangent point at the mean position of the stars
+    mean_vector = vectors.mean(axis=0)
+    crval = np.array([np.degrees(np.arctan2(mean_vector[1], mean_vector[0])) % 360.0,
+                      np.degrees(np.arcsin(mean_vector[2] / np.linalg.norm(mean_vector)))])
+
+    order = max(sip_degree, 1)
+    terms = [(p, q) for p in range(order + 1) for q in range(order + 1) if p + q <= order]
+    u_pix = xp + 1.0 - crpix[0]
+    v_pix = yp + 1.0 - crpix[1]
+    if sip is not None:
+        u_pix, v_pix = (u_pix + lcoproj.sip_correction(sip.a, u_pix, v_pix),
+                        v_pix + lcoproj.sip_correction(sip.b, u_pix, v_pix))
+    scale = max(np.abs(u_pix).max(), np.abs(v_pix).max(), 1.0)
+    design = np.array([(u_pix / scale)**p * (v_pix / scale)**q for (p, q) in terms]).T
+
+    inliers = weights > 0
+    for it in range(max_iterations):
+        # Two passes are enough to move the tangent point onto CRPIX
+        for tangent_pass in range(2):
+            xi, eta = lcoproj.standard_coordinates(vectors, crval[0], crval[1])
+            sqrt_w = np.sqrt(weights[inliers])[:, np.newaxis]
+            coeffs, _, _, _ = np.linalg.lstsq(design[inliers] * sqrt_w, np.c_[xi, eta][inliers] * sqrt_w,
+                                              rcond=None)
+            ra0, dec0 = lcoproj.standard_to_radec(coeffs[0, 0], coeffs[0, 1], crval[0], crval[1])
+            crval = np.array([ra0[0], dec0[0]])
+
+        # Residuals in pixels, for clipping
+        cd = np.array([[coeffs[terms.index((1, 0)), 0], coeffs[terms.index((0, 1)), 0]],
+                       [coeffs[terms.index((1, 0)), 1], coeffs[terms.index((0, 1)), 1]]]) / scale
+        residuals = (design @ coeffs - np.c_[xi, eta]) @ np.linalg.inv(cd).T
+        dist = np.sqrt((residuals**2).sum(axis=1))
+        rms = np.sqrt((dist[inliers]**2).mean())
+
+        new_inliers = (weights > 0) & (dist <= sigma_clip * rms)
+        if (new_inliers == inliers).all() or new_inliers.sum() < len(terms) + 1:
+            break
+        inliers = new_inliers
+
+    lcologs.log(
+        'Linear WCS fit: ' + str(inliers.sum()) + ' of ' + str(len(xp)) + ' stars used, residual RMS = '
+        + str(rms) + ' pix after ' + str(it + 1) + ' iterations',
+        'info', log=log
+    )
+
+    new_wcs = WCS(naxis=2)
+    new_wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    new_wcs.wcs.cunit = ['deg', 'deg']
+    new_wcs.wcs.crval = crval
+    new_wcs.wcs.crpix = crpix
+    new_wcs.wcs.cd = cd
+
+    # Higher order terms are CD . (A, B) in the SIP convention
+    if sip_degree >= 2:
+        cd_inv = np.linalg.inv(cd)
+        a = np.zeros((order + 1, order + 1))
+        b = np.zeros((order + 1, order + 1))
+        for k, (p, q) in enumerate(terms):
+            if p + q >= 2:
+                a[p, q], b[p, q] = cd_inv @ coeffs[k] / scale**(p + q)
+        new_wcs.wcs.ctype = ['RA---TAN-SIP', 'DEC--TAN-SIP']
+        new_wcs.sip = Sip(a, b, None, None, crpix)
+
+    elif sip is not None:
+        new_wcs.wcs.ctype = ['RA---TAN-SIP', 'DEC--TAN-SIP']
+        new_wcs.sip = Sip(sip.a, sip.b, None, None, crpix)
+
+    if image_shape is not None:
+        new_wcs.pixel_shape = (image_shape[1], image_shape[0])
+
+    return new_wcs
+
+def match_stars_consensus(det_positions, cat_positions, max_distance=10, sigma_clip=3.0, min_residual=0.5,
+                          max_iterations=10, max_pairs=5000, log=None):
+    """
+    Deterministic robust matching of detected and catalog star positions, as an alternative to RANSAC.
+    Candidate pairs are the mutual nearest neighbours within max_distance.  A consensus on the translation is
+    taken from the median pair offset, then an affine transform is fitted by least squares, with iterative
+    sigma-clipping of the pairs, for a bounded number of iterations.
+
+    Parameters
+    ----------
+    det_positions : array, [X,Y] positions of the detected stars
+    cat_positions : array, [X,Y] positions of the catalog stars, approximately aligned with the detections
+    max_distance : float, the maximum separation of candidate pairs in pixels
+    sigma_clip : float, the threshold, in units of the residual RMS, above which pairs are rejected
+    min_residual : float, the minimum clipping threshold in pixels
+    max_iterations : int, the maximum number of clipping iterations
+    max_pairs : int, the maximum number of candidate pairs used; larger sets are subsampled with a fixed stride
+    log : object pipeline log
+
+    Returns
+    -------
+    det_idx : array, the indices of the paired detected stars
+    cat_idx : array, the indices of the paired catalog stars
+    model : skimage.transform.AffineTransform, the transform from detected to catalog positions, or None
+    inliers : array, boolean mask of the pairs retained in the fit
+    """
+
+    det_positions = np.asarray(det_positions)[:,:2]
+    cat_positions = np.asarray(cat_positions)[:,:2]
+    empty = np.array([], dtype=int)
+
+    if len(det_positions) == 0 or len(cat_positions) == 0:
+        return empty, empty, None, np.array([], dtype=bool)
+
+    # Mutual nearest neighbours within the matching distance
+    dist, cat_idx = sspa.cKDTree(cat_positions).query(det_positions, k=1, distance_upper_bound=max_distance)
+    _, back_idx = sspa.cKDTree(det_positions).query(cat_positions, k=1)
+    det_idx = np.arange(len(det_positions))
+    mutual = np.isfinite(dist)
+    mutual[mutual] = back_idx[cat_idx[mutual]] == det_idx[mutual]
+    det_idx = det_idx[mutual]
+    cat_idx = cat_idx[mutual]
+
+    # Evenly spaced pairs, so that the subsample is deterministic and spans the whole list of detections
+    if len(det_idx) > max_pairs:
+        keep = np.linspace(0, len(det_idx) - 1, max_pairs).astype(int)
+        det_idx = det_idx[keep]
+        cat_idx = cat_idx[keep]
+
+    if len(det_idx) < 3:
+        lcologs.log('Only ' + str(len(det_idx)) + ' mutual nearest neighbour pairs found', 'warning', log=log)
+        return det_idx, cat_idx, None, np.zeros(len(det_idx), dtype=bool)
+
+    src = det_positions[det_idx]
+    dst = cat_positions[cat_idx]
+
+    # Consensus on the translation
+    offsets = dst - src
+    median_offset = np.median(offsets, axis=0)
+    spread = np.sqrt(((offsets - median_offset)**2).sum(axis=1))
+    mad = np.median(spread)
+    inliers = spread <= max(sigma_clip * 1.4826 * mad, min_residual)
+
+    # Iterative sigma-clipped affine least squares
+    design = np.c_[src, np.ones(len(src))]
+    converged = False
+    for it in range(max_iterations):
+        if inliers.sum() < 3:
+            lcologs.log('Affine fit failed after ' + str(it) + ' iterations', 'warning', log=log)
+            return det_idx, cat_idx, None, inliers
+
+        coeffs, _, _, _ = np.linalg.lstsq(design[inliers], dst[inliers], rcond=None)
+        model = tf.AffineTransform(matrix=np.r_[coeffs.T, [[0.0, 0.0, 1.0]]])
+        residuals = np.sqrt(((model(src) - dst)**2).sum(axis=1))
+        rms = np.sqrt((residuals[inliers]**2).mean())
+        new_inliers = residuals <= max(sigma_clip * rms, min_residual)
+
+        if (new_inliers == inliers).all():
+            converged = True
+            break
+        inliers = new_inliers
+
+    lcologs.log(
+        'Consensus match: ' + str(inliers.sum()) + ' inliers from ' + str(len(det_idx))
+        + ' mutual nearest neighbour pairs, residual RMS = ' + str(rms) + ' pix, '
+        + str(it + 1) + ' iterations, converged=' + str(converged),
+        'info', log=log
+    )
+
+    return det_idx, cat_idx, model, inliers
+
+def estimate_pixel_offset(ref_positions, positions, max_offset=100, bin_size=2.0):
+    """
+    Estimate the (X,Y) offset between two sets of star positions, by voting over all pairwise differences.
+
+    Parameters
+    ----------
+    ref_positions : array, [X,Y] positions of the reference stars
+    positions : array, [X,Y] positions of the stars to be shifted
+    max_offset : float, the largest offset considered in pixels
+    bin_size : float, the size of the voting bins in pixels
+
+    Returns
+    -------
+    offset : array, the [X,Y] offset to add to positions to match ref_positions
+    """
+
+    diffs = (ref_positions[:, np.newaxis, :2] - positions[np.newaxis, :, :2]).reshape(-1, 2)
+    diffs = diffs[np.all(np.abs(diffs) < max_offset, axis=1)]
+
+    if len(diffs) == 0:
+        return np.zeros(2)
+
+    bins = np.arange(-max_offset, max_offset + bin_size, bin_size)
+    votes, xedges, yedges = np.histogram2d(diffs[:,0], diffs[:,1], bins=[bins, bins])
+    i, j = np.unravel_index(np.argmax(votes), votes.shape)
+    peak = np.array([xedges[i], yedges[j]]) + bin_size / 2.0
+
+    # Refine the peak position from the differences which voted for it
+    close = np.all(np.abs(diffs - peak) <= bin_size, axis=1)
+
+    return diffs[close].mean(axis=0)
+
+def compose_wcs_with_transform(reference_wcs, transform, image_shape):
+    """
+    Build the WCS of an image from the WCS of the reference and the affine transform mapping the image pixel
+    positions onto the reference pixel positions.
+
+    Parameters
+    ----------
+    reference_wcs : astropy.wcs, the WCS of the reference image
+    transform : skimage.transform.AffineTransform, transform from image to reference pixels
+    image_shape : tuple, the shape of the image
+
+    Returns
+    -------
+    new_wcs : astropy.wcs, the WCS of the image
+    """
+
+    matrix = transform.params[:2,:2]
+    translation = transform.params[:2,2]
+
+    # The reference point moves to the image pixel which the transform maps onto it; pixel offsets from the
+    # reference point are then related by the matrix alone, so it can be absorbed into the CD matrix
+    crpix = np.linalg.solve(matrix, reference_wcs.wcs.crpix - 1 - translation) + 1
+
+    new_wcs = copy.deepcopy(reference_wcs)
+    new_wcs.wcs.crpix = crpix
+    if new_wcs.wcs.has_cd():
+        new_wcs.wcs.cd = reference_wcs.wcs.cd @ matrix
+    else:
+        new_wcs.wcs.pc = reference_wcs.wcs.get_pc() @ matrix
+
+    if reference_wcs.sip is not None:
+        a, b = transform_sip_coefficients(reference_wcs.sip, matrix, image_shape)
+        new_wcs.sip = Sip(a, b, None, None, crpix)
+
+    new_wcs.pixel_shape = (image_shape[1], image_shape[0])
+
+    return new_wcs
+
+def transform_sip_coefficients(sip, matrix, image_shape, npoints=20):
+    """
+    Re-express the SIP distortion of the reference in the pixel frame of an image, g(u) = M^-1 f(M u), where
+    M is the matrix of the image to reference transform.  The result is a polynomial of the same order, so it is
+    recovered exactly by a least squares fit on a grid of positions.
+
+    Parameters
+    ----------
+    sip : astropy.wcs.Sip, the SIP distortion of the reference
+    matrix : array, the 2x2 matrix of the image to reference transform
+    image_shape : tuple, the shape of the image
+    npoints : int, the number of grid points along each axis
+
+    Returns
+    -------
+    a, b : array, the SIP A and B coefficients in the image frame
+    """
+
+    order = sip.a_order
+    yy, xx = np.meshgrid(np.linspace(0, image_shape[0], npoints), np.linspace(0, image_shape[1], npoints))
+    u_img = np.c_[xx.ravel() - image_shape[1] / 2.0, yy.ravel() - image_shape[0] / 2.0]
+
+    u_ref = u_img @ matrix.T
+    distortion = np.c_[lcoproj.sip_correction(sip.a, u_ref[:,0], u_ref[:,1]),
+                       lcoproj.sip_correction(sip.b, u_ref[:,0], u_ref[:,1])]
+    target = distortion @ np.linalg.inv(matrix).T
+
+    terms = [(p, q) for p in range(order + 1) for q in range(order + 1) if p + q <= order]
+    design = np.array([u_img[:,0]**p * u_img[:,1]**q for (p, q) in terms]).T
+    coeffs, _, _, _ = np.linalg.lstsq(design, target, rcond=None)
+
+    a = np.zeros((order + 1, order + 1))
+    b = np.zeros((order + 1, order + 1))
+    for k, (p, q) in enumerate(terms):
+        a[p, q] = coeffs[k, 0]
+        b[p, q] = coeffs[k, 1]
+
+    return a, b
+
+class ReferenceAstrometry(object):
+    """
+    Refined WCS and detected star positions of the reference image of a dataset, indexed for pixel-space
+    matching against the other frames.
+
+    Attributes
+    ----------
+    wcs : astropy.wcs, the refined WCS of the reference image
+    positions : array, [X,Y] positions of stars detected in the reference, brightest first
+    tree : scipy.spatial.cKDTree, the index of the reference star positions
+    """
+
+    def __init__(self, file_path=None, log=None):
+
+        self.wcs = None
+        self.positions = None
+        self.tree = None
+
+        if file_path:
+            if os.path.isfile(file_path):
+                self.load(file_path, log=log)
+            else:
+                lcologs.log('No reference astrometry found at ' + file_path, 'info', log=log)
+
+    def set_from_analyst(self, analyst):
+        """
+        Set the reference astrometry from an AperturePhotometryAnalyst with a refined WCS
+        """
+
+        order = np.argsort(analyst.image_source_catalog[:,2])[::-1]
+        self.wcs = copy.deepcopy(analyst.image_new_wcs)
+        self.positions = np.array(analyst.image_source_catalog[order,:2])
+        self.tree = sspa.cKDTree(self.positions)
+
+    def load(self, file_path, log=None):
+
+        with fits.open(file_path) as hdul:
+            self.wcs = WCS(hdul[0].header)
+            self.positions = np.c_[hdul[1].data['x'], hdul[1].data['y']]
+        self.tree = sspa.cKDTree(self.positions)
+        lcologs.log('Loaded reference astrometry from ' + file_path, 'info', log=log)
+
+    def save(self, file_path, log=None):
+
+        primary = fits.PrimaryHDU(header=self.wcs.to_header(relax=True))
+        sources = fits.table_to_hdu(Table([
+            Column(name='x', data=self.positions[:,0]),
+            Column(name='y', data=self.positions[:,1])
+        ]))
+        sources.header['EXTNAME'] = 'REFERENCE SOURCES'
+        fits.HDUList([primary, sources]).writeto(file_path, overwrite=True)
+        lcologs.log('Saved reference astrometry to ' + file_path, 'info', log=log)
+
+class ModelImageCache(object):
+    """
+    Cache of the Fourier transforms of the catalog model images of a field, used to measure the shift of each
+    frame in refine_image_wcs.  For a fixed pointing the model barely changes from frame to frame, so it is keyed
+    by the header WCS, quantized to a couple of pixels, well within the matching radius, together with the image shape and the selection of
+    catalog stars.  Transforms are held in memory for the duration of a reduction and optionally stored on disk.
+
+    Attributes
+    ----------
+    cache_dir : str, [optional] the directory in which the transforms are stored
+    quantum : float, the quantization of the WCS keys in pixels
+    max_entries : int, the maximum number of transforms held in memory
+    ffts : dict, the transforms held in memory
+    """
+
+    def __init__(self, cache_dir=None, quantum=2.0, max_entries=10, log=None):
+
+        self.cache_dir = cache_dir
+        self.quantum = quantum
+        self.max_entries = max_entries
+        self.ffts = {}
+
+        if self.cache_dir and not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+            lcologs.log('Created model image cache at ' + self.cache_dir, 'info', log=log)
+
+    def get_key(self, image_wcs, image_shape, nstars, star_limit):
+        """
+        Return the cache key of a model image, with the WCS parameters rounded to the quantum in pixels
+        """
+
+        # The scale and rotation are quantized by the displacement they cause at the edge of the image, and the
+        # rounded scale is used to express the reference sky position in pixels
+        cd = lcoproj.wcs_pixel_scale_matrix(image_wcs)
+        max_size = max(image_shape)
+        pixscale = np.sqrt(np.abs(np.linalg.det(cd)))
+        scale_key = int(np.round(np.log(pixscale) * max_size / self.quantum))
+        pixscale = np.exp(scale_key * self.quantum / max_size)
+        crval = image_wcs.wcs.crval * [np.cos(np.radians(image_wcs.wcs.crval[1])), 1.0] / pixscale
+
+        key = (
+            tuple(image_shape), nstars, star_limit, scale_key,
+            tuple(np.round(image_wcs.wcs.crpix / self.quantum).astype(int)),
+            tuple(np.round(crval / self.quantum).astype(int)),
+            tuple(np.round(cd.ravel() / pixscale * max_size / self.quantum).astype(int))
+        )
+
+        return key
+
+    def get_file_path(self, key):
+        return os.path.join(self.cache_dir, 'model_fft_' + hashlib.md5(repr(key).encode()).hexdigest() + '.npy')
+
+    def get(self, key, log=None):
+        """
+        Return the cached transform for a key, or None
+        """
+
+        if key in self.ffts.keys():
+            lcologs.log('Using cached catalog model image transform', 'info', log=log)
+            return self.ffts[key]
+
+        if self.cache_dir and os.path.isfile(self.get_file_path(key)):
+            self.ffts[key] = np.load(self.get_file_path(key))
+            lcologs.log('Loaded catalog model image transform from ' + self.get_file_path(key), 'info', log=log)
+            return self.ffts[key]
+
+        return None
+
+    def add(self, key, fft, log=None):
+        """
+        Add a transform to the cache, discarding the oldest entry held in memory if the cache is full
+        """
+
+        if len(self.ffts) >= self.max_entries:
+            del self.ffts[next(iter(self.ffts))]
+        self.ffts[key] = fft
+
+        if self.cache_dir:
+            np.save(self.get_file_path(key), fft)
+            lcologs.log('Stored catalog model image transform in ' + self.get_file_path(key), 'info', log=log)
+
 def build_wcs_from_obs_set(obs_set):
     """
     Method to create an Astropy WCS object from a set of WCS keywords
@@ -224,3 +814,33 @@ def build_wcs_from_obs_set(obs_set):
         im_wcs.append(WCS(header=params))
 
     return im_wcs
+
+def project_catalog_into_frames(star_catalog, obs_set, file_path=None, log=None):
+    """
+    Compute the pixel positions of all stars in the catalog in every frame of an ObservationSet from the WCS
+    parameters in its table, without building a WCS object per frame.  If a file path is given, the
+    positions are stored as a float32 .npy file, which can be re-opened as a memory map with
+    np.load(file_path, mmap_mode='r').
+
+    Parameters
+    ----------
+    star_catalog : StarCatalog, the star catalog of the field
+    obs_set : ObservationSet, the frames of the dataset
+    file_path : str, [optional] path of the output .npy file
+    log : object pipeline log
+
+    Returns
+    -------
+    positions : array, (N_stars, N_frames, 2) 0-based pixel positions
+    """
+
+    wcs_stack = lcoproj.WCSStack()
+    wcs_stack.set_from_obs_set(obs_set)
+    positions = star_catalog.get_projection().project_frames(wcs_stack, file_path=file_path)
+
+    lcologs.log(
+        'Projected ' + str(positions.shape[0]) + ' catalog stars into ' + str(positions.shape[1]) + ' frames',
+        'info', log=log
+    )
+
+    return positions
@@ -1,6 +1,35 @@
 import numpy as np
+from scipy.spatial import cKDTree
 from image_reduction.infrastructure import logs as lcologs
 
+def in_frame_mask(image_shape, star_positions):
+    """
+    Function to flag the star pixel positions which lie within the frame boundaries
+
+    :param image_shape: Tuple of NAXIS1, NAXIS2 => max_y, max_x
+    :param star_positions: Numpy array of star pixel x,y positions
+    :return: Boolean array
+    """
+
+    star_positions = np.asarray(star_positions)
+
+    return ((star_positions[:,0] > 0) & (star_positions[:,0] < image_shape[1])
+            & (star_positions[:,1] > 0) & (star_positions[:,1] < image_shape[0]))
+
+def in_frame_fraction(image_shape, star_positions):
+    """
+    Function to return the fraction of star pixel positions which lie within the frame boundaries
+
+    :param image_shape: Tuple of NAXIS1, NAXIS2 => max_y, max_x
+    :param star_positions: Numpy array of star pixel x,y positions
+    :return: float
+    """
+
+    if len(star_positions) == 0:
+        return 0.0
+
+    return float(in_frame_mask(image_shape, star_positions).mean())
+
 def check_stars_within_frame(image_shape, star_positions, log=None):
     """
     Function to verify that the set of star pixel positions calculated from the image WCS
@@ -12,15 +41,104 @@ def check_stars_within_frame(image_shape, star_positions, log=None):
     :return: Boolean
     """
 
-    idx1 = np.where(star_positions[:,0] > 0)[0]
-    idx2 = np.where(star_positions[:,0] < image_shape[1])[0]
-    idx3 = np.where(star_positions[:,1] > 0)[0]
-    idx4 = np.where(star_positions[:,1] < image_shape[0])[0]
-    idx = set(idx1).intersection(set(idx2)).intersection(set(idx3)).intersection(set(idx4))
-
-    if len(idx) > 0:
+    if len(star_positions) > 0 and in_frame_mask(image_shape, star_positions).any():
         lcologs.log('Catalog stars projected to be within frame boundaries', 'info', log=log)
         return True
     else:
         lcologs.log('Catalog stars NOT within frame boundaries', 'warning', log=log)
-        return False
\ No newline at end of file
+        return False
+
+def valid_pixel_fraction(image_data):
+    """
+    Function to return the fraction of finite pixels in an image, or zero if the image is constant
+
+    :param image_data: Numpy image array
+    :return: float
+    """
+
+    valid = np.isfinite(image_data)
+    if not valid.any() or np.ptp(image_data[valid]) == 0:
+        return 0.0
+
+    return float(valid.mean())
+
+def match_fraction(det_positions, cat_positions, match_radius=3.0, nstars=500):
+    """
+    Function to measure the density of matches between detected and catalog stars, as the fraction
+    of the brightest detected stars which have a catalog star within the matching radius
+
+    :param det_positions: Numpy array of detected star pixel x,y positions, brightest first
+    :param cat_positions: Numpy array of catalog star pixel x,y positions
+    :param match_radius: float Matching radius in pixels
+    :param nstars: int Number of brightest detected stars to consider
+    :return: float
+    """
+
+    det_positions = np.asarray(det_positions)[:nstars,:2]
+    cat_positions = np.asarray(cat_positions)[:,:2]
+    if len(det_positions) == 0 or len(cat_positions) == 0:
+        return 0.0
+
+    dists, _ = cKDTree(cat_positions).query(det_positions, k=1, distance_upper_bound=match_radius)
+
+    return float(np.isfinite(dists).mean())
+
+def check_frame_before_detection(image_data, star_positions, min_valid_fraction=0.5, min_in_frame_fraction=0.1,
+                                 log=None):
+    """
+    Function to reject clearly hopeless frames before object detection and WCS refinement are run,
+    because the image data are largely invalid or because the header WCS places few of the catalog
+    stars around the field center within the frame
+
+    :param image_data: Numpy image array
+    :param star_positions: Numpy array of catalog star pixel x,y positions from the header WCS
+    :param min_valid_fraction: float Minimum fraction of valid pixels
+    :param min_in_frame_fraction: float Minimum fraction of catalog stars within the frame
+    :return: Boolean status and dictionary of QC metrics
+    """
+
+    qc = {
+        'valid_pixel_fraction': valid_pixel_fraction(image_data),
+        'header_in_frame_fraction': in_frame_fraction(image_data.shape, star_positions)
+    }
+
+    status = (qc['valid_pixel_fraction'] >= min_valid_fraction
+              and qc['header_in_frame_fraction'] >= min_in_frame_fraction)
+
+    if status:
+        lcologs.log('Frame passed pre-detection QC: ' + repr(qc), 'info', log=log)
+    else:
+        lcologs.log('Frame rejected by pre-detection QC: ' + repr(qc), 'warning', log=log)
+
+    return status, qc
+
+def assess_wcs_fit(image_shape, star_positions, det_positions, fit_stats, match_radius=3.0, log=None):
+    """
+    Function to compute the QC metrics of a refined WCS
+
+    :param image_shape: Tuple of NAXIS1, NAXIS2 => max_y, max_x
+    :param star_positions: Numpy array of catalog star pixel x,y positions from the refined WCS
+    :param det_positions: Numpy array of detected star pixel x,y positions, brightest first
+    :param fit_stats: dict Number of matches ('nmatches'), inliers ('ninliers') and residual RMS ('rms') of the fit
+    :param match_radius: float Matching radius in pixels
+    :return: dictionary of QC metrics
+    """
+
+    qc = {
+        'in_frame_fraction': in_frame_fraction(image_shape, star_positions),
+        'match_fraction': match_fraction(det_positions, star_positions, match_radius=match_radius),
+        'nmatches': np.nan,
+        'ninliers': np.nan,
+        'inlier_fraction': np.nan,
+        'residual_rms': np.nan
+    }
+
+    if fit_stats:
+        qc['nmatches'] = float(fit_stats['nmatches'])
+        qc['ninliers'] = float(fit_stats['ninliers'])
+        qc['inlier_fraction'] = fit_stats['ninliers'] / max(fit_stats['nmatches'], 1)
+        qc['residual_rms'] = float(fit_stats['rms'])
+
+    lcologs.log('WCS fit QC: ' + repr(qc), 'info', log=log)
+
+    return qc
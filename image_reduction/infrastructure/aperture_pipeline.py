@@ -4,13 +4,19 @@ import os
 from astropy.coordinates import SkyCoord
 from astropy.io import fits
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import numpy as  np
 import yaml
 
 import image_reduction.infrastructure.observations as lcoobs
 import image_reduction.infrastructure.logs as lcologs
 import image_reduction.photometry.aperture_photometry as lcoapphot
+import image_reduction.photometry.dia_photometry as lcodiaphot
+import image_reduction.photometry.deep_reference as lcodeepref
 import image_reduction.photometry.photometric_scale_factor as lcopscale
+from image_reduction.astrometry import wcs as lcowcs
+from image_reduction.astrometry import distortion as lcodistortion
 from image_reduction.IO import parquet, lightcurve, tom_utils
 from image_reduction.infrastructure.data_classes import StarCatalog
 
@@ -76,6 +82,7 @@ def reduce_dataset(args):
     star_catalog = StarCatalog(file_path=star_catalog_path, log=log)
 
     # If no star catalog is available, create one starting with known Gaia objects
+    ref_agent = None
     if not star_catalog.sources:
         star_catalog.create_from_Gaia_catalog(args, target, log=log)
 
@@ -90,6 +97,50 @@ def reduce_dataset(args):
             agent.image_new_wcs, agent.image_source_catalog, agent.dir_path, log
         )
         lcologs.log('Completed star catalog with objects detected in the reference image', 'info', log=log)
+        ref_agent = agent
+
+    ### REFERENCE ASTROMETRY
+    # Optionally fit the WCS of each frame relative to the reference image rather than to the Gaia catalog.
+    # This requires the refined WCS and detected stars of the reference, which are stored for later runs.
+    reference_astrometry = None
+    if 'astrometry' in config.keys() and config['astrometry'].get('mode', 'gaia') == 'reference':
+        ref_astrometry_path = os.path.join(args.directory, 'reference_astrometry.fits')
+        reference_astrometry = lcowcs.ReferenceAstrometry(file_path=ref_astrometry_path, log=log)
+
+        if reference_astrometry.wcs is None:
+            if not ref_agent:
+                ref_agent = lcoapphot.AperturePhotometryAnalyst(
+                    reference_image_name, args.directory, star_catalog, obs_set, config, log=log
+                )
+                star_catalog = ref_agent.run_image_astrometry(star_catalog, log)
+
+            if ref_agent.status == 'OK':
+                reference_astrometry.set_from_analyst(ref_agent)
+                reference_astrometry.save(ref_astrometry_path, log=log)
+            else:
+                lcologs.log(
+                    'No WCS fit for the reference image; using Gaia astrometry for all frames', 'warning', log=log
+                )
+                reference_astrometry = None
+
+    ### DISTORTION MODELS
+    # Optionally cache the distortion of each camera, built from the best WCS fits of all datasets, under the
+    # top-level reduction directory (by default data_reduction_dir/distortion_models)
+    distortion_cache = None
+    if 'astrometry' in config.keys() and config['astrometry'].get('distortion', False):
+        cache_dir = config['astrometry'].get(
+            'distortion_dir', os.path.join(args.directory, '..', '..', '..', 'distortion_models')
+        )
+        distortion_cache = lcodistortion.DistortionModelCache(
+            cache_dir, ncandidates=config['astrometry'].get('distortion_candidates', 10), log=log
+        )
+
+    # The transforms of the catalog model images used to measure frame shifts are shared by all frames,
+    # and optionally kept for later runs
+    if 'astrometry' in config.keys() and config['astrometry'].get('persist_model_cache', False):
+        model_cache = lcowcs.ModelImageCache(cache_dir=os.path.join(args.directory, 'model_cache'), log=log)
+    else:
+        model_cache = lcowcs.ModelImageCache(log=log)
 
     ### TIME SERIES PHOTOMETRY
     # Loop over all images
@@ -106,8 +157,13 @@ def reduce_dataset(args):
             with fits.open(image_path) as hdul:
 
                 # Perform astrometry on the image
-                agent = lcoapphot.AperturePhotometryAnalyst(im, args.directory, star_catalog, obs_set, config, log=log)
+                agent = lcoapphot.AperturePhotometryAnalyst(
+                    im, args.directory, star_catalog, obs_set, config,
+                    reference_astrometry=reference_astrometry, distortion_cache=distortion_cache,
+                    model_cache=model_cache, log=log
+                )
                 star_catalog = agent.run_image_astrometry(star_catalog, log)
+                agent.store_astrometry_qc(args.directory, log)
                 hdul = agent.store_new_wcs_in_image(hdul, log)
 
                 # If astrometry was successful, we can photometer the image
@@ -147,9 +203,22 @@ def reduce_dataset(args):
     ### Photometric Correction
     # Calculate the photometric scale factor and use it to compute corrected lightcurves.
     if len(obs_set.table) > 0:
-        dataset = lcopscale.calculate_pscale(
-            reference_image_name, obs_set, dataset, log=log
-        )
+        # The ensemble method solves for the zero points of all images and mean fluxes of all stars jointly
+        if config['photometry'].get('pscale_method', 'median') == 'ensemble':
+            dataset = lcopscale.calculate_ensemble_pscale(
+                reference_image_name, obs_set, dataset, log=log,
+                spatial_degree=config['photometry'].get('pscale_spatial_degree', 0)
+            )
+
+        # Incremental mode stores the comparison stars and scale factors, so that only new images are computed
+        else:
+            pscale_reference_path = None
+            if config['photometry'].get('incremental_pscale', False):
+                pscale_reference_path = os.path.join(args.directory, 'pscale_reference.npz')
+            dataset = lcopscale.calculate_pscale(
+                reference_image_name, obs_set, dataset, log=log, reference_path=pscale_reference_path,
+                drift_threshold=config['photometry'].get('pscale_drift_threshold', 0.01), recompute=args.update_phot
+            )
 
         # Output normalized timeseries photometry for the whole frame
         parquet.output_norm_flux(args.directory, dataset)
@@ -198,11 +267,127 @@ def reduce_dataset(args):
             log=log
         )
 
+    ### DIA PHOTOMETRY
+    # Optionally perform difference image photometry of the field around the target
+    if len(obs_set.table) > 0 and 'dia' in config.keys() and config['dia'].get('run', False):
+        run_dia_stage(args, config, obs_set, star_catalog, dataset, reference_image_name, log=log)
+
     # Wrap up
     log.info('Aperture photometry reduction completed')
     lcologs.close_log(log)
 
 
+def run_dia_stage(args, config, obs_set, star_catalog, dataset, reference_image_name, log=None):
+    """
+    Stage of the pipeline performing difference image photometry on a cutout around the target, using
+    the refined WCS of each image stored by the aperture photometry stage to align it to the reference.
+    The difference fluxes of each image are stored in the dia_flux parquet directory as they are computed,
+    with the transient candidates detected in the difference images in dia_candidates if requested,
+    and the DIA lightcurve of the target is output alongside the aperture photometry lightcurve.
+
+    Parameters
+    ----------
+    args    Object      Parameters of the dataset to be reduced
+    config  dict        Reduction configuration
+    obs_set ObservationSet  Images of the dataset
+    star_catalog StarCatalog Source table for the dataset
+    dataset AperturePhotometryDataset  Aperture photometry of the dataset
+    reference_image_name str  Name of the reference image
+    log     Logger      Logger object
+
+    Returns
+    -------
+    None
+    """
+
+    dia_config = config['dia']
+    kernel_size = dia_config.get('kernel_size', 17)
+    target = SkyCoord(config['target']['RA'], config['target']['Dec'], frame='icrs',
+                      unit=(u.hourangle, u.deg) if ':' in str(config['target']['RA']) else (u.deg, u.deg))
+
+    # A deep reference stacked from the best frames replaces the single reference image if requested,
+    # on the pixel grid and in the flux units of the best of these frames
+    reference_path = os.path.join(args.directory, reference_image_name)
+    if dia_config.get('deep_reference', False):
+        reference_path = os.path.join(args.directory, 'deep_reference.fits')
+        if not os.path.isfile(reference_path) or args.update_phot:
+            frames = lcodeepref.select_reference_frames(
+                args.directory, obs_set, nframes=dia_config.get('deep_reference_frames', 10), log=log
+            )
+            lcodeepref.build_deep_reference(args.directory, frames, obs_set, reference_path, log=log)
+        reference_image_name = fits.getval(reference_path, 'GRIDIMG')
+
+    lcologs.log('Starting DIA photometry with reference ' + reference_path, 'info', log=log)
+    reference = lcodiaphot.DIAReference(
+        reference_path, target.ra.deg, target.dec.deg, dia_config.get('cutout_size', 250), kernel_size, log=log
+    )
+    star_index, positions = reference.get_star_positions(star_catalog.sources['ra'], star_catalog.sources['dec'])
+    lcologs.log(str(len(star_index)) + ' stars within the DIA cutout', 'info', log=log)
+
+    ref_idx = obs_set.table['file'].tolist().index(reference_image_name)
+    options = {
+        'kernel_size': kernel_size,
+        'solver': dia_config.get('solver', 'cholesky'),
+        'kernel_degree': dia_config.get('kernel_degree', 0),
+        'kernel_basis': dia_config.get('kernel_basis', 'delta'),
+        'photometry': dia_config.get('photometry', 'aperture'),
+        'radius': config['photometry']['aperture_arcsec'] / obs_set.table['pixscale'][ref_idx],
+        'detect_threshold': dia_config.get('detect_threshold', 0.0),
+        'psf_fwhm': obs_set.table['fwhm'][ref_idx] / obs_set.table['pixscale'][ref_idx]
+    }
+    index = star_catalog.get_index()
+    match_radius = dia_config.get('match_radius_arcsec', 1.0) / 3600.0
+
+    # Images are processed on a pool of workers, and their photometry stored as soon as it is returned.
+    # Failed images have no stored photometry and are processed again
+    # Images without aperture photometry failed their astrometry, and have no refined WCS to align them
+    image_paths = []
+    for i, im in enumerate(obs_set.table['file']):
+        if np.all(np.isnan(dataset.raw_flux[:, i])):
+            lcologs.log('No DIA photometry for ' + im + ', no refined WCS', 'warning', log=log)
+            continue
+        dia_file = os.path.join(args.directory, 'dia_flux', im + '.parquet')
+        if not os.path.isfile(dia_file) or args.update_phot:
+            image_paths.append(os.path.join(args.directory, im))
+    lcologs.log('DIA photometry required for ' + str(len(image_paths)) + ' images', 'info', log=log)
+
+    nprocess = dia_config.get('nprocess', 1)
+    if nprocess > 1:
+        with ProcessPoolExecutor(max_workers=nprocess) as executor:
+            for result in executor.map(lcodiaphot.run_dia_epoch, image_paths, repeat(reference),
+                                       repeat(positions), repeat(options)):
+                store_dia_results(args.directory, result, star_index, reference, index, match_radius, log=log)
+    else:
+        for image_path in image_paths:
+            result = lcodiaphot.run_dia_epoch(image_path, reference, positions, options)
+            store_dia_results(args.directory, result, star_index, reference, index, match_radius, log=log)
+
+    # DIA lightcurves in the flux units of the reference aperture photometry
+    dia_flux = parquet.load_dia_flux(args.directory)
+    flux, flux_err = lcodiaphot.compute_dia_flux(
+        dia_flux, obs_set, len(star_catalog.sources), dataset.raw_flux[:, ref_idx], reference.exptime
+    )
+
+    lc_root_file_name = config['target']['name'] + '_' + obs_set.table['filter'][0] + '_dia_lc'
+    params = {
+        'target_ra': config['target']['RA'],
+        'target_dec': config['target']['Dec'],
+        'filter': config['tom']['data_label'],
+        'lc_path': os.path.join(args.directory, lc_root_file_name)
+    }
+    lightcurve.dia_timeseries.fn(params, star_catalog, obs_set, flux, flux_err, log=log)
+
+    lcologs.log('Completed DIA photometry stage', 'info', log=log)
+
+def store_dia_results(red_dir_path, result, star_index, reference, index, match_radius, log=None):
+    """
+    Store the difference image photometry of one image, and its transient candidates if they were searched for
+    """
+
+    lcodiaphot.store_dia_photometry(red_dir_path, result, star_index, log=log)
+    if result['candidates'] is not None:
+        lcodiaphot.store_dia_candidates(red_dir_path, result, reference, index, match_radius, log=log)
+
 def get_args():
 
     parser = argparse.ArgumentParser()
@@ -10,6 +10,7 @@ from image_reduction.infrastructure import time_utils as lcotime
 from image_reduction.infrastructure import logs as lcologs
 from image_reduction.logistics import GaiaCatalog as GC
 from image_reduction.astrometry import crossmatching
+from image_reduction.astrometry import projection as lcoproj
 
 class ObservationSet(object):
     """
@@ -377,6 +378,8 @@ class StarCatalog(object):
         self.complete = False   # Indicates whether image-detected objects have been added
         self.ra_center = None
         self.dec_center = None
+        self.projection = None  # Cached CatalogProjection of the sources, see get_projection
+        self.index = None       # SpatialIndex of the sources, see get_index
 
         if file_path:
             if os.path.isfile(file_path):
@@ -396,8 +399,15 @@ class StarCatalog(object):
         self.ra_center = self.sources.meta['RACEN']
         self.dec_center = self.sources.meta['DECCEN']
         self.complete = True
+        self.projection = None
         lcologs.log('Loaded star catalog from ' + file_path,'info', log=log)
 
+        # Load the spatial index stored with the catalog, unless it is out of date
+        self.index = crossmatching.SpatialIndex(file_path=self.get_index_path(file_path), log=log)
+        if not self.index.matches_catalog(self.sources['ra'].data, self.sources['dec'].data,
+                                          x=self.sources['x'].data, y=self.sources['y'].data):
+            self.index = None
+
     def save(self, file_path, log=None):
 
         self.sources.meta['RACEN'] = self.ra_center
@@ -405,6 +415,42 @@ class StarCatalog(object):
         self.sources.write(file_path, format='fits', overwrite=True)
         lcologs.log('Saved star catalog to ' + file_path, 'info', log=log)
 
+        self.get_index().save(self.get_index_path(file_path), log=log)
+
+    def get_index_path(self, file_path):
+        """
+        Return the path of the spatial index stored alongside the catalog file
+        """
+
+        return os.path.splitext(file_path)[0] + '_index.pkl'
+
+    def get_index(self):
+        """
+        Return the spatial index of the sky and reference image positions of the sources, building it
+        on first use.  The index is reset whenever the sources table is replaced.
+        """
+
+        if self.index is None:
+            self.index = crossmatching.SpatialIndex(
+                ra=self.sources['ra'].data, dec=self.sources['dec'].data,
+                x=self.sources['x'].data, y=self.sources['y'].data
+            )
+
+        return self.index
+
+    def get_projection(self):
+        """
+        Return the cached unit vectors and field center separations of the sources, building them
+        on first use.  The cache is reset whenever the sources table is replaced.
+        """
+
+        if self.projection is None:
+            self.projection = lcoproj.CatalogProjection(
+                self.sources['ra'].data, self.sources['dec'].data, self.ra_center, self.dec_center
+            )
+
+        return self.projection
+
     def create_from_Gaia_catalog(self, args, target, log=None):
 
         lcologs.log(
@@ -450,6 +496,8 @@ class StarCatalog(object):
                 Column(name='phot_rp_mean_flux_error', data=gaia_catalog['phot_rp_mean_flux_error']),
             ]
         )
+        self.projection = None
+        self.index = None
 
     def combine_source_catalogs(self, image_new_wcs, image_source_catalog, dir_path, log):
         """
@@ -513,6 +561,9 @@ class StarCatalog(object):
                 ]
             )
 
+            self.projection = None
+            self.index = None
+
             # Now the complete flag has to be set, so that we don't extent the
             # catalog after every image, since this makes indexing the stars much harder
             self.complete = True
@@ -6,6 +6,7 @@ import numpy as np
 from os import path
 
 from image_reduction.logistics import vizier_tools
+from image_reduction.astrometry import crossmatching
 from image_reduction.infrastructure import logs as lcologs
 
 @task
@@ -57,7 +58,7 @@ def collect_Gaia_catalog(ra, dec, radius=25, row_limit = 30000, catalog_name='Ga
     return  gaia_catalog
 
 @task
-def find_nearest(catalog, ra, dec, radius=(2.0/3600.0)*u.deg, log=None):
+def find_nearest(catalog, ra, dec, radius=(2.0/3600.0)*u.deg, index=None, log=None):
     """
     Function to identify the nearest catalog entry to the given coordinates, within a cut-off radius
 
@@ -67,6 +68,7 @@ def find_nearest(catalog, ra, dec, radius=(2.0/3600.0)*u.deg, log=None):
     ra float    RA of location to search at [decimal deg]
     dec float   Dec of location to search at [decimal deg]
     radius float Search cut-off radius [decimal deg, default = 2 arcsec]
+    index SpatialIndex [optional] Spatial index of the catalog, built if not given
 
     Returns
     -------
@@ -75,14 +77,13 @@ def find_nearest(catalog, ra, dec, radius=(2.0/3600.0)*u.deg, log=None):
                     within the search radius
     """
 
-    sources = SkyCoord(catalog['ra'], catalog['dec'], frame='icrs', unit=(u.deg, u.deg))
-    target = SkyCoord(ra, dec, frame='icrs', unit=(u.deg, u.deg))
+    if index is None:
+        index = crossmatching.SpatialIndex(ra=catalog['ra'], dec=catalog['dec'])
 
-    separations = target.separation(sources)
+    radius = u.Quantity(radius, u.deg).value
+    idx, separations = index.query_nearest_sky(ra, dec, radius=radius)
 
-    idx = np.where(separations <= radius)[0]
-
-    if len(idx) > 0:
+    if idx[0] >= 0:
         lcologs.log(
             'Found nearest matching star ' + str(idx[0]) + ' ' + repr(catalog[idx[0]]),
             'info',
@@ -20,6 +20,7 @@ from image_reduction.astrometry import wcs as lcowcs
 from image_reduction.infrastructure import logs as lcologs
 from image_reduction.IO import ds9_utils
 from image_reduction.IO import parquet
+from image_reduction.data_quality import astrometry_qc
 
 class AperturePhotometryAnalyst(object):
     """
@@ -31,10 +32,17 @@ class AperturePhotometryAnalyst(object):
     image_name : str, a name to the data
     image_path : str, a path+name to the data
     sources : astropy.Table, the star catalog of the field
+    reference_astrometry : ReferenceAstrometry, [optional] astrometry of the reference image, used to fit the
+                            WCS relative to the reference rather than to the Gaia catalog
+    distortion_cache : DistortionModelCache, [optional] cache of the camera distortion models, so that only
+                        the linear terms of the WCS are fitted once the distortion of the camera is known
+    model_cache : ModelImageCache, [optional] cache of the Fourier transforms of the catalog model images of
+                  the field, shared by the frames of a reduction
 
     """
 
-    def __init__(self, image_name, image_path, star_catalog, obs_set, config, log=None):
+    def __init__(self, image_name, image_path, star_catalog, obs_set, config, reference_astrometry=None,
+                 distortion_cache=None, model_cache=None, log=None):
 
         lcologs.log(
             'Initializing Aperture Photometry Analyst on '+image_name+' at this location '+image_path,
@@ -64,19 +72,38 @@ class AperturePhotometryAnalyst(object):
             sys.exit()
 
         self.sources = copy.deepcopy(star_catalog.sources)
+        self.catalog_projection = star_catalog.get_projection()
         self.catalog_complete = copy.deepcopy(star_catalog.complete)
         self.image_source_catalog = None
         self.ra_center = star_catalog.ra_center
         self.dec_center = star_catalog.dec_center
         self.image_new_wcs = None
+        self.reference_astrometry = reference_astrometry
+        self.distortion_cache = distortion_cache
+        self.model_cache = model_cache
+        self.wcs_fit_stats = None
+        self.qc_summary = {
+            'file': image_name,
+            'status': 'OK',
+            'valid_pixel_fraction': np.nan,
+            'header_in_frame_fraction': np.nan,
+            'in_frame_fraction': np.nan,
+            'match_fraction': np.nan,
+            'nmatches': np.nan,
+            'ninliers': np.nan,
+            'inlier_fraction': np.nan,
+            'residual_rms': np.nan
+        }
         self.get_science_image()
         self.get_image_errors()
         self.image_original_wcs = WCS(self.image_header)
         self.phot_aperture = config['photometry']['aperture_arcsec'] / self.image_header['PIXSCALE']
+        self.astrometry_config = config['astrometry'] if 'astrometry' in config.keys() else {}
 
         idx = obs_set.table['file'].tolist().index(image_name)
         if idx >= 0:
             self.pixscale = obs_set.table['pixscale'][idx]
+            self.facility_code = obs_set.table['facility_code'][idx]
 
     def get_science_image(self):
         """Method to identify and extract the science image, otherwise raise an error"""
@@ -111,37 +138,71 @@ class AperturePhotometryAnalyst(object):
 
         lcologs.log('Original image WCS: ' + repr(self.image_original_wcs), 'info', log=log)
 
-        # Detect objects within the working frame
-        self.starfind(log)
+        # Reject clearly hopeless frames before spending time on object detection and WCS refinement
+        self.check_frame_quality(log)
 
-        # Refine the image WCS
-        lcologs.log(repr(time.time()-start), 'info', log=log)
-        self.refine_wcs(log)
-        lcologs.log(repr(time.time()-start), 'info', log=log)
+        if self.status == 'OK':
+            # Detect objects within the working frame
+            self.starfind(log)
+
+            # Refine the image WCS
+            lcologs.log(repr(time.time()-start), 'info', log=log)
+            self.refine_wcs(log)
+            lcologs.log(repr(time.time()-start), 'info', log=log)
 
         if self.status == 'OK':
             self.sources = copy.deepcopy(star_catalog.sources)
+            self.catalog_projection = star_catalog.get_projection()
 
             # Update star positions using the refined WCS
             # If a valid WCS is available, calculate the expected pixel positions of all the
             # stars in the sources table
             self.update_star_positions(log=log)
 
+            self.qc_summary.update(astrometry_qc.assess_wcs_fit(
+                self.image_data.shape, self.get_qc_star_positions(self.image_new_wcs),
+                self.image_source_catalog[np.argsort(self.image_source_catalog[:,2])[::-1]],
+                self.wcs_fit_stats, log=log
+            ))
+
+        self.qc_summary['status'] = self.status
+
         return star_catalog
 
+    def get_qc_star_positions(self, image_wcs, radius=10):
+        """
+        Return the pixel positions of the Gaia stars within radius (arcmin) of the field center, for
+        quality control of the WCS
+        """
+
+        idx = np.where((self.sources['gaia_id'] > 0) & (self.catalog_projection.separations <= radius / 60.0))[0]
+
+        return np.array(self.catalog_projection.world_to_pixel(image_wcs, idx)).T
+
+    def check_frame_quality(self, log):
+        """
+        Reject frames with largely invalid data, or whose header WCS places few catalog stars within the frame
+        """
+
+        status, qc = astrometry_qc.check_frame_before_detection(
+            self.image_data, self.get_qc_star_positions(self.image_original_wcs),
+            min_valid_fraction=self.astrometry_config.get('qc_min_valid_fraction', 0.5),
+            min_in_frame_fraction=self.astrometry_config.get('qc_min_in_frame_fraction', 0.1),
+            log=log
+        )
+        self.qc_summary.update(qc)
+
+        if not status:
+            self.status = 'ERROR'
+
     def update_star_positions(self, log=None):
         """
         Update the pixel positions of stars in this frame, based on the refined WCS fit
         """
 
-        catalog_coords = SkyCoord(ra=self.sources['ra'].data,
-                                  dec=self.sources['dec'].data,
-                                  unit=(u.degree, u.degree), frame='icrs')
-
-        star_pix = self.image_new_wcs.world_to_pixel(catalog_coords)
-        stars_positions = np.array(star_pix).T
-        self.sources['x'] = stars_positions[:, 0]
-        self.sources['y'] = stars_positions[:, 1]
+        star_pix = self.catalog_projection.world_to_pixel(self.image_new_wcs)
+        self.sources['x'] = star_pix[0]
+        self.sources['y'] = star_pix[1]
 
         lcologs.log(
             'Updated pixel positions of stars in the working frame', 'info', log=log
@@ -150,10 +211,40 @@ class AperturePhotometryAnalyst(object):
     def refine_wcs(self, log):
         """
         Starting from approximate WCS solution, this function refine the WCS solution with the Gaia catalog.
+        If the astrometry of the reference image is available, the WCS is instead fitted relative to the
+        reference, falling back to the Gaia catalog if this fails.
         """
 
         try:
-            wcs2 = lcowcs.refine_image_wcs(self, star_limit=50000, log=log, debug=True)
+            wcs2 = None
+            if self.reference_astrometry:
+                wcs2 = lcowcs.refine_image_wcs_from_reference(
+                    self, self.reference_astrometry,
+                    matcher=self.astrometry_config.get('matcher', 'ransac'),
+                    seed=self.astrometry_config.get('seed', None), log=log
+                )
+
+            if not wcs2:
+                # Hold the camera distortion fixed if it is known, otherwise fit it so that the frame
+                # can contribute to the distortion model
+                distortion = None
+                sip_degree = 1
+                if self.distortion_cache:
+                    distortion = self.distortion_cache.get_model(self.facility_code, log=log)
+                    if distortion is None:
+                        sip_degree = self.astrometry_config.get('sip_degree', 3)
+
+                wcs2 = lcowcs.refine_image_wcs(
+                    self, star_limit=50000, solver=self.astrometry_config.get('solver', 'astropy'),
+                    matcher=self.astrometry_config.get('matcher', 'ransac'),
+                    seed=self.astrometry_config.get('seed', None), sip_degree=sip_degree,
+                    distortion=distortion, model_cache=self.model_cache, log=log, debug=True
+                )
+
+                if wcs2 and self.distortion_cache and distortion is None:
+                    self.distortion_cache.add_candidate(
+                        self.facility_code, self.image_name, wcs2, self.wcs_fit_stats, log=log
+                    )
 
             self.image_new_wcs = wcs2
 
@@ -303,6 +394,17 @@ class AperturePhotometryAnalyst(object):
 
         lcologs.log('Stored photometry for ' + self.image_path, 'info', log=log)
 
+    def store_astrometry_qc(self, red_dir_path, log):
+        """
+        Save the astrometric QC summary of the image in parquet format
+        """
+
+        dir_path = os.path.join(red_dir_path, "astrometry_qc")
+        qc_arrow = pa.Table.from_pylist([self.qc_summary])
+        pq.write_table(qc_arrow, os.path.join(dir_path, self.image_name + '.parquet'))
+
+        lcologs.log('Stored astrometric QC for ' + self.image_path, 'info', log=log)
+
 
 def run_aperture_photometry(image, error, positions, radius):
     """
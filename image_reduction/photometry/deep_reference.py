@@ -0,0 +1,334 @@
+import os
+import shutil
+import numpy as np
+from astropy.io import fits
+from astropy.stats import sigma_clipped_stats
+from photutils.detection import DAOStarFinder
+from skimage import transform as tf
+
+from image_reduction.infrastructure import logs as lcologs
+from image_reduction.photometry import dia_photometry as lcodia
+
+
+def select_reference_frames(red_dir_path, obs_set, nframes=10, max_airmass=2.0, log=None):
+    """
+    Function to select the best frames of a dataset to build a deep reference image, ranked by the
+    product fwhm * sqrt(sky_bkgd), to which the noise of the photometry of faint point sources is
+    proportional.  Frames above max_airmass are rejected, as are frames without the refined WCS stored by
+    the aperture photometry stage, which could not be registered accurately.
+
+    Parameters
+    ----------
+    red_dir_path : str, the path to the reduction directory
+    obs_set : ObservationSet, the images of the dataset
+    nframes : int, the maximum number of frames to select
+    max_airmass : float, the maximum airmass of a selected frame
+    log : object pipeline log
+
+    Returns
+    -------
+    frames : list, the names of the selected frames, best first
+    """
+
+    table = obs_set.table
+    fwhm = np.array(table['fwhm'], dtype=float)
+    sky = np.array(table['sky_bkgd'], dtype=float)
+    airmass = np.array(table['airmass'], dtype=float)
+
+    valid = np.isfinite(fwhm) & (fwhm > 0) & np.isfinite(sky) & (airmass <= max_airmass)
+    score = fwhm * np.sqrt(np.clip(sky, 1.0, None))
+
+    frames = []
+    for i in np.argsort(score, kind='stable'):
+        if len(frames) == nframes:
+            break
+        if not valid[i]:
+            continue
+        frame = str(table['file'][i])
+        if not has_refined_wcs(os.path.join(red_dir_path, frame)):
+            lcologs.log('Skipped ' + frame + ' for the deep reference, no refined WCS', 'warning', log=log)
+            continue
+        frames.append(frame)
+
+    lcologs.log('Selected ' + str(len(frames)) + ' frames for the deep reference: ' + repr(frames),
+                'info', log=log)
+
+    return frames
+
+def has_refined_wcs(image_path):
+    """
+    Function to check whether an image holds the refined WCS stored by the aperture photometry stage
+
+    Parameters
+    ----------
+    image_path : str, the path to the image
+
+    Returns
+    -------
+    refined : bool
+    """
+
+    if not os.path.isfile(image_path):
+        return False
+
+    with fits.open(image_path) as hdulist:
+        _, refined = lcodia.get_refined_wcs(hdulist)
+
+    return refined
+
+def get_tile_rows(nframes, ncols, memory_limit):
+    """
+    Function to return the number of rows of the tiles combined at once, so that the stacked tiles of the
+    frames and their variance fit within memory_limit bytes whatever the number of frames
+
+    Parameters
+    ----------
+    nframes : int, the number of frames
+    ncols : int, the number of columns of the images
+    memory_limit : int, the maximum memory in bytes used by the stacked tiles
+
+    Returns
+    -------
+    tile_rows : int
+    """
+
+    # Data and variance, float32 on disk, float64 while combined
+    bytes_per_row = nframes * ncols * 2 * (4 + 8)
+
+    return max(1, int(memory_limit // bytes_per_row))
+
+def combine_tile(data, variance, method='median', sigma_clip=3.0):
+    """
+    Function to combine a stack of registered tiles, where invalid pixels are NaN
+
+    Parameters
+    ----------
+    data : array, the tiles of the frames, of shape (nframes, nrows, ncols)
+    variance : array, the variance of the tiles
+    method : str, 'median' or 'mean', the latter sigma-clipped around the median
+    sigma_clip : float, the clipping threshold of the mean in units of the robust standard deviation
+
+    Returns
+    -------
+    combined : array, the combined tile
+    error : array, the uncertainty of the combined tile
+    nused : array, the number of frames combined in each pixel
+    """
+
+    valid = np.isfinite(data) & np.isfinite(variance)
+    data = np.where(valid, data, np.nan)
+
+    median = np.nanmedian(data, axis=0)
+    if method == 'mean':
+        mad = 1.4826 * np.nanmedian(np.abs(data - median), axis=0)
+        valid &= ~(np.abs(data - median) > sigma_clip * mad)
+
+    nused = valid.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_error = np.sqrt(np.where(valid, variance, 0.0).sum(axis=0)) / nused
+
+        if method == 'mean':
+            combined = np.where(valid, data, 0.0).sum(axis=0) / nused
+            error = mean_error
+        else:
+            # Standard error of the median of normally distributed data
+            combined = median
+            error = np.sqrt(np.pi / 2.0) * mean_error
+
+    return combined, error, nused
+
+def select_scale_stars(image, radius, nstars=100):
+    """
+    Function to select the bright stars of the grid frame whose fluxes set the photometric scale of the
+    frames of a deep reference
+
+    Parameters
+    ----------
+    image : array, the sky-subtracted image of the grid frame, where invalid pixels are NaN
+    radius : float, the radius of the aperture in pixels
+    nstars : int, the maximum number of stars, the brightest ones being selected
+
+    Returns
+    -------
+    positions : array, the [X,Y] positions of the stars
+    """
+
+    _, median, std = sigma_clipped_stats(image, sigma=3.0, maxiters=5)
+    sources = DAOStarFinder(fwhm=3.0, threshold=10.0 * std)(np.nan_to_num(image - median))
+    if sources is None:
+        return np.zeros((0, 2))
+
+    positions = np.c_[sources['xcentroid'], sources['ycentroid']]
+    ny, nx = image.shape
+    inside = ((positions[:, 0] > radius) & (positions[:, 0] < nx - 1 - radius)
+              & (positions[:, 1] > radius) & (positions[:, 1] < ny - 1 - radius))
+    positions = positions[inside]
+    order = np.argsort(-np.asarray(sources['flux'])[inside], kind='stable')
+
+    return positions[order[:nstars]]
+
+def measure_frame_scale(grid_image, frame_image, positions, radius, min_stars=3):
+    """
+    Function to measure the photometric scale factor of a registered frame relative to the grid frame, as the
+    median ratio of the aperture fluxes of bright stars measured on both sky-subtracted images
+
+    Parameters
+    ----------
+    grid_image : array, the sky-subtracted image of the grid frame, where invalid pixels are NaN
+    frame_image : array, the sky-subtracted frame registered to the grid, where invalid pixels are NaN
+    positions : array, the [X,Y] positions of the stars, from select_scale_stars
+    radius : float, the radius of the aperture in pixels
+    min_stars : int, the minimum number of stars measured on both images
+
+    Returns
+    -------
+    scale : float, the factor to multiply the frame by, NaN if fewer than min_stars stars were measured
+    nstars : int, the number of stars measured
+    """
+
+    if len(positions) == 0:
+        return np.nan, 0
+
+    error = np.ones(grid_image.shape)
+    grid_flux = np.asarray(lcodia.run_dia_photometry(grid_image, error, positions, radius)['aperture_sum'])
+    frame_flux = np.asarray(lcodia.run_dia_photometry(frame_image, error, positions, radius)['aperture_sum'])
+
+    valid = np.isfinite(grid_flux) & np.isfinite(frame_flux) & (grid_flux > 0) & (frame_flux > 0)
+    if valid.sum() < min_stars:
+        return np.nan, int(valid.sum())
+
+    return float(np.median(grid_flux[valid] / frame_flux[valid])), int(valid.sum())
+
+def build_deep_reference(red_dir_path, frames, obs_set, output_path, method='median', sigma_clip=3.0,
+                         min_frames=2, memory_limit=256*1024**2, scale_radius=6.0, log=None):
+    """
+    Function to build a deep reference image by stacking frames of a dataset, on the pixel grid of the first
+    frame.  Each frame is registered to the grid with the refined WCS of the frames, sky-subtracted and scaled
+    to the photometry of the first frame, and written to a memory-mapped cube on disk, so that only one
+    frame is held in memory at a time.  The cube is then combined tile by tile, with tiles sized to
+    memory_limit, so that the memory used does not depend on the number of frames.
+
+    The photometric scale factor of each frame is the median ratio of the aperture fluxes of the bright stars
+    of the first frame, measured on the registered frame, which corrects for the exposure time and the
+    transparency.  The ratio of exposure times is used instead for a frame with too few stars measured.
+
+    The frames are registered with an affine transform fitted to the mapping between the WCS of the frame
+    and of the grid, see wcs_affine_transform.  The non-linear (e.g. SIP) distortions of the WCS are only
+    matched to first order, so frames of wide fields with different pointings are blurred towards the edges.
+
+    Parameters
+    ----------
+    red_dir_path : str, the path to the reduction directory
+    frames : list, the names of the frames to stack, the first one defining the pixel grid, which must all hold
+             a refined WCS
+    obs_set : ObservationSet, the images of the dataset
+    output_path : str, the path of the deep reference FITS file
+    method : str, 'median' or 'mean', the latter sigma-clipped
+    sigma_clip : float, the clipping threshold of the mean
+    min_frames : int, the minimum number of valid frames of an unmasked pixel
+    memory_limit : int, the maximum memory in bytes used by the stacked tiles
+    scale_radius : float, the radius in pixels of the apertures measuring the photometric scale factors
+    log : object pipeline log
+
+    Returns
+    -------
+    output_path : str, the path of the deep reference FITS file, with the combined image, its uncertainties
+                  in the ERR extension and its bad pixel mask in the BPM extension
+    """
+
+    if len(frames) == 0:
+        raise ValueError('No frames to build the deep reference')
+
+    files = list(obs_set.table['file'])
+    for frame in frames:
+        if not has_refined_wcs(os.path.join(red_dir_path, frame)):
+            raise ValueError('No refined WCS to register ' + frame + ' to the deep reference')
+
+    grid = lcodia.load_dia_image(os.path.join(red_dir_path, frames[0]))
+    grid_shape = grid['data'].shape
+    grid_sky = float(obs_set.table['sky_bkgd'][files.index(frames[0])])
+    grid_image = np.where(grid['mask'], np.nan, grid['data'] - grid_sky)
+    scale_stars = select_scale_stars(grid_image, scale_radius)
+
+    tmp_dir = os.path.join(red_dir_path, 'deep_reference_tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    data_cube = np.lib.format.open_memmap(os.path.join(tmp_dir, 'data.npy'), mode='w+', dtype=np.float32,
+                                          shape=(len(frames),) + grid_shape)
+    variance_cube = np.lib.format.open_memmap(os.path.join(tmp_dir, 'variance.npy'), mode='w+',
+                                              dtype=np.float32, shape=(len(frames),) + grid_shape)
+
+    # Register the frames one at a time
+    for i, frame in enumerate(frames):
+        image = grid if i == 0 else lcodia.load_dia_image(os.path.join(red_dir_path, frame))
+        sky = float(obs_set.table['sky_bkgd'][files.index(frame)])
+
+        transform = lcodia.wcs_affine_transform(grid['wcs'], grid_shape, image['wcs'])
+        data = image['data'].copy()
+        data[image['mask']] = np.nan
+        registered, variance = lcodia.warp_layers([data, image['errors']**2], transform.params, grid_shape,
+                                                  order=3)
+
+        # Pixels outside the frame or interpolated from bad pixels are invalid
+        coverage = tf.warp(np.isfinite(data).astype(float), transform.params, output_shape=grid_shape,
+                           order=1, cval=0.0)
+        invalid = (coverage < 0.999) | ~np.isfinite(registered)
+        registered = np.where(invalid, np.nan, registered - sky)
+
+        if i == 0:
+            scale, nstars = 1.0, len(scale_stars)
+        else:
+            scale, nstars = measure_frame_scale(grid_image, registered, scale_stars, scale_radius)
+        if not np.isfinite(scale):
+            lcologs.log('Only ' + str(nstars) + ' stars to scale ' + frame + ', scaled by the exposure time',
+                        'warning', log=log)
+            scale = grid['exptime'] / image['exptime']
+
+        data_cube[i] = registered * scale + grid_sky
+        variance_cube[i] = np.where(invalid, np.nan, variance * scale**2)
+
+        lcologs.log('Registered ' + frame + ' to the deep reference grid, photometric scale factor '
+                    + str(scale) + ' from ' + str(nstars) + ' stars', 'info', log=log)
+        del image, data, registered, variance
+
+    data_cube.flush()
+    variance_cube.flush()
+
+    # Combine tile by tile
+    deep_image = np.zeros(grid_shape, dtype=np.float32)
+    deep_error = np.zeros(grid_shape, dtype=np.float32)
+    deep_mask = np.zeros(grid_shape, dtype=np.uint8)
+
+    tile_rows = get_tile_rows(len(frames), grid_shape[1], memory_limit)
+    for row in range(0, grid_shape[0], tile_rows):
+        rows = slice(row, min(row + tile_rows, grid_shape[0]))
+        combined, error, nused = combine_tile(np.asarray(data_cube[:, rows], dtype=float),
+                                              np.asarray(variance_cube[:, rows], dtype=float),
+                                              method=method, sigma_clip=sigma_clip)
+
+        masked = nused < min_frames
+        deep_image[rows] = np.where(masked, 0.0, combined)
+        deep_error[rows] = np.where(masked, 0.0, error)
+        deep_mask[rows] = masked
+
+    del data_cube, variance_cube
+    shutil.rmtree(tmp_dir)
+
+    header = grid['wcs'].to_header(relax=True)
+    header['EXPTIME'] = grid['exptime']
+    header['NCOMBINE'] = (len(frames), 'Number of frames stacked')
+    header['COMBINE'] = (method, 'Method used to stack the frames')
+    header['GRIDIMG'] = (frames[0], 'Frame defining the pixel grid')
+    hdulist = fits.HDUList([
+        fits.PrimaryHDU(data=deep_image, header=header),
+        fits.ImageHDU(data=deep_error, name='ERR'),
+        fits.ImageHDU(data=deep_mask, name='BPM')
+    ])
+    hdulist.writeto(output_path, overwrite=True)
+
+    lcologs.log(
+        'Built deep reference from ' + str(len(frames)) + ' frames in tiles of ' + str(tile_rows) + ' rows, output to '
+        + output_path,
+        'info', log=log
+    )
+
+    return output_path
@@ -1,13 +1,25 @@
+import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from astropy.io import fits
 from astropy.wcs import WCS
 from astropy.coordinates import SkyCoord
+from astropy.table import Table
 from photutils.aperture import aperture_photometry
 from photutils.aperture import CircularAnnulus, CircularAperture
 from photutils.aperture import ApertureStats
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from numpy.lib.stride_tricks import sliding_window_view
 from skimage.measure import ransac
 from skimage import transform as tf
 from scipy import ndimage
+from scipy import linalg
+from scipy import signal
+from scipy import fft
+from scipy import sparse
+from scipy.sparse import csgraph
 
 from image_reduction.infrastructure import logs as lcologs
 from image_reduction.photometry import aperture_photometry as lcoaphot
@@ -25,23 +37,31 @@ class DIAPhotometryAnalyst(object):
     image_path : str, a path+name to the data
     reference_catalog : astropy.Table, the star catalog of the reference
     image_catalog : astropy.Table, the star catalog of the image
-    cutout_region : list, [RA,DEC,pixel_size] the size in pixels of the cutout image around RA,DEC
+    cutout_region : list, [RA,DEC,pixel_size] the size in pixels of the cutout image around RA,DEC, or a list of
+                    such regions to process several stamps of the image in one pass
     kernel_size: int, the size of the numerical kernel use
-
+    solver : str, the kernel solver of run_difference_image, 'lstsq' or 'cholesky'
+    kernel_cache : dict, ReferenceKernelSolvers shared between the analysts of a dataset, keyed by reference
+                   and cutout.  If None, the kernel is solved from scratch with run_difference_image
+    kernel_degree : int, the degree of the polynomial spatial variation of the kernel, 0 for a constant kernel
+    kernel_basis : str, the kernel basis of run_difference_image, 'delta' or 'alard_lupton'
+    reference_cache : dict, reference stamps shared between the analysts of a dataset, keyed by reference
+                      and cutout.  The reference is only opened if one of the stamps is not in the cache
+    stamps : list, the results of each cutout region, as dicts of the attributes set by run_dia_photometry
 
     """
 
     def __init__(self, reference_name, reference_path,image_name, image_path, reference_catalog, image_catalog,
-                 cutout_region, kernel_size,log_path='./logs'):
+                 cutout_region, kernel_size,log_path='./logs', solver='lstsq',
+                 kernel_cache=None, kernel_degree=0, kernel_basis='delta', reference_cache=None):
 
         self.log = lcologs.start_log(log_path, image_name)
         self.log.info('Initialize DIA Photometry Analyst')
 
+        # The reference is opened on demand, when a stamp is not in the reference_cache
         self.reference_path = reference_path+reference_name
-        self.reference_layers = fits.open(self.reference_path)
-        self.reference_image = self.reference_layers[0].data
-        self.reference_wcs = WCS(self.reference_layers[-2].header)
-        self.log.info('Reference found and open successfully!')
+        self.reference_layers = None
+        self.reference_cache = reference_cache
 
         self.image_path = image_path+image_name
         self.image_layers = fits.open(self.image_path)
@@ -56,10 +76,6 @@ class DIAPhotometryAnalyst(object):
         except:
             self.fwhm = 5
 
-        try:
-            self.reference_mask = self.reference_layers[2].data
-        except:
-            self.reference_mask = np.zeros(self.reference_image.shape)
         try:
             self.image_mask = self.image_layers[2].data
         except:
@@ -67,16 +83,24 @@ class DIAPhotometryAnalyst(object):
 
 
         self.image_wcs = WCS(self.image_layers[-2].header)
-        self.log.info('Reference found and open successfully!')
+        self.log.info('Image found and open successfully!')
 
         self.ref_catalog = reference_catalog
         self.image_catalog = image_catalog
 
-        ra, dec, size = cutout_region
+        if np.isscalar(cutout_region[0]):
+            self.cutout_regions = [list(cutout_region)]
+        else:
+            self.cutout_regions = [list(region) for region in cutout_region]
+        ra, dec, size = self.cutout_regions[0]
         self.ra = ra
         self.dec = dec
         self.size = size
         self.kernel_size = kernel_size
+        self.solver = solver
+        self.kernel_cache = kernel_cache
+        self.kernel_degree = kernel_degree
+        self.kernel_basis = kernel_basis
 
         self.process_image()
 
@@ -85,37 +109,92 @@ class DIAPhotometryAnalyst(object):
 
     def process_image(self):
         """
-        Process the image following the various steps
+        Process the image following the various steps, for each cutout region in turn.  The attributes of the
+        results are those of the last region, and the results of all regions are stored in stamps
+        """
+        self.log.info('Start Image Processing of ' + str(len(self.cutout_regions)) + ' stamps')
+
+        self.stamps = []
+        for region in self.cutout_regions:
+            self.ra, self.dec, self.size = region
+            self.dia_photometry = None
+            self.kernel = None
+            self.kernel_errors = None
+
+            self.cut_image_and_ref()
+            self.align_image_to_ref()
+            self.run_dia_photometry()
+
+            self.stamps.append({
+                'cutout_region': region,
+                'dia_photometry': self.dia_photometry,
+                'kernel': self.kernel,
+                'kernel_errors': self.kernel_errors,
+            })
+
+    def open_reference(self):
+        """
+        Open the reference image and read the layers needed to cut the reference stamps
         """
-        self.log.info('Start Image Processing')
 
-        self.cut_image_and_ref()
-        self.align_image_to_ref()
-        self.run_dia_photometry()
+        self.reference_layers = fits.open(self.reference_path)
+        self.reference_image = self.reference_layers[0].data
+        self.reference_wcs = WCS(self.reference_layers[-2].header)
+        try:
+            self.reference_mask = self.reference_layers[2].data
+        except:
+            self.reference_mask = np.zeros(self.reference_image.shape)
+        self.log.info('Reference found and open successfully!')
 
-    def cut_image_and_ref(self,):
+    def get_reference_stamp(self):
         """
-        Cut the image and ref around the ra,dec center
+        Return the reference cutout around the ra,dec center, from the reference_cache if available
         """
+
+        key = (self.reference_path, self.ra, self.dec, self.size, self.kernel_size)
+        if self.reference_cache is not None and key in self.reference_cache.keys():
+            return self.reference_cache[key]
+
+        if self.reference_layers is None:
+            self.open_reference()
+
         ra, dec, size, kernel_size = self.ra,self.dec,self.size,self.kernel_size
         kernel_size = int(kernel_size / 2)
 
         coo2 = SkyCoord(ra=ra,dec=dec,unit='deg')
         xx,yy = self.reference_wcs.world_to_pixel(coo2)
 
-        self.origin_ref_x = xx - size / 2
-        self.origin_ref_y = yy - size / 2
+        rows = slice(int(int(yy) - size / 2 - kernel_size), int(int(yy) + size / 2 + 1 + kernel_size))
+        cols = slice(int(int(xx) - size / 2 - kernel_size), int(int(xx) + size / 2 + 1 + kernel_size))
 
-        self.cutout_reference = self.reference_image[int(int(yy) - size / 2 - kernel_size):int(int(yy) + size / 2 + 1 + kernel_size),
-                     int(int(xx) - size / 2 - kernel_size):int(int(xx) + size / 2 + 1 + kernel_size)]
+        stamp = {
+            'origin_ref_x': xx - size / 2,
+            'origin_ref_y': yy - size / 2,
+            'cutout_reference': np.asarray(self.reference_image[rows, cols]),
+            'cutout_reference_mask': np.asarray(self.reference_mask[rows, cols]),
+            'ref_catalog_mask': (np.abs(self.ref_catalog['xcenter'] - xx) < size / 2 )
+                                & (np.abs(self.ref_catalog['ycenter'] - yy) < size / 2 )
+        }
+        if self.reference_cache is not None:
+            self.reference_cache[key] = stamp
 
-        self.cutout_reference_mask = self.reference_mask[
-                                int(int(yy) - size / 2 - kernel_size):int(int(yy) + size / 2 + 1 + kernel_size),
-                                int(int(xx) - size / 2 - kernel_size):int(int(xx) + size / 2 + 1 + kernel_size)]
+        return stamp
 
-        mask = (np.abs(self.ref_catalog['xcenter'] - xx) < size / 2 ) & (np.abs(self.ref_catalog['ycenter'] - yy) < size / 2 )
-        self.ref_catalog_mask = mask
+    def cut_image_and_ref(self,):
+        """
+        Cut the image and ref around the ra,dec center
+        """
+        ra, dec, size, kernel_size = self.ra,self.dec,self.size,self.kernel_size
+        kernel_size = int(kernel_size / 2)
 
+        stamp = self.get_reference_stamp()
+        self.origin_ref_x = stamp['origin_ref_x']
+        self.origin_ref_y = stamp['origin_ref_y']
+        self.cutout_reference = stamp['cutout_reference']
+        self.cutout_reference_mask = stamp['cutout_reference_mask']
+        self.ref_catalog_mask = stamp['ref_catalog_mask']
+
+        coo2 = SkyCoord(ra=ra,dec=dec,unit='deg')
         xx, yy = self.image_wcs.world_to_pixel(coo2)
 
         self.origin_image_x = xx - size / 2
@@ -134,28 +213,15 @@ class DIAPhotometryAnalyst(object):
                         int(int(yy) - size / 2 - kernel_size):int(int(yy) + size / 2 + 1 + kernel_size),
                         int(int(xx) - size / 2 - kernel_size):int(int(xx) + size / 2 + 1 + kernel_size)]
 
-        indi,indj = build_the_U_indexes(self.cutout_image, np.eye(self.kernel_size))
-
-        self.indi = indi
-        self.indj = indj
-
     def align_image_to_ref(self):
         """Perform image alignement to the reference"""
-        matching = []
-
-        for inde, i in enumerate(self.ref_catalog['id'][self.ref_catalog_mask]):
 
-            if i in self.image_catalog['id']:
-
-                index = np.where(self.image_catalog['id'] == i)[0][0]
-
-                matching.append([inde, index])
-
-            else:
-
-                pass
-
-        matching = np.array(matching)
+        # Stars in both catalogs, in the order of the reference catalog
+        ref_ids = np.asarray(self.ref_catalog['id'][self.ref_catalog_mask])
+        common, ref_index, image_index = np.intersect1d(ref_ids, np.asarray(self.image_catalog['id']),
+                                                        return_indices=True)
+        order = np.argsort(ref_index)
+        matching = np.c_[ref_index[order], image_index[order]]
 
         pts1 = np.c_[[self.ref_catalog['xcenter'][self.ref_catalog_mask] - self.origin_ref_x,
                       self.ref_catalog['ycenter'][self.ref_catalog_mask] - self.origin_ref_y]].T[matching[:, 0]]
@@ -166,14 +232,13 @@ class DIAPhotometryAnalyst(object):
         model_robust, inliers = ransac((pts2[:1000], pts1[:1000]), tf.AffineTransform,
                                        min_samples=int(0.5 * len(pts1[:1000])), residual_threshold=0.01, max_trials=300)
 
-        aligned_image = tf.warp(self.cutout_image.astype(float),
-                                model_robust.inverse,
-                                output_shape=self.cutout_image.shape, order=3)
-        aligned_mask = tf.warp(self.cutout_mask.astype(float), model_robust.inverse,
+        # The image and variance share the cubic interpolation, so they are warped together
+        inverse = model_robust.inverse
+        aligned_image, aligned_errors = warp_layers([self.cutout_image.astype(float),
+                                                     self.cutout_errors.astype(float)**2],
+                                                    inverse, self.cutout_image.shape, order=3)
+        aligned_mask = tf.warp(self.cutout_mask.astype(float), inverse,
                                output_shape=self.cutout_image.shape, order=1)
-        aligned_errors = tf.warp(self.cutout_errors.astype(float)**2,
-                                 model_robust.inverse,
-                                 output_shape=self.cutout_image.shape, order=3)
 
         self.cutout_aligned_image = aligned_image
         self.cutout_aligned_mask = aligned_mask
@@ -190,10 +255,15 @@ class DIAPhotometryAnalyst(object):
             kernel_size = int(self.kernel_size / 2)
             mask = self.cutout_aligned_mask.astype(bool) | self.cutout_reference_mask.astype(bool)
 
-            dia_image,image_model,dia_mask, kernel,bkg_coeffs,kernel_errors = (
-                run_difference_image(self.cutout_reference, self.cutout_aligned_image,
-                                     self.kernel_size,mask = mask,
-                                     indi=self.indi, indj=self.indj))
+            if self.kernel_cache is not None and self.kernel_degree == 0 and self.kernel_basis == 'delta':
+                kernel_solver = self.get_kernel_solver()
+                dia_image,image_model,dia_mask, kernel,bkg_coeffs,kernel_errors = (
+                    kernel_solver.solve(self.cutout_aligned_image, mask=mask))
+            else:
+                dia_image,image_model,dia_mask, kernel,bkg_coeffs,kernel_errors = (
+                    run_difference_image(self.cutout_reference, self.cutout_aligned_image,
+                                         self.kernel_size,mask = mask, solver=self.solver,
+                                         kernel_degree=self.kernel_degree, kernel_basis=self.kernel_basis))
 
             positions = np.c_[[self.ref_catalog['xcenter'][self.ref_catalog_mask] - self.origin_ref_x,
               self.ref_catalog['ycenter'][self.ref_catalog_mask] - self.origin_ref_y]].T
@@ -223,6 +293,18 @@ class DIAPhotometryAnalyst(object):
             self.log.info('Problems with the DIA photometry: aboard DIA Photometry! Details below')
             self.log.error(f"DIA Photometry Error: %s, %s" % (error, type(error)))
 
+    def get_kernel_solver(self):
+        """
+        Return the ReferenceKernelSolver of the reference cutout from the kernel_cache, creating it if needed
+        """
+
+        key = (self.reference_path, self.ra, self.dec, self.size, self.kernel_size)
+        if key not in self.kernel_cache.keys():
+            self.log.info('Factorizing the reference design for the DIA kernel solution')
+            self.kernel_cache[key] = ReferenceKernelSolver(self.cutout_reference, self.kernel_size)
+
+        return self.kernel_cache[key]
+
     def update_image_with_new_layers(self):
 
             update_wcs_layer = fits.PrimaryHDU(header=self.image_header)
@@ -251,10 +333,243 @@ class DIAPhotometryAnalyst(object):
             self.image_layers.writeto(self.image_path,overwrite=True)
 
 
-def run_difference_image(reference_image, aligned_image, kernel_size, mask=None, error=None,indi=None, indj=None):
+def warp_layers(layers, inverse_map, output_shape, order=3):
+    """
+    Warp several images with the same transform and interpolation order in a single call of tf.warp.
+    Each layer is clipped to its own range of values, as tf.warp would do for that layer alone.
+
+    Parameters
+    ----------
+    layers : list of arrays, the images to warp
+    inverse_map : transform, the inverse transform from output to input coordinates
+    output_shape : tuple, the shape of the warped images
+    order : int, the order of the interpolation
+
+    Returns
+    -------
+    warped : list of arrays, the warped images
+    """
+
+    warped = tf.warp(np.dstack(layers), inverse_map, output_shape=output_shape, order=order, clip=False)
+
+    warped_layers = []
+    for i, layer in enumerate(layers):
+        output = warped[:, :, i]
+        min_val, max_val = np.nanmin(layer), np.nanmax(layer)
+
+        # Values outside of the input image are set to 0, which extends the range if they are used
+        if not min_val <= 0 <= max_val and np.nanmin(output) <= 0 <= np.nanmax(output):
+            min_val, max_val = min(min_val, 0), max(max_val, 0)
+
+        warped_layers.append(np.clip(output, min_val, max_val))
+
+    return warped_layers
+
+class ReferenceKernelSolver(object):
+    """
+    Kernel solver for the difference images of many epochs against the same reference cutout.
+
+    The normal matrix of the kernel solution depends only on the reference and the mask, so it is accumulated
+    and factorized once for the unmasked reference.  The mask of each epoch changes only the lines of the design
+    matrix whose kernel window overlaps a masked pixel, and the normal matrix of a mask is obtained from the
+    unmasked one by a low-rank update over those lines.  The factorizations are cached by mask, so that epochs
+    sharing a mask (e.g. the static bad pixels of the reference) share one factorization.  The images of
+    several epochs are solved together as multiple right-hand sides.
+
+    The results are identical to run_difference_image with the same mask, without noise weighting.
+
+    Attributes
+    ----------
+    reference_image : array, the reference cutout
+    kernel_size : int, the size of the kernel in pixels
+    block_rows : int, the number of image rows accumulated at once
+    max_masks : int, the maximum number of mask factorizations cached
+    normal_matrix : array, the normal matrix of the unmasked reference
+    factors : dict, the cached factorizations, keyed by the hash of the dilated mask
+    """
+
+    def __init__(self, reference_image, kernel_size, block_rows=16, max_masks=10):
+
+        self.reference_image = reference_image
+        self.kernel_size = kernel_size
+        self.block_rows = block_rows
+        self.max_masks = max_masks
+        self.factors = {}
+
+        half = int(kernel_size / 2)
+        self.reference_normalized = reference_image - reference_image.mean()
+        self.output_shape = reference_image[half:-half, half:-half].shape
+
+        Y, X = np.indices(reference_image.shape)
+        self.bkg_basis = np.c_[np.ones(X[half:-half, half:-half].size),
+                               X[half:-half, half:-half].ravel(),
+                               Y[half:-half, half:-half].ravel()]
+
+        self.normal_matrix, _ = build_the_normal_equations(self.reference_normalized, None, self.bkg_basis,
+                                                           None, kernel_size, block_rows=block_rows)
+
+    def get_factorization(self, mask):
+        """
+        Return the factorization of the normal matrix for a dilated mask, as a dictionary of the factor
+        (or None if the matrix is singular), the masked normal matrix, the lines of the design matrix changed
+        by the mask, and these lines without ('Afull') and with ('Amasked') the mask applied
+        """
+
+        key = hashlib.md5(np.packbits(mask).tobytes() + str(mask.shape).encode()).hexdigest()
+        if key in self.factors.keys():
+            return self.factors[key]
+
+        k = self.kernel_size
+        half = int(k / 2)
+        mask_windows = sliding_window_view(mask, (k, k))
+        changed = mask_windows.any(axis=(2, 3))
+        ii, jj = np.nonzero(changed)
+
+        Ufull = sliding_window_view(self.reference_normalized, (k, k))[ii, jj].reshape(-1, k**2)
+        Umasked = Ufull.copy()
+        Umasked[mask_windows[ii, jj].reshape(-1, k**2)] = 0
+
+        lines = np.flatnonzero(changed)
+        bkg_masked = self.bkg_basis[lines] * ~mask[half:-half, half:-half].ravel()[lines, None]
+
+        Afull = np.c_[Ufull, self.bkg_basis[lines]]
+        Amasked = np.c_[Umasked, bkg_masked]
+        normal_matrix = self.normal_matrix - Afull.T @ Afull + Amasked.T @ Amasked
+
+        try:
+            factor = linalg.cho_factor(normal_matrix)
+            covariance = linalg.cho_solve(factor, np.eye(len(normal_matrix)))
+        except linalg.LinAlgError:
+            factor = None
+            covariance = np.linalg.pinv(normal_matrix)
+
+        entry = {'factor': factor, 'normal_matrix': normal_matrix, 'covariance': covariance,
+                 'lines': lines, 'Afull': Afull, 'Amasked': Amasked}
+
+        if len(self.factors) >= self.max_masks:
+            del self.factors[list(self.factors.keys())[0]]
+        self.factors[key] = entry
+
+        return entry
+
+    def solve(self, aligned_image, mask=None):
+        """
+        Difference image of one epoch, returning the same outputs as run_difference_image
+        """
+
+        return self.solve_many([aligned_image], masks=[mask])[0]
+
+    def solve_many(self, aligned_images, masks=None):
+        """
+        Difference images of several epochs, solved together
+
+        Parameters
+        ----------
+        aligned_images : list of arrays, the images aligned to the reference
+        masks : list of arrays, the booleans of data to ignore for each image, or None
+
+        Returns
+        -------
+        results : list of (dia_image, image_model, dia_mask, kernel, bkg_coeffs, kernel_errors) tuples,
+                  one per image, as returned by run_difference_image
+        """
+
+        if masks is None:
+            masks = [None] * len(aligned_images)
+
+        k = self.kernel_size
+        half = int(k / 2)
+        nparams = k**2 + self.bkg_basis.shape[1]
+
+        dilated = []
+        tofit = np.zeros((self.bkg_basis.shape[0], len(aligned_images)))
+        for i, (image, mask) in enumerate(zip(aligned_images, masks)):
+            if mask is None:
+                mask = np.zeros(image.shape)
+            mask = dilate_the_mask(mask)
+            dilated.append(mask)
+
+            data = image - image.mean()
+            data[mask] = 0
+            tofit[:, i] = data[half:-half, half:-half].ravel()
+
+        # Right-hand sides of all epochs for the unmasked design, in one pass over U
+        _, normal_vectors = build_the_normal_equations(self.reference_normalized, None, self.bkg_basis,
+                                                       tofit, k, block_rows=self.block_rows)
+
+        solutions = np.zeros((nparams, len(aligned_images)))
+        entries = []
+        for i, mask in enumerate(dilated):
+            entry = self.get_factorization(mask)
+            entries.append(entry)
+
+            y = tofit[entry['lines'], i]
+            normal_vector = normal_vectors[:, i] - entry['Afull'].T @ y + entry['Amasked'].T @ y
+            if entry['factor'] is not None:
+                solutions[:, i] = linalg.cho_solve(entry['factor'], normal_vector)
+            else:
+                solutions[:, i] = np.linalg.lstsq(entry['normal_matrix'], normal_vector)[0]
+
+        kernels = np.flip(solutions[:-3].T.reshape(-1, k, k), axis=(1, 2))
+        models = build_the_basis_columns(self.reference_normalized, kernels)
+
+        results = []
+        for i, (image, mask, entry) in enumerate(zip(aligned_images, dilated, entries)):
+            bkg_masked = self.bkg_basis * ~mask[half:-half, half:-half].ravel()[:, None]
+            model = (models[:, i] + bkg_masked @ solutions[-3:, i]).reshape(self.output_shape) + image.mean()
+
+            residus = image[half:-half, half:-half] - model
+
+            kernel = np.flip(solutions[:-3, i].reshape((k, k)))
+            bkg_coeffs = solutions[-3:, i]
+
+            chisq = np.sum(residus ** 2)
+            variance = entry['covariance'].diagonal()[:-3] * chisq / (image.size - kernel.size)
+            kernel_errors = np.flip((variance ** 0.5).reshape(kernel.shape))
+
+            results.append((residus, model, mask, kernel, bkg_coeffs, kernel_errors))
+
+        return results
+
+def dilate_the_mask(mask):
+    """
+    Extend the mask of the difference image a bit around the masked pixels
+
+    Parameters
+    ----------
+    mask : array, a boolean of data to ignore (i.e. 1 = ignored)
+
+    Returns
+    -------
+    mask : array, the dilated boolean mask
+    """
+
+    return ndimage.binary_dilation(mask, structure=np.ones((3, 3)).astype(bool),
+                                   iterations=15).astype(bool)
+
+def run_difference_image(reference_image, aligned_image, kernel_size, mask=None, error=None,indi=None, indj=None,
+                         solver='lstsq', block_rows=16, kernel_degree=0, tile_size=32, kernel_basis='delta'):
     """
         Difference image, given an aligned image to a reference.
 
+        With solver='lstsq', the full design matrix [U, background] is built and solved by least squares.
+        With solver='cholesky', the normal matrix and vector are accumulated over blocks of block_rows rows of
+        the image, so that the design matrix is never held in memory, and solved by a Cholesky factorization.
+        The kernel errors are then derived from the inverse of the same factorization, i.e. the full covariance
+        of the masked fit including the background terms, rather than from pinv(U.T @ U).
+
+        With kernel_degree > 0, the kernel varies as a polynomial of that degree in the x,y pixel coordinates,
+        normalized to [-1, 1] over the cutout.  The normal equations are then always accumulated tile by tile,
+        over tiles of tile_size x tile_size pixels, so that the memory used by the design matrix does not depend
+        on the size of the cutout, and the returned kernel and kernel_errors are stacks of one kernel per
+        polynomial term, ordered 1, x, y, x**2, x*y, y**2...  The first one is the kernel at the cutout center.
+
+        With kernel_basis='alard_lupton', the kernel is a combination of the Gaussian x polynomial basis kernels
+        of alard_lupton_basis instead of one free parameter per kernel pixel.  The design columns are FFT
+        convolutions of the reference with the basis kernels and the solution goes through the Cholesky
+        factorization of the normal equations, whatever the solver.  The kernel errors are propagated from the
+        covariance of the basis coefficients.  This basis does not support a spatially varying kernel.
+
         Parameters
         ----------
         reference_image : array, the reference data
@@ -262,8 +577,13 @@ def run_difference_image(reference_image, aligned_image, kernel_size, mask=None,
         kernel_size: int, the size of the kernel in pixels
         mask : array, a boolean of data to ignore (i.e. 1 = ignored)
         error : array, the error data (2D)
-        indi: array, the indexes in i for the U matrix construction
-        indj: array, the indexes in j for the U matric construction
+        indi: array, [deprecated] not used, the U matrix is built from sliding windows of the reference
+        indj: array, [deprecated] not used
+        solver: str, 'lstsq' or 'cholesky'
+        block_rows: int, the number of image rows accumulated at once by the cholesky solver
+        kernel_degree: int, the degree of the polynomial spatial variation of the kernel
+        tile_size: int, the size in pixels of the tiles accumulated at once for a spatially varying kernel
+        kernel_basis: str, 'delta' or 'alard_lupton'
 
         Returns
         -------
@@ -273,6 +593,15 @@ def run_difference_image(reference_image, aligned_image, kernel_size, mask=None,
         bkg_coeffs: array, the estimated bkg coefficients (polynomial)
         kernel_errors: array, the errors on the kernel estimate
     """
+    if solver not in ['lstsq', 'cholesky']:
+        raise ValueError('Unknown kernel solver ' + str(solver))
+
+    if kernel_basis not in ['delta', 'alard_lupton']:
+        raise ValueError('Unknown kernel basis ' + str(kernel_basis))
+
+    if kernel_basis == 'alard_lupton' and kernel_degree > 0:
+        raise ValueError('Spatially varying kernels are not supported with the alard_lupton basis')
+
     if mask is None:
 
         mask = np.zeros(reference_image.shape)
@@ -286,23 +615,18 @@ def run_difference_image(reference_image, aligned_image, kernel_size, mask=None,
         noise = np.ones(reference_image.shape)
 
     #Extend the mask a bit
-    mask = ndimage.binary_dilation(mask, structure=np.ones((3, 3)).astype(bool),
-                                   iterations=15).astype(bool)
+    mask = dilate_the_mask(mask)
 
-    if (indi is not None) & (indj is not None):
-
-        pass
-
-    else:
-
-        indi,indj = build_the_U_indexes(reference_image, np.eye(kernel_size))
+    reference_normalized = (reference_image-reference_image.mean()) / noise
+    full_kernel_size = kernel_size
+    dense_lstsq = (solver == 'lstsq' and kernel_degree == 0 and kernel_basis == 'delta')
+    if dense_lstsq:
+        Umatrix = build_the_U_windows(reference_normalized, kernel_size)
+        Umatrix2 = Umatrix.copy()
+        Umatrix2[build_the_U_windows(mask, kernel_size)] = 0
 
     kernel_size = int(kernel_size / 2)
 
-    Umatrix = ((reference_image-reference_image.mean()) / noise)[indi, indj]
-    Umatrix2 = Umatrix.copy()
-    Umatrix2[mask[indi, indj]] = 0
-
     tofit = ((aligned_image - aligned_image.mean()) / noise)
     tofit[mask] = 0
 
@@ -321,12 +645,40 @@ def run_difference_image(reference_image, aligned_image, kernel_size, mask=None,
     xxx[kernel_size:-kernel_size, kernel_size:-kernel_size].ravel(),
     yyy[kernel_size:-kernel_size, kernel_size:-kernel_size].ravel()]
     #bkg_coeffs = ones[kernel_size:-kernel_size,kernel_size:-kernel_size].ravel()
-    bigU = np.c_[Umatrix2, bkg_coeffs]
-    solution = np.linalg.lstsq(bigU,
-                               tofit[kernel_size:-kernel_size, kernel_size:-kernel_size].ravel())
-    #breakpoint()
-    if np.any(np.isnan(solution[0])):
-        breakpoint()
+
+    output_shape = reference_image[kernel_size:-kernel_size, kernel_size:-kernel_size].shape
+    if kernel_basis == 'alard_lupton':
+        basis = alard_lupton_basis(full_kernel_size)
+        design = np.c_[build_the_basis_columns(reference_normalized * ~mask, basis), bkg_coeffs]
+        normal_matrix = design.T @ design
+        normal_vector = design.T @ tofit[kernel_size:-kernel_size, kernel_size:-kernel_size].ravel()
+        del design
+    elif kernel_degree > 0:
+        bkg_images = bkg_coeffs.reshape(output_shape + (bkg_coeffs.shape[1],))
+        normal_matrix, normal_vector = build_the_varying_normal_equations(
+            reference_normalized, mask, bkg_images,
+            tofit[kernel_size:-kernel_size, kernel_size:-kernel_size],
+            full_kernel_size, kernel_degree, tile_size=tile_size)
+    elif solver == 'cholesky':
+        normal_matrix, normal_vector = build_the_normal_equations(
+            reference_normalized, mask, bkg_coeffs,
+            tofit[kernel_size:-kernel_size, kernel_size:-kernel_size].ravel(),
+            full_kernel_size, block_rows=block_rows)
+
+    if dense_lstsq:
+        bigU = np.c_[Umatrix2, bkg_coeffs]
+        solution = np.linalg.lstsq(bigU,
+                                   tofit[kernel_size:-kernel_size, kernel_size:-kernel_size].ravel())
+    else:
+        try:
+            factor = linalg.cho_factor(normal_matrix)
+            solution = [linalg.cho_solve(factor, normal_vector)]
+        except linalg.LinAlgError:
+            # Singular normal matrix, e.g. a fully masked cutout
+            factor = None
+            solution = np.linalg.lstsq(normal_matrix, normal_vector)
+    if np.any(~np.isfinite(solution[0])):
+        raise ValueError('Non-finite kernel solution, check the images for non-finite pixels')
 
     #model = ((((Umatrix @ solution[0][:-3]).reshape(
     #    reference_image[kernel_size:-kernel_size, kernel_size:-kernel_size].shape) +
@@ -336,34 +688,156 @@ def run_difference_image(reference_image, aligned_image, kernel_size, mask=None,
     #    #          -1]) +
     #         aligned_image.mean())
 
-    model = (np.c_[Umatrix, bkg_coeffs] @ solution[0]).reshape(
-        reference_image[kernel_size:-kernel_size,
-        kernel_size:-kernel_size].shape) + aligned_image.mean()
+    kernel_shape = (2*kernel_size+1, 2*kernel_size+1)
+    if kernel_degree > 0:
+        kernel_shape = (len(solution[0][:-3]) // full_kernel_size**2,) + kernel_shape
+    if kernel_basis == 'alard_lupton':
+        kernel = np.tensordot(solution[0][:-3], basis, axes=1)
+    else:
+        kernel = np.flip(solution[0][:-3].reshape(kernel_shape), axis=(-2, -1))
+
+    # The model is the FFT convolution of the reference with the kernel, rather than U @ solution
+    if kernel_degree > 0:
+        model = evaluate_the_varying_model(reference_normalized, bkg_images, solution[0], full_kernel_size,
+                                           kernel_degree).ravel()
+    else:
+        model = build_the_basis_columns(reference_normalized, kernel[None])[:, 0]
+        model += bkg_coeffs @ solution[0][-3:]
+
+    model = model.reshape(output_shape) + aligned_image.mean()
 
 
     residus = aligned_image[kernel_size:-kernel_size, kernel_size:-kernel_size] - model
     #residus[mask[kernel_size:-kernel_size, kernel_size:-kernel_size]] = 0
 
-    kernel = np.flip(solution[0][:-3].reshape((2*kernel_size+1, 2*kernel_size+1)))
     bkg_coeffs = solution[0][-3:]
 
-    cov = np.linalg.pinv(Umatrix.T @ Umatrix)
+    if dense_lstsq:
+        cov = np.linalg.pinv(Umatrix.T @ Umatrix)
+    elif factor is not None:
+        cov = linalg.cho_solve(factor, np.eye(len(normal_vector)))[:-3, :-3]
+    else:
+        cov = np.linalg.pinv(normal_matrix)[:-3, :-3]
     chisq = np.sum(residus ** 2)
-    cov *= chisq / (len(tofit.ravel()) - len(kernel.ravel()))
 
-    kernel_errors = np.flip((cov.diagonal() ** 0.5).reshape(kernel.shape))
+    if kernel_basis == 'alard_lupton':
+        cov *= chisq / (len(tofit.ravel()) - len(basis))
+        basis_pixels = basis.reshape(len(basis), -1)
+        variance = np.einsum('ip,ij,jp->p', basis_pixels, cov, basis_pixels)
+        kernel_errors = (variance ** 0.5).reshape(kernel.shape)
+    else:
+        cov *= chisq / (len(tofit.ravel()) - len(kernel.ravel()))
+        kernel_errors = np.flip((cov.diagonal() ** 0.5).reshape(kernel.shape), axis=(-2, -1))
     # bkg_coeffs_errors = TODO
     image_model = model
     dia_image = residus
     dia_mask = mask
 
-    #import scipy.signal as ss
+    return dia_image,image_model,dia_mask,kernel,bkg_coeffs,kernel_errors
 
-    #model2 = ss.fftconvolve(reference_image - reference_image.mean(),kernel,
-    #                         mode='same' )
-    #breakpoint()
+def run_difference_image_tile(reference_tile, aligned_tile, kernel_size, mask_tile, options):
+    """
+    Difference image of one tile of a full frame, for run_tiled_difference_image
 
-    return dia_image,image_model,dia_mask,kernel,bkg_coeffs,kernel_errors
+    Parameters
+    ----------
+    reference_tile : array, the reference data of the tile, including its overlap
+    aligned_tile : array, the aligned image data of the tile, including its overlap
+    kernel_size : int, the size of the kernel in pixels
+    mask_tile : array, the mask of the tile, including its overlap
+    options : dict, the keyword arguments of run_difference_image
+
+    Returns
+    -------
+    results : tuple, the outputs of run_difference_image for the tile
+    """
+
+    return run_difference_image(reference_tile, aligned_tile, kernel_size, mask=mask_tile, **options)
+
+def run_tiled_difference_image(reference_image, aligned_image, kernel_size, mask=None, tile_size=512, overlap=16,
+                               nprocess=1, solver='cholesky', kernel_degree=0, kernel_basis='delta'):
+    """
+        Difference image of a full frame, solved independently on tiles of the frame.
+
+        The frame is split into tiles of tile_size x tile_size output pixels.  Each tile is solved with
+        run_difference_image on the reference and aligned image extended by the kernel half-width plus overlap
+        pixels on each side, so that the kernel solution and the mask dilation of the tile are not affected by
+        its edges, and only the central part of its difference image is kept.  The tiles are processed on a
+        pool of nprocess processes.
+
+        Parameters
+        ----------
+        reference_image : array, the reference data
+        aligned_image: array, the image aligned to the data
+        kernel_size: int, the size of the kernel in pixels
+        mask : array, a boolean of data to ignore (i.e. 1 = ignored)
+        tile_size: int, the size of the tiles in output pixels
+        overlap: int, the number of pixels by which tiles are extended on each side
+        nprocess: int, the number of processes, 1 to process the tiles serially
+        solver: str, the solver of run_difference_image
+        kernel_degree: int, the degree of the spatial variation of the kernel within each tile
+        kernel_basis: str, the kernel basis of run_difference_image
+
+        Returns
+        -------
+        dia_image : array, the difference image, over the same pixels as run_difference_image
+        image_model : array, the model of the image
+        dia_mask : array, the dilated mask
+        kernels: array, the estimated kernel of each tile, of shape (ntiles_y, ntiles_x) + kernel shape
+        bkg_coeffs: array, the estimated bkg coefficients of each tile, in the pixel coordinates of the tile
+        kernel_errors: array, the errors on the kernel estimate of each tile
+    """
+    if mask is None:
+
+        mask = np.zeros(reference_image.shape, dtype=bool)
+
+    half = int(kernel_size / 2)
+    output_shape = (reference_image.shape[0] - 2 * half, reference_image.shape[1] - 2 * half)
+    options = {'solver': solver, 'kernel_degree': kernel_degree, 'kernel_basis': kernel_basis}
+
+    # Tile limits in output pixels, and the corresponding extended limits in image pixels
+    row_starts = np.arange(0, output_shape[0], tile_size)
+    col_starts = np.arange(0, output_shape[1], tile_size)
+    tiles = []
+    for row in row_starts:
+        for col in col_starts:
+            core = (slice(row, min(row + tile_size, output_shape[0])),
+                    slice(col, min(col + tile_size, output_shape[1])))
+            extended = (slice(max(row - overlap, 0), min(core[0].stop + 2 * half + overlap, reference_image.shape[0])),
+                        slice(max(col - overlap, 0), min(core[1].stop + 2 * half + overlap, reference_image.shape[1])))
+            tiles.append((core, extended))
+
+    arguments = [(reference_image[extended], aligned_image[extended], kernel_size, mask[extended], options)
+                 for core, extended in tiles]
+
+    if nprocess > 1:
+        with ProcessPoolExecutor(max_workers=nprocess) as executor:
+            results = list(executor.map(run_difference_image_tile, *zip(*arguments)))
+    else:
+        results = [run_difference_image_tile(*args) for args in arguments]
+
+    dia_image = np.zeros(output_shape)
+    image_model = np.zeros(output_shape)
+    kernels = []
+    bkg_coeffs = []
+    kernel_errors = []
+    for (core, extended), result in zip(tiles, results):
+        inner = (slice(core[0].start - extended[0].start, core[0].stop - extended[0].start),
+                 slice(core[1].start - extended[1].start, core[1].stop - extended[1].start))
+        dia_image[core] = result[0][inner]
+        image_model[core] = result[1][inner]
+        kernels.append(result[3])
+        bkg_coeffs.append(result[4])
+        kernel_errors.append(result[5])
+
+    grid = (len(row_starts), len(col_starts))
+    kernels = np.array(kernels).reshape(grid + kernels[0].shape)
+    bkg_coeffs = np.array(bkg_coeffs).reshape(grid + bkg_coeffs[0].shape)
+    kernel_errors = np.array(kernel_errors).reshape(grid + kernel_errors[0].shape)
+
+    dia_mask = dilate_the_mask(mask)
+
+    return dia_image, image_model, dia_mask, kernels, bkg_coeffs, kernel_errors
 
 def run_dia_photometry(image, error, positions,radius):
     """
@@ -395,71 +869,942 @@ def run_dia_photometry(image, error, positions,radius):
     #breakpoint()
     return phot_table
 
+def run_dia_psf_photometry(image, error, positions, psf_fwhm, kernel=None, mask=None):
+    """
+    DIA photometry on a image by fitting the PSF at fixed stars positions simultaneously, so that the fluxes of
+    blended neighbours are separated.  The PSF is the Gaussian reference PSF convolved by the kernel.  The design
+    matrix has one column per star, non-zero on its PSF stamp only, so that the normal matrix is sparse, with
+    non-zero terms between overlapping stars only.  It is solved group by group of overlapping stars, in closed
+    form for isolated stars.
 
+    Parameters
+    ----------
+    image : array, the image data
+    error : array, the error data (2D)
+    positions: array, [X,Y] positions of the stars
+    psf_fwhm : float, the FWHM of the reference PSF in pixels
+    kernel : array, [optional] the kernel of run_difference_image
+    mask : array, [optional] the boolean mask of the pixels excluded from the fit
 
+    Returns
+    -------
+    phot_table : astropy.Table, the photometry, in the format of run_dia_photometry, with the sparse covariance
+                 matrix of the fluxes in meta['covariance'].  Stars without valid pixels, or blended with a star at
+                 the same position, are NaN
+    """
+
+    positions = np.atleast_2d(positions)
+    nstars = len(positions)
+    ny, nx = image.shape
+
+    centers = np.floor(positions + 0.5).astype(int)
+    stamps = gaussian_psf(psf_fwhm, kernel=kernel, offsets=positions - centers)
+    half = stamps.shape[-1] // 2
+    dy, dx = np.mgrid[-half:half + 1, -half:half + 1]
+    rows = centers[:, 1, None, None] + dy
+    cols = centers[:, 0, None, None] + dx
+    # The wings of the stamps below 1e-3 of their peak are dropped, so that only significant overlaps couple stars
+    inside = ((rows >= 0) & (rows < ny) & (cols >= 0) & (cols < nx)
+              & (np.abs(stamps) > 1e-3 * np.abs(stamps).max(axis=(1, 2), keepdims=True)))
+
+    valid = (error > 0) & np.isfinite(image)
+    if mask is not None:
+        valid &= ~mask
+    weight = np.zeros(image.shape)
+    weight[valid] = 1.0 / error[valid]
+
+    # The stamps are stored star by star, so that they are the columns of the design matrix in CSC format
+    pixels = (rows * nx + cols)[inside]
+    indptr = np.r_[0, np.cumsum(inside.sum(axis=(1, 2)))]
+    design = sparse.csc_matrix((stamps[inside] * weight.ravel()[pixels], pixels, indptr), shape=(ny * nx, nstars))
+
+    normal = (design.T @ design).tocsr()
+    vector = design.T @ (np.where(valid, image, 0.0) * weight).ravel()
+
+    # The normal matrix, and so its inverse, are block diagonal over the groups of overlapping stars
+    ngroups, groups = csgraph.connected_components(normal, directed=False)
+    sizes = np.bincount(groups)
+    diagonal = normal.diagonal()
+
+    flux = np.full(nstars, np.nan)
+    variance = np.full(nstars, np.nan)
+    single = (sizes[groups] == 1) & (diagonal > 0)
+    flux[single] = vector[single] / diagonal[single]
+    variance[single] = 1.0 / diagonal[single]
+    cov_rows, cov_cols, cov_values = [np.where(single)[0]], [np.where(single)[0]], [variance[single]]
+
+    for group in np.where(sizes > 1)[0]:
+        idx = np.where(groups == group)[0]
+        matrix = normal[idx][:, idx].toarray()
+
+        # The fluxes of stars with indistinguishable PSFs, e.g. at the same position, are left undefined
+        try:
+            if np.linalg.cond(matrix) > 1e12:
+                raise linalg.LinAlgError('Ill-conditioned group of blended stars')
+            block = linalg.inv(matrix, overwrite_a=True)
+        except linalg.LinAlgError:
+            continue
+        flux[idx] = block @ vector[idx]
+        variance[idx] = block.diagonal()
+        cov_rows.append(np.repeat(idx, len(idx)))
+        cov_cols.append(np.tile(idx, len(idx)))
+        cov_values.append(block.ravel())
+
+    covariance = sparse.csr_matrix((np.concatenate(cov_values), (np.concatenate(cov_rows), np.concatenate(cov_cols))),
+                                   shape=(nstars, nstars))
+
+    phot_table = Table({
+        'id': np.arange(1, nstars + 1),
+        'xcenter': positions[:, 0],
+        'ycenter': positions[:, 1],
+        'aperture_sum': flux,
+        'aperture_sum_err': np.sqrt(variance)
+    })
+    phot_table.meta['covariance'] = covariance
+
+    return phot_table
+
+def gaussian_psf(fwhm, kernel=None, offsets=None):
+    """
+    Normalized Gaussian PSF stamp of a given FWHM, optionally convolved by a DIA kernel to give the PSF of the
+    aligned image from that of the reference
+
+    Parameters
+    ----------
+    fwhm : float, the FWHM of the PSF in pixels
+    kernel : array, [optional] the kernel of run_difference_image
+    offsets : array, [optional] x,y sub-pixel offsets of the PSF center, one row per stamp
+
+    Returns
+    -------
+    psf : array, the PSF stamp, of odd size and unit sum, or a stack of stamps, one per offset
+    """
+
+    sigma = fwhm / (2.0 * np.sqrt(2.0 * np.log(2.0)))
+    half = int(np.ceil(4.0 * sigma))
+    yy, xx = np.mgrid[-half:half + 1, -half:half + 1]
+
+    if offsets is None:
+        psf = np.exp(-(xx**2 + yy**2) / (2.0 * sigma**2))
+    else:
+        offsets = np.atleast_2d(offsets)
+        psf = np.exp(-((xx - offsets[:, 0, None, None])**2 + (yy - offsets[:, 1, None, None])**2)
+                     / (2.0 * sigma**2))
+
+    if kernel is not None:
+        psf = signal.fftconvolve(psf, kernel if offsets is None else kernel[None], mode='full', axes=(-2, -1))
+
+    return psf / psf.sum(axis=(-2, -1), keepdims=True)
+
+def psf_aperture_fraction(psf, radius):
+    """
+    Fraction of the flux of a PSF stamp within a circular aperture centered on the stamp, to convert the total
+    fluxes of PSF photometry to the flux units of aperture photometry
+
+    Parameters
+    ----------
+    psf : array, the PSF stamp of gaussian_psf, of odd size and unit sum
+    radius : float, the radius of the aperture in pixels
+
+    Returns
+    -------
+    fraction : float
+    """
+
+    center = (psf.shape[1] // 2, psf.shape[0] // 2)
+    phot_table = aperture_photometry(psf, CircularAperture(center, r=radius), method='exact')
+
+    return float(phot_table['aperture_sum'][0])
+
+def detect_transients(dia_image, variance, psf, mask=None, threshold=5.0, min_separation=3):
+    """
+    Detect the point sources left in a difference image with a matched filter.  The difference image weighted
+    by the inverse variance is cross-correlated with the PSF by FFT, which gives at each pixel the maximum
+    likelihood flux of a point source and its signal-to-noise ratio against the propagated noise.  Candidates
+    are the local maxima of |snr| above threshold, so that both brightening and fading sources are detected.
+
+    Parameters
+    ----------
+    dia_image : array, the difference image
+    variance : array, the variance of the difference image
+    psf : array, the PSF of the image, of odd size and unit sum
+    mask : array, [optional] the boolean mask of bad pixels
+    threshold : float, the detection threshold in signal-to-noise ratio
+    min_separation : int, the minimum separation of two candidates in pixels
+
+    Returns
+    -------
+    candidates : dict, the x,y positions ('x', 'y') in the difference image, flux ('flux', 'flux_err') and
+                 signal-to-noise ratio ('snr') of the candidates, sorted by decreasing |snr|
+    """
+
+    if mask is None:
+        mask = np.zeros(dia_image.shape, dtype=bool)
+
+    weight = np.zeros(dia_image.shape)
+    valid = ~mask & (variance > 0) & np.isfinite(dia_image)
+    weight[valid] = 1.0 / variance[valid]
+    data = np.where(valid, dia_image, 0.0)
+
+    # Correlation with the PSF is the convolution with the flipped PSF
+    flipped = psf[::-1, ::-1]
+    numerator = signal.fftconvolve(data * weight, flipped, mode='same')
+    denominator = signal.fftconvolve(weight, flipped**2, mode='same')
+
+    covered = denominator > 1e-3 * np.max(denominator)
+    snr = np.zeros(dia_image.shape)
+    snr[covered] = numerator[covered] / denominator[covered]**0.5
+    flux = np.zeros(dia_image.shape)
+    flux[covered] = numerator[covered] / denominator[covered]
+
+    significance = np.abs(snr)
+    peaks = ((significance >= threshold) & covered & ~mask
+             & (significance == ndimage.maximum_filter(significance, size=2 * min_separation + 1)))
+    rows, cols = np.nonzero(peaks)
+    order = np.argsort(-significance[rows, cols], kind='stable')
+    rows, cols = rows[order], cols[order]
+
+    # Sub-pixel positions from a parabola through the neighbours of each peak, and the flux at the vertex
+    ny, nx = dia_image.shape
+    offsets = []
+    peak_flux = flux[rows, cols]
+    for step in ((1, 0), (0, 1)):
+        below = (np.clip(rows - step[0], 0, ny - 1), np.clip(cols - step[1], 0, nx - 1))
+        above = (np.clip(rows + step[0], 0, ny - 1), np.clip(cols + step[1], 0, nx - 1))
+        curvature = significance[below] - 2.0 * significance[rows, cols] + significance[above]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            offset = np.where(curvature < 0, 0.5 * (significance[below] - significance[above]) / curvature, 0.0)
+        offset = np.clip(offset, -0.5, 0.5)
+        offsets.append(offset)
+        peak_flux = peak_flux + 0.5 * offset * (flux[above] - flux[below]) + 0.5 * offset**2 * (
+            flux[above] - 2.0 * flux[rows, cols] + flux[below])
+
+    flux_err = denominator[rows, cols]**-0.5
+    candidates = {
+        'x': cols + offsets[1],
+        'y': rows + offsets[0],
+        'flux': peak_flux,
+        'flux_err': flux_err,
+        'snr': snr[rows, cols]
+    }
+
+    return candidates
+
+
+
+
+def build_the_U_windows(image, kernel_size):
+    """
+    Construct the U matrix for the kernel solution, where each line is the window of the image covered by the
+    kernel at one pixel, image[i:i+kernel_size, j:j+kernel_size].ravel(), with j running fastest.
+    The windows are a strided view of the image, flattened to 2D in a single copy.
+
+    Parameters
+    ----------
+    image : array, the image data
+    kernel_size : int, the size of the kernel in pixels
+
+    Returns
+    -------
+    Umatrix : array, the U matrix of shape ((m-kernel_size+1)*(n-kernel_size+1), kernel_size**2)
+    """
+
+    windows = sliding_window_view(image, (kernel_size, kernel_size))
+
+    return windows.reshape(-1, kernel_size**2)
+
+def iterate_the_U_blocks(image, mask, kernel_size, block_rows=16):
+    """
+    Iterate over the U matrix of an image by blocks of lines, each block covering block_rows rows of the
+    output image, so that only one block is held in memory at a time
+
+    Parameters
+    ----------
+    image : array, the image data
+    mask : array, a boolean of data to zero in U (i.e. 1 = ignored), or None
+    kernel_size : int, the size of the kernel in pixels
+    block_rows : int, the number of output image rows per block
+
+    Yields
+    ------
+    Ublock : array, the lines of the U matrix for the block
+    lines : slice, the lines of the full U matrix covered by the block
+    """
+
+    windows = sliding_window_view(image, (kernel_size, kernel_size))
+    if mask is not None:
+        mask_windows = sliding_window_view(mask, (kernel_size, kernel_size))
+
+    ncols = windows.shape[1]
+    for row in range(0, windows.shape[0], block_rows):
+        Ublock = windows[row:row + block_rows].reshape(-1, kernel_size**2)
+        if mask is not None:
+            Ublock[mask_windows[row:row + block_rows].reshape(-1, kernel_size**2)] = 0
+
+        yield Ublock, slice(row * ncols, row * ncols + len(Ublock))
+
+def build_the_normal_equations(image, mask, bkg_basis, tofit, kernel_size, block_rows=16):
+    """
+    Accumulate the normal matrix A.T @ A and vector A.T @ y of the kernel solution, where
+    A = [U, bkg_basis], streaming over blocks of the U matrix
+
+    Parameters
+    ----------
+    image : array, the (normalized) reference data
+    mask : array, a boolean of data to zero in U (i.e. 1 = ignored)
+    bkg_basis : array, the background terms of A, one line per line of U
+    tofit : array, the (normalized) image data to fit, one entry (or one column per image) per line of U,
+            or None to accumulate the normal matrix only
+    kernel_size : int, the size of the kernel in pixels
+    block_rows : int, the number of output image rows per block
+
+    Returns
+    -------
+    normal_matrix : array, A.T @ A
+    normal_vector : array, A.T @ y, or None
+    """
+
+    nparams = kernel_size**2 + bkg_basis.shape[1]
+    normal_matrix = np.zeros((nparams, nparams))
+    normal_vector = None if tofit is None else np.zeros((nparams,) + tofit.shape[1:])
+
+    for Ublock, lines in iterate_the_U_blocks(image, mask, kernel_size, block_rows=block_rows):
+        Ablock = np.c_[Ublock, bkg_basis[lines]]
+        normal_matrix += Ablock.T @ Ablock
+        if tofit is not None:
+            normal_vector += Ablock.T @ tofit[lines]
+
+    return normal_matrix, normal_vector
+
+def iterate_the_U_tiles(image, mask, kernel_size, tile_size=32):
+    """
+    Iterate over the U matrix of an image by square tiles of the output image, so that only the lines of one
+    tile are held in memory at a time
+
+    Parameters
+    ----------
+    image : array, the image data
+    mask : array, a boolean of data to zero in U (i.e. 1 = ignored), or None
+    kernel_size : int, the size of the kernel in pixels
+    tile_size : int, the size of the tiles in output image pixels
+
+    Yields
+    ------
+    Ublock : array, the lines of the U matrix for the tile
+    rows : slice, the rows of the output image covered by the tile
+    cols : slice, the columns of the output image covered by the tile
+    """
+
+    windows = sliding_window_view(image, (kernel_size, kernel_size))
+    if mask is not None:
+        mask_windows = sliding_window_view(mask, (kernel_size, kernel_size))
+
+    for row in range(0, windows.shape[0], tile_size):
+        for col in range(0, windows.shape[1], tile_size):
+            rows = slice(row, min(row + tile_size, windows.shape[0]))
+            cols = slice(col, min(col + tile_size, windows.shape[1]))
+
+            Ublock = windows[rows, cols].reshape(-1, kernel_size**2)
+            if mask is not None:
+                Ublock[mask_windows[rows, cols].reshape(-1, kernel_size**2)] = 0
+
+            yield Ublock, rows, cols
+
+def spatial_polynomial_terms(rows, cols, output_shape, degree):
+    """
+    Polynomial terms of the spatial variation of the kernel for a tile of the output image, in x,y coordinates
+    normalized to [-1, 1] over the output image, ordered 1, x, y, x**2, x*y, y**2...
+
+    Parameters
+    ----------
+    rows : slice, the rows of the tile
+    cols : slice, the columns of the tile
+    output_shape : tuple, the shape of the output image
+    degree : int, the degree of the polynomial
+
+    Returns
+    -------
+    terms : array, the polynomial terms of shape (npix, nterms), one line per pixel of the tile
+    """
+
+    yy, xx = np.mgrid[rows, cols]
+    xn = (xx.ravel() - (output_shape[1] - 1) / 2) / max((output_shape[1] - 1) / 2, 1)
+    yn = (yy.ravel() - (output_shape[0] - 1) / 2) / max((output_shape[0] - 1) / 2, 1)
+
+    return np.stack([xn**(order - i) * yn**i for order in range(degree + 1) for i in range(order + 1)], axis=-1)
+
+def build_the_varying_normal_equations(image, mask, bkg_images, tofit, kernel_size, degree, tile_size=32):
+    """
+    Accumulate tile by tile the normal matrix A.T @ A and vector A.T @ y of a spatially varying kernel
+    solution, where the design matrix A has one block of U per polynomial term, scaled by that term, followed
+    by the background terms
+
+    Parameters
+    ----------
+    image : array, the (normalized) reference data
+    mask : array, a boolean of data to zero in U (i.e. 1 = ignored)
+    bkg_images : array, the background terms, of shape output_shape + (nbkg,)
+    tofit : array, the (normalized) image data to fit, of the output image shape
+    kernel_size : int, the size of the kernel in pixels
+    degree : int, the degree of the polynomial spatial variation of the kernel
+    tile_size : int, the size of the tiles in output image pixels
+
+    Returns
+    -------
+    normal_matrix : array, A.T @ A
+    normal_vector : array, A.T @ y
+    """
+
+    nterms = (degree + 1) * (degree + 2) // 2
+    nparams = nterms * kernel_size**2 + bkg_images.shape[-1]
+    normal_matrix = np.zeros((nparams, nparams))
+    normal_vector = np.zeros(nparams)
+
+    for Ublock, rows, cols in iterate_the_U_tiles(image, mask, kernel_size, tile_size=tile_size):
+        terms = spatial_polynomial_terms(rows, cols, tofit.shape, degree)
+        Ablock = np.c_[(Ublock[:, None, :] * terms[:, :, None]).reshape(len(Ublock), -1),
+                       bkg_images[rows, cols].reshape(len(Ublock), -1)]
+        normal_matrix += Ablock.T @ Ablock
+        normal_vector += Ablock.T @ tofit[rows, cols].ravel()
+
+    return normal_matrix, normal_vector
+
+def evaluate_the_varying_model(image, bkg_images, solution, kernel_size, degree):
+    """
+    Evaluate the model of a spatially varying kernel solution, as the sum of the FFT convolutions of the
+    reference with the kernel of each polynomial term, weighted by that term
+
+    Parameters
+    ----------
+    image : array, the (normalized) reference data
+    bkg_images : array, the background terms, of shape output_shape + (nbkg,)
+    solution : array, the kernel coefficients of each polynomial term followed by the background coefficients
+    kernel_size : int, the size of the kernel in pixels
+    degree : int, the degree of the polynomial spatial variation of the kernel
+
+    Returns
+    -------
+    model : array, the model of the output image shape
+    """
+
+    nbkg = bkg_images.shape[-1]
+    output_shape = bkg_images.shape[:-1]
+    kernels = np.flip(solution[:-nbkg].reshape(-1, kernel_size, kernel_size), axis=(1, 2))
+
+    terms = spatial_polynomial_terms(slice(0, output_shape[0]), slice(0, output_shape[1]), output_shape, degree)
+    model = np.sum(build_the_basis_columns(image, kernels) * terms, axis=1)
+    model += bkg_images.reshape(-1, nbkg) @ solution[-nbkg:]
+
+    return model.reshape(output_shape)
+
+def alard_lupton_basis(kernel_size, sigmas=(0.7, 1.5, 3.0), degrees=(6, 4, 2)):
+    """
+    Construct the Alard & Lupton (1998) kernel basis, Gaussians of several widths multiplied by polynomials
+    exp(-(u**2+v**2)/(2*sigma**2)) * u**i * v**j with i+j <= degree, each normalized to unit norm
+
+    Parameters
+    ----------
+    kernel_size : int, the size of the kernel in pixels
+    sigmas : tuple, the widths in pixels of the Gaussians
+    degrees : tuple, the degree of the polynomials of each Gaussian
+
+    Returns
+    -------
+    basis : array, the basis kernels of shape (nbasis, kernel_size, kernel_size)
+    """
+
+    half = int(kernel_size / 2)
+    vv, uu = np.mgrid[-half:half + 1, -half:half + 1]
+
+    basis = []
+    for sigma, degree in zip(sigmas, degrees):
+        gaussian = np.exp(-(uu**2 + vv**2) / (2 * sigma**2))
+        for order in range(degree + 1):
+            for j in range(order + 1):
+                kernel = gaussian * uu**(order - j) * vv**j
+                basis.append(kernel / np.sqrt(np.sum(kernel**2)))
+
+    return np.array(basis)
+
+def build_the_basis_columns(image, basis):
+    """
+    Construct the design columns of a kernel basis, the FFT convolutions of the image with each basis kernel
+    over the pixels where the kernel is fully within the image.  This is also the model of the image for a set
+    of kernels.
+
+    Parameters
+    ----------
+    image : array, the (normalized) reference data
+    basis : array, the basis kernels of shape (nbasis, kernel_size, kernel_size)
+
+    Returns
+    -------
+    columns : array, the design columns of shape (npix, nbasis)
+    """
+
+    kernel_size = basis.shape[-1]
+    shape = [fft.next_fast_len(n + kernel_size - 1, real=True) for n in image.shape]
+    valid = (slice(kernel_size - 1, image.shape[0]), slice(kernel_size - 1, image.shape[1]))
+
+    # The FFT of the image is computed once for all the basis kernels
+    image_fft = fft.rfft2(image, shape)
+    columns = [fft.irfft2(image_fft * fft.rfft2(kernel, shape), shape)[valid].ravel() for kernel in basis]
+
+    return np.stack(columns, axis=-1)
 
 def build_the_U_matrix(X,K):
     """To save to make X,Y dependent kernel, might be of use later"""
     p, q = K.shape
-    m, n = X.shape
-    U = np.zeros(((n - q + 1) ** 2, q ** 2))
-    #YY, XX = np.indices(X.shape)
-    #UX = np.zeros(U.shape)
-    #UY = np.zeros(U.shape)
-    #UXX = np.zeros(U.shape)
-    #UYY = np.zeros(U.shape)
-    #UXY = np.zeros(U.shape)
-    indi = np.zeros(U.shape)
-    indj = np.zeros(U.shape)
-
-    iii, jjj = np.indices(X.shape)
-
-    line = 0
-    for i in range(n - q + 1):
-        for j in range(n - q + 1):
-            U[line] = X[i:i + q, j:j + q].ravel()  # *MASK[i:i+q,j:j+q].ravel()
-            #UX[line] = xx[i:i + q, j:j + q].ravel() * XX[i:i + q, j:j + q].ravel()  # *MASK[i:i+q,j:j+q].ravel()
-            #UY[line] = xx[i:i + q, j:j + q].ravel() * YY[i:i + q, j:j + q].ravel()  # *MASK[i:i+q,j:j+q].ravel()
-            #UXX[line] = xx[i:i + q, j:j + q].ravel() * XX[i:i + q, j:j + q].ravel() ** 2  # *MASK[i:i+q,j:j+q].ravel()
-            #UYY[line] = xx[i:i + q, j:j + q].ravel() * YY[i:i + q, j:j + q].ravel() ** 2  # *MASK[i:i+q,j:j+q].ravel()
-            #UXY[line] = xx[i:i + q, j:j + q].ravel() * XX[i:i + q, j:j + q].ravel() * YY[i:i + q,
-            #                                                                          j:j + q].ravel()  # *MASK[i:i+q,j:j+q].ravel()
-
-            indi[line] = iii[i:i + q, j:j + q].ravel()
-            indj[line] = jjj[i:i + q, j:j + q].ravel()
-            line += 1
-
-    return U, indi.astype(int), indj.astype(int)
+    indi, indj = build_the_U_indexes(X, K)
+
+    return build_the_U_windows(X, q), indi, indj
 
 
 def build_the_U_indexes(reference_image, kernel):
     """
-    Construct the indi,inj indexes to build quickly the umatrix for kernel solution
+    Construct the indi,inj indexes to build quickly the umatrix for kernel solution, such that
+    reference_image[indi, indj] is the U matrix built by build_the_U_windows
+
     Parameters
     ----------
-    image : array, the image data
-    error : array, the error data (2D)
-    positions: array, [X,Y] positions of the stars to place aperture
-    radius: float, the aperture radius use to extract flux
+    reference_image : array, the reference data
+    kernel : array, an array of the shape of the kernel
 
     Returns
     -------
-    phot_table : astropy.Table, the photometric table
+    indi : array, the indexes in i for the U matrix construction
+    indj : array, the indexes in j for the U matrix construction
     """
     p, q = kernel.shape
-    m, n = reference_image.shape
     iii, jjj = np.indices(reference_image.shape)
 
-    indi = np.zeros(((n - q + 1) ** 2, q ** 2))
-    indj = np.zeros(((n - q + 1) ** 2, q ** 2))
+    return build_the_U_windows(iii, q), build_the_U_windows(jjj, q)
+
+
+def get_refined_wcs(hdulist):
+    """
+    Return the refined WCS stored in an image by the aperture photometry stage if available, otherwise the WCS
+    of the image header
+
+    Parameters
+    ----------
+    hdulist : astropy.io.fits.HDUList, the open image
+
+    Returns
+    -------
+    image_wcs : astropy.wcs, the WCS of the image
+    wcs_refined : bool, whether the WCS is the refined one
+    """
+
+    names = [hdu.name for hdu in hdulist]
+    layer_name = 'LCO MICROLENSING PHOTOMETRY UPDATED WCS'
+    if layer_name in names:
+        return WCS(hdulist[names.index(layer_name)].header), True
+
+    return WCS(hdulist[0].header), False
+
+def load_dia_image(image_path):
+    """
+    Load the layers of an image needed for DIA.  The refined WCS stored by the aperture photometry stage is used
+    if available, otherwise the WCS of the image header.
+
+    Parameters
+    ----------
+    image_path : str, the path to the image
+
+    Returns
+    -------
+    image : dict, the science data ('data'), errors ('errors'), boolean bad pixel mask ('mask'), including the
+            non-finite pixels, WCS ('wcs'), whether the WCS was refined ('wcs_refined') and exposure time
+            ('exptime') of the image
+    """
+
+    with fits.open(image_path) as hdulist:
+        names = [hdu.name for hdu in hdulist]
+        header = hdulist[0].header
+
+        data = hdulist[names.index('SCI')].data if 'SCI' in names else hdulist[0].data
+        data = data.astype(float)
+
+        if 'ERR' in names:
+            errors = hdulist[names.index('ERR')].data.astype(float)
+        else:
+            errors = np.abs(data)**0.5
+
+        if 'BPM' in names:
+            mask = hdulist[names.index('BPM')].data > 0
+        else:
+            mask = np.zeros(data.shape, dtype=bool)
+
+        # Non-finite pixels are masked, and filled so that they do not spread through the interpolation
+        invalid = ~np.isfinite(data) | ~np.isfinite(errors)
+        if invalid.any():
+            mask = mask | invalid
+            data[invalid] = np.median(data[~invalid]) if (~invalid).any() else 0.0
+            errors[invalid] = np.median(errors[~invalid]) if (~invalid).any() else 0.0
+
+        image_wcs, wcs_refined = get_refined_wcs(hdulist)
+
+        image = {
+            'data': data,
+            'errors': errors,
+            'mask': mask,
+            'wcs': image_wcs,
+            'wcs_refined': wcs_refined,
+            'exptime': float(header['EXPTIME'])
+        }
+
+    return image
+
+# The kernel solvers of the DIA references, cached per process by DIAReference.get_kernel_solver
+kernel_solvers = {}
+
+class DIAReference(object):
+    """
+    Reference cutout of the DIA stage of a dataset, centered on a position on sky
+
+    Attributes
+    ----------
+    image_name : str, the name of the reference image
+    image : array, the reference cutout, extended by the kernel half-width on each side
+    mask : array, the boolean bad pixel mask of the cutout
+    wcs : astropy.wcs, the WCS of the full reference image
+    origin : tuple, the x,y pixel position of the cutout in the full reference image
+    kernel_size : int, the size of the kernel in pixels
+    exptime : float, the exposure time of the reference image
+    """
+
+    def __init__(self, image_path, ra, dec, cutout_size, kernel_size, log=None):
+
+        reference = load_dia_image(image_path)
+        half = int(kernel_size / 2)
+
+        xx, yy = reference['wcs'].world_to_pixel_values(ra, dec)
+        x0 = max(int(xx) - int(cutout_size / 2) - half, 0)
+        y0 = max(int(yy) - int(cutout_size / 2) - half, 0)
+        x1 = min(int(xx) + int(cutout_size / 2) + 1 + half, reference['data'].shape[1])
+        y1 = min(int(yy) + int(cutout_size / 2) + 1 + half, reference['data'].shape[0])
+
+        self.image_name = os.path.basename(image_path)
+        self.image = reference['data'][y0:y1, x0:x1]
+        self.mask = reference['mask'][y0:y1, x0:x1]
+        self.wcs = reference['wcs']
+        self.origin = (x0, y0)
+        self.kernel_size = kernel_size
+        self.exptime = reference['exptime']
+
+        lcologs.log(
+            'DIA reference cutout of ' + repr(self.image.shape) + ' pixels at ' + repr(self.origin)
+            + ' in ' + self.image_name,
+            'info', log=log
+        )
+
+    def get_kernel_solver(self):
+        """
+        Return the ReferenceKernelSolver of the cutout for a constant delta-function kernel.  It is built once
+        per process, as the workers of the DIA stage receive a new copy of the reference with each image, and
+        only the solver of the last reference is kept
+        """
+
+        key = hashlib.md5(np.ascontiguousarray(self.image).tobytes()).hexdigest() + repr(
+            (self.image.shape, self.kernel_size))
+        if key not in kernel_solvers.keys():
+            kernel_solvers.clear()
+            kernel_solvers[key] = ReferenceKernelSolver(self.image, self.kernel_size)
+
+        return kernel_solvers[key]
+
+    def get_star_positions(self, ra, dec):
+        """
+        Return the indices and the positions in the difference image pixels of the stars within the cutout
+
+        Parameters
+        ----------
+        ra : array, the RA of the stars in degrees
+        dec : array, the Dec of the stars in degrees
+
+        Returns
+        -------
+        star_index : array, the indices of the stars within the cutout
+        positions : array, their x,y positions in the difference image
+        """
+
+        half = int(self.kernel_size / 2)
+        xx, yy = self.wcs.world_to_pixel_values(np.asarray(ra), np.asarray(dec))
+        xx = xx - self.origin[0] - half
+        yy = yy - self.origin[1] - half
+
+        ny, nx = self.image.shape[0] - 2 * half, self.image.shape[1] - 2 * half
+        within = (xx >= 0) & (xx <= nx - 1) & (yy >= 0) & (yy <= ny - 1)
+
+        return np.where(within)[0], np.c_[xx[within], yy[within]]
+
+    def get_sky_positions(self, x, y):
+        """
+        Return the sky positions of pixel positions in the difference image
+
+        Parameters
+        ----------
+        x, y : array, the x,y positions in the difference image
+
+        Returns
+        -------
+        ra, dec : array, the sky positions in degrees
+        """
+
+        half = int(self.kernel_size / 2)
+
+        return self.wcs.pixel_to_world_values(np.asarray(x) + self.origin[0] + half,
+                                              np.asarray(y) + self.origin[1] + half)
+
+def wcs_affine_transform(grid_wcs, grid_shape, frame_wcs, origin=(0, 0), npoints=5):
+    """
+    Compute the affine transform from the pixels of a grid to the pixels of a frame, from their WCS, sampled
+    on npoints x npoints positions over the grid
+
+    Parameters
+    ----------
+    grid_wcs : astropy.wcs, the WCS of the image the grid is cut from
+    grid_shape : tuple, the shape of the grid
+    frame_wcs : astropy.wcs, the WCS of the frame
+    origin : tuple, the x,y pixel position of the grid in the image of grid_wcs
+    npoints : int, the size of the sample of positions
+
+    Returns
+    -------
+    transform : skimage.transform.AffineTransform, the transform from grid to frame pixels
+    """
+
+    yy, xx = np.mgrid[0:grid_shape[0] - 1:npoints * 1j, 0:grid_shape[1] - 1:npoints * 1j]
+    ra, dec = grid_wcs.pixel_to_world_values(xx.ravel() + origin[0], yy.ravel() + origin[1])
+    x_frame, y_frame = frame_wcs.world_to_pixel_values(ra, dec)
+
+    design = np.c_[xx.ravel(), yy.ravel(), np.ones(xx.size)]
+    coeffs = np.linalg.lstsq(design, np.c_[x_frame, y_frame], rcond=None)[0]
+
+    matrix = np.eye(3)
+    matrix[:2, :] = coeffs.T
+
+    return tf.AffineTransform(matrix=matrix)
+
+def align_to_reference(image_wcs, reference, npoints=5):
+    """
+    Compute the affine transform from the pixels of the reference cutout to the pixels of an image, from their
+    WCS, sampled on a grid of npoints x npoints positions over the cutout
+
+    Parameters
+    ----------
+    image_wcs : astropy.wcs, the WCS of the image
+    reference : DIAReference, the reference cutout
+    npoints : int, the size of the grid of positions
+
+    Returns
+    -------
+    transform : skimage.transform.AffineTransform, the transform from reference cutout to image pixels
+    """
+
+    return wcs_affine_transform(reference.wcs, reference.image.shape, image_wcs, origin=reference.origin,
+                                npoints=npoints)
+
+def run_dia_epoch(image_path, reference, positions, options):
+    """
+    Difference image photometry of one image of a dataset against the reference cutout, for the DIA stage.
+    The image is aligned to the reference using the WCS of both images, and fails if it has no refined WCS.
+
+    Parameters
+    ----------
+    image_path : str, the path to the image
+    reference : DIAReference, the reference cutout
+    positions : array, the x,y positions of the stars in the difference image
+    options : dict, the 'kernel_size', 'solver', 'kernel_degree' and 'kernel_basis' of run_difference_image,
+              where a constant ('kernel_degree' 0) 'delta' kernel is solved with the ReferenceKernelSolver of
+              the reference whatever the 'solver',
+              the 'photometry' method, 'aperture' (default) with the aperture 'radius' in pixels or 'psf' with
+              run_dia_psf_photometry, and the reference PSF FWHM 'psf_fwhm' in pixels.  PSF fluxes are scaled
+              by the fraction of the kernel-convolved PSF within 'radius', to the units of the aperture fluxes.  If 'detect_threshold' is
+              set, transients are detected in the difference image with detect_transients
+
+    Returns
+    -------
+    result : dict, the image name ('file'), status ('status'), difference fluxes ('diff_flux', 'diff_flux_err'),
+             the sum of the kernel and its uncertainty ('kernel_sum', 'kernel_sum_err') and the transient
+             candidates ('candidates'), None if they were not searched for
+    """
+
+    result = {
+        'file': os.path.basename(image_path),
+        'status': 'OK',
+        'diff_flux': np.full(len(positions), np.nan),
+        'diff_flux_err': np.full(len(positions), np.nan),
+        'kernel_sum': np.nan,
+        'kernel_sum_err': np.nan,
+        'candidates': None
+    }
+
+    try:
+        image = load_dia_image(image_path)
+        if not image['wcs_refined']:
+            raise ValueError('No refined WCS, the astrometry of the image failed')
+        transform = align_to_reference(image['wcs'], reference)
+
+        # The transform matrix maps output (reference) to input (image) pixels, as the inverse map of tf.warp
+        aligned_image, aligned_variance = warp_layers([image['data'], image['errors']**2], transform.params,
+                                                      reference.image.shape, order=3)
+        aligned_mask = tf.warp(image['mask'].astype(float), transform.params, output_shape=reference.image.shape,
+                               order=1)
+        mask = reference.mask | (aligned_mask > 0)
+
+        # A constant delta-function kernel is solved against the reference factorized once per process
+        if options['kernel_degree'] == 0 and options['kernel_basis'] == 'delta':
+            outputs = reference.get_kernel_solver().solve(aligned_image, mask=mask)
+        else:
+            outputs = run_difference_image(
+                reference.image, aligned_image, options['kernel_size'], mask=mask, solver=options['solver'],
+                kernel_degree=options['kernel_degree'], kernel_basis=options['kernel_basis']
+            )
+        dia_image, image_model, dia_mask, kernel, bkg_coeffs, kernel_errors = outputs
+
+        # For a spatially varying kernel, the photometric scale is that of the kernel at the cutout center
+        if options['kernel_degree'] > 0:
+            kernel = kernel[0]
+            kernel_errors = kernel_errors[0]
+
+        half = int(options['kernel_size'] / 2)
+        dia_error = np.abs(aligned_variance[half:-half, half:-half])**0.5
+        if options.get('photometry', 'aperture') == 'psf':
+            phot_table = run_dia_psf_photometry(dia_image, dia_error, positions, options['psf_fwhm'],
+                                                kernel=kernel, mask=mask[half:-half, half:-half])
+
+            # Total PSF fluxes scaled to the aperture of the aperture photometry
+            fraction = psf_aperture_fraction(gaussian_psf(options['psf_fwhm'], kernel=kernel), options['radius'])
+        else:
+            phot_table = run_dia_photometry(dia_image, dia_error, positions, options['radius'])
+            fraction = 1.0
+
+        result['diff_flux'] = np.array(phot_table['aperture_sum']) * fraction
+        result['diff_flux_err'] = np.array(phot_table['aperture_sum_err']) * fraction
+        result['kernel_sum'] = float(kernel.sum())
+        result['kernel_sum_err'] = float(np.sqrt(np.nansum(kernel_errors**2)))
+
+        # The PSF of the difference image is that of the reference convolved by the kernel
+        if options.get('detect_threshold'):
+            result['candidates'] = detect_transients(
+                dia_image, aligned_variance[half:-half, half:-half],
+                gaussian_psf(options['psf_fwhm'], kernel=kernel), mask=mask[half:-half, half:-half],
+                threshold=options['detect_threshold']
+            )
+
+    except Exception as error:
+        result['status'] = 'DIA failed: ' + repr(error)
+
+    return result
+
+def store_dia_photometry(red_dir_path, result, star_index, log=None):
+    """
+    Save the difference image photometry of one image in parquet format, in the dia_flux directory.
+    Failed images are not stored, and any earlier photometry of them removed, so that they are processed again
+    by the next reduction.
+
+    Parameters
+    ----------
+    red_dir_path : str, the path to the reduction directory
+    result : dict, the output of run_dia_epoch
+    star_index : array, the indices of the photometered stars in the star catalog
+    """
+
+    dia_file = os.path.join(red_dir_path, 'dia_flux', result['file'] + '.parquet')
+    if result['status'] != 'OK':
+        if os.path.isfile(dia_file):
+            os.remove(dia_file)
+        lcologs.log('No DIA photometry stored for ' + result['file'] + ': ' + result['status'], 'warning', log=log)
+        return
+
+    nstars = len(star_index)
+    dia_table = pa.table({
+        'file': [result['file']] * nstars,
+        'star_index': np.asarray(star_index, dtype='int64'),
+        'diff_flux': result['diff_flux'],
+        'diff_flux_err': result['diff_flux_err'],
+        'kernel_sum': np.full(nstars, result['kernel_sum']),
+        'kernel_sum_err': np.full(nstars, result['kernel_sum_err'])
+    })
+    pq.write_table(dia_table, dia_file)
+
+    lcologs.log('Stored DIA photometry for ' + result['file'], 'info', log=log)
+
+def store_dia_candidates(red_dir_path, result, reference, index, radius, log=None):
+    """
+    Cross-match the transient candidates of one image with the star catalog and save them in parquet format,
+    in the dia_candidates directory
+
+    Parameters
+    ----------
+    red_dir_path : str, the path to the reduction directory
+    result : dict, the output of run_dia_epoch
+    reference : DIAReference, the reference cutout
+    index : SpatialIndex, the spatial index of the star catalog
+    radius : float, the cross-match radius in degrees
+    """
+
+    candidates = result['candidates']
+    ra, dec = reference.get_sky_positions(candidates['x'], candidates['y'])
+    if len(ra) > 0:
+        star_index, separation = index.query_nearest_sky(ra, dec, radius=radius)
+    else:
+        star_index, separation = np.array([], dtype=int), np.array([])
+
+    candidate_table = pa.table({
+        'file': [result['file']] * len(ra),
+        'x': np.asarray(candidates['x'], dtype=float),
+        'y': np.asarray(candidates['y'], dtype=float),
+        'ra': np.asarray(ra, dtype=float),
+        'dec': np.asarray(dec, dtype=float),
+        'flux': np.asarray(candidates['flux'], dtype=float),
+        'flux_err': np.asarray(candidates['flux_err'], dtype=float),
+        'snr': np.asarray(candidates['snr'], dtype=float),
+        'star_index': np.asarray(star_index, dtype='int64'),
+        'separation': np.asarray(separation, dtype=float)
+    })
+    pq.write_table(candidate_table, os.path.join(red_dir_path, 'dia_candidates', result['file'] + '.parquet'))
+
+    lcologs.log(
+        'Stored ' + str(len(ra)) + ' transient candidates for ' + result['file'] + ', '
+        + str(int((np.asarray(star_index) < 0).sum())) + ' without a catalog counterpart',
+        'info', log=log
+    )
+
+def compute_dia_flux(dia_flux, obs_set, nstars, reference_flux, reference_exptime):
+    """
+    Compute the DIA flux timeseries of all stars, in the flux units of the reference aperture photometry,
+    as the reference flux plus the difference flux scaled to the reference by the kernel sum.
+    Stars outside the DIA cutout or images without DIA photometry are NaN.
+
+    Parameters
+    ----------
+    dia_flux : Table, the DIA photometry of all images, as loaded by parquet.load_dia_flux
+    obs_set : ObservationSet, the images of the dataset
+    nstars : int, the number of stars in the star catalog
+    reference_flux : array, the aperture flux of all stars in the reference image
+    reference_exptime : float, the exposure time of the reference image
+
+    Returns
+    -------
+    flux : array, the flux of the stars, of shape (nstars, nimages)
+    flux_err : array, the uncertainties of the flux
+    """
 
-    line = 0
-    for i in range(n - q + 1):
-        for j in range(n - q + 1):
+    flux = np.full((nstars, len(obs_set.table)), np.nan)
+    flux_err = np.full((nstars, len(obs_set.table)), np.nan)
 
-            indi[line] = iii[i:i + q, j:j + q].ravel()
-            indj[line] = jjj[i:i + q, j:j + q].ravel()
-            line += 1
+    files = list(obs_set.table['file'])
+    image_index = np.array([files.index(f) if f in files else -1 for f in dia_flux['file']])
+    star_index = np.array(dia_flux['star_index'])
+    valid = image_index >= 0
 
-    return indi.astype(int), indj.astype(int)
+    scale = np.array(dia_flux['kernel_sum']) * reference_exptime
+    flux[star_index[valid], image_index[valid]] = (np.asarray(reference_flux)[star_index[valid]]
+                                                   + np.array(dia_flux['diff_flux'])[valid] / scale[valid])
+    flux_err[star_index[valid], image_index[valid]] = np.abs(np.array(dia_flux['diff_flux_err'])[valid]
+                                                             / scale[valid])
 
+    return flux, flux_err
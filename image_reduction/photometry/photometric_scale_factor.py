@@ -1,17 +1,69 @@
+import os
 import numpy as np
-import copy
+from scipy import sparse
+from scipy.sparse.linalg import LinearOperator, lsqr
 import image_reduction.infrastructure.logs as lcologs
 import matplotlib.pyplot as plt
 
-def photometric_scale_factor_from_lightcurves(lcs, mask, dataset, log=None, debug=False):
+def get_block_slices(nitems, nvalues, memory_limit=256*1024**2):
+    """
+    Slices of the blocks of items (stars or epochs) processed at once, so that the float64 values of a block,
+    and the temporary arrays of its processing, fit within memory_limit bytes
+
+    Parameters
+    ----------
+    nitems : int, the number of items
+    nvalues : int, the number of values of each item
+    memory_limit : int, the maximum memory in bytes used by a block
+
+    Returns
+    -------
+    blocks : list, the slices of the blocks
+    """
+
+    # Allow for the temporary copies made by the percentile and median calculations
+    block_size = max(1, int(memory_limit // (nvalues * 8 * 4)))
+
+    return [slice(i, min(i + block_size, nitems)) for i in range(0, nitems, block_size)]
+
+def reference_median_flux(lcs, stars=None, memory_limit=256*1024**2):
+    """
+    Median flux of each lightcurve, excluding NaN and faint or negative flux entries
+
+    Parameters
+    ----------
+    lcs : array, an array containing all the lightcurves
+    stars : array, [optional] the boolean selection of the lightcurves, by default all
+    memory_limit : int, the maximum memory in bytes used by a block of lightcurves
+
+    Returns
+    -------
+    median_flux : array, the median flux of each selected star
+    """
+
+    rows = np.arange(lcs.shape[0]) if stars is None else np.flatnonzero(stars)
+    median_flux = np.zeros(len(rows))
+
+    for block in get_block_slices(len(rows), lcs.shape[1], memory_limit=memory_limit):
+        block_lcs = lcs[rows[block]]
+        median_flux[block] = np.nanmedian(np.where(block_lcs > 10.0, block_lcs, np.nan), axis=1)
+
+    return median_flux
+
+def photometric_scale_factor_from_lightcurves(lcs, mask, dataset, log=None, debug=False, median_flux=None,
+                                              stars=None, memory_limit=256*1024**2):
     """
     Estimate the 16,50,84 percentiles of the photometric scale factor, define as the median(flux)/flux for each
     epoch and stars.
+    The epochs are processed in blocks, so that only a block of the normalized lightcurves is held in memory.
 
     Parameters
     ----------
     lcs : array, an array containing all the lightcurves
     log: logger object
+    median_flux : array, [optional] the median flux of each star, by default that of the lightcurves
+    stars : array, [optional] the boolean selection of the lightcurves used, by default all
+    memory_limit : int, the maximum memory in bytes used by a block of epochs
 
     Returns
     -------
@@ -19,18 +71,18 @@ def photometric_scale_factor_from_lightcurves(lcs, mask, dataset, log=None, debu
     epscales: 2D array, uncertainties of the photometric scale factor
     """
 
-    # Exclude NaN and negative flux entries
-    valid = np.logical_and(~np.isnan(lcs), lcs > 10.0)
-    lcs_cleaned = lcs.astype(float).copy()
-    lcs_cleaned[~valid] = np.nan
+    rows = slice(None) if stars is None else np.flatnonzero(stars)
+    if median_flux is None:
+        median_flux = reference_median_flux(lcs, stars=stars, memory_limit=memory_limit)
 
-    median_flux = np.nanmedian(lcs_cleaned, axis=1)[:, None]
-    norm_lc = lcs/median_flux
-
-    pscales = np.nanpercentile(norm_lc,[16,50,84], axis=0)
-    ps = np.tile(pscales[1], (lcs.shape[0], 1))
-    #epscales = (pscales[2] - pscales[0]) / 2
-    epscales = np.nanmedian(abs(norm_lc - ps), axis=0)
+    nepochs = lcs.shape[1]
+    pscales = np.zeros((3, nepochs))
+    epscales = np.zeros(nepochs)
+    for block in get_block_slices(nepochs, len(median_flux), memory_limit=memory_limit):
+        norm_lc = lcs[rows, block] / median_flux[:, None]
+        pscales[:, block] = np.nanpercentile(norm_lc, [16, 50, 84], axis=0)
+        #epscales = (pscales[2] - pscales[0]) / 2
+        epscales[block] = np.nanmedian(np.abs(norm_lc - pscales[1, block]), axis=0)
 
     if debug:
         lcologs.log('PSCALE values: ' + repr(pscales), 'info', log=log)
@@ -38,7 +90,8 @@ def photometric_scale_factor_from_lightcurves(lcs, mask, dataset, log=None, debu
 
         fig, ax = plt.subplots()
         im = 1
-        ax.hist(norm_lc[:,im], bins=200, edgecolor='black')
+        norm_lc = lcs[rows, im] / median_flux
+        ax.hist(norm_lc, bins=200, edgecolor='black')
         ylim = ax.get_ylim()
         ax.set_xlim([0,10])
         ax.plot([pscales[1,im]-epscales[im]]*2, ylim, 'c-')
@@ -53,7 +106,7 @@ def photometric_scale_factor_from_lightcurves(lcs, mask, dataset, log=None, debu
         fig, ax = plt.subplots()
         scatter = ax.scatter(
             x=dataset.sources['x'][mask], y=dataset.sources['y'][mask],
-            c=norm_lc[:,im], cmap='PuBuGn', s=5,
+            c=norm_lc, cmap='PuBuGn', s=5,
             vmin=0.0, vmax=2.0
         )
         cb = plt.colorbar(scatter)
@@ -65,54 +118,103 @@ def photometric_scale_factor_from_lightcurves(lcs, mask, dataset, log=None, debu
 
     return pscales, epscales
 
-def calculate_pscale(ref_image, obs_set, dataset, log=None, debug=True):
+class PscaleReference(object):
     """
-    Function to compute the pscale factor for a set of aperture photometry catalogs
+    Persistent state of the photometric scale factor calculation of a dataset, so that the scale factors of
+    newly added images can be computed against the same comparison stars and median fluxes
+
+    Attributes
+    ----------
+    ref_image : str, the name of the reference image
+    files : array, the names of the images with a scale factor
+    mask : array, the boolean selection of comparison stars in the star catalog
+    median_flux : array, the median flux of the comparison stars
+    pscales : array, the 16,50,84 percentiles of the scale factors of the images
+    epscales : array, the uncertainties of the scale factors of the images
+    shift : array, the estimated relative drift of the median flux of each comparison star since the last
+            full calculation
+    """
+
+    def __init__(self, file_path=None, log=None):
+
+        self.ref_image = None
+        self.files = np.array([], dtype=str)
+        self.mask = None
+        self.median_flux = None
+        self.pscales = None
+        self.epscales = None
+        self.shift = None
+
+        if file_path:
+            if os.path.isfile(file_path):
+                self.load(file_path, log=log)
+            else:
+                lcologs.log('No photometric scale factor reference found at ' + file_path, 'info', log=log)
+
+    def load(self, file_path, log=None):
+
+        with np.load(file_path) as data:
+            self.ref_image = str(data['ref_image'])
+            self.files = data['files']
+            self.mask = data['mask']
+            self.median_flux = data['median_flux']
+            self.pscales = data['pscales']
+            self.epscales = data['epscales']
+            self.shift = data['shift']
+        lcologs.log('Loaded photometric scale factors of ' + str(len(self.files)) + ' images from ' + file_path,
+                    'info', log=log)
+
+    def save(self, file_path, log=None):
+
+        np.savez(file_path, ref_image=self.ref_image, files=self.files, mask=self.mask,
+                 median_flux=self.median_flux, pscales=self.pscales, epscales=self.epscales, shift=self.shift)
+        lcologs.log('Saved photometric scale factors to ' + file_path, 'info', log=log)
+
+    def is_valid_for(self, ref_image, nstars, image_set):
+        """
+        Verify that the stored scale factors apply to the dataset: same reference and star catalog, and all
+        stored images still in the dataset
+        """
+
+        return (self.mask is not None and self.ref_image == ref_image and len(self.mask) == nstars
+                and set(self.files).issubset(image_set))
+
+def select_comparison_stars(dataset, lcs, elcs, log=None, memory_limit=256*1024**2):
+    """
+    Function to select the comparison stars of the photometric scale factor: stars close to the center of the
+    frame, with the highest numbers of datapoints of reasonable SNR
 
     Params
     ------
-    ref_image string Name of reference image
-    obs_set ObservationSet  Set of images in the dataset
     dataset AperturePhotometryDataset
+    lcs, elcs array     Fluxes and uncertainties for all stars in all images
+    memory_limit int    Maximum memory in bytes used by a block of epochs
 
     Return
     ------
-    pscsales, epscales array    Photometric scale factors and errors for all images
-    flux, err_flux      array   Fluxes for all stars in all images
+    mask array  Boolean selection of the comparison stars
     """
 
-    lcologs.log('Computing photometric scale factors', 'info', log=log)
-
-    # Image list used to synchronise the references to each image
-    # The first non-None image photometry catalog in the dictionary is used as the
-    # reference by default.
-    image_set = [str(image) for image in obs_set.table['file']]
-    ref_idx = image_set.index(ref_image)
-    lcologs.log('Using image number ' + str(ref_idx) + ', (' + obs_set.table['file'][ref_idx] + ') as reference', 'info', log=log)
-
-    # Collate the timeseries photometry for all stars into a single array.
-    lcs = copy.deepcopy(dataset.raw_flux)
-    elcs = copy.deepcopy(dataset.raw_err_flux)
-
     # Select datapoints that have a reasonable SNR to avoid high uncertainty on the pscale factor,
     # and those close to the center of the image, since the wings of the frame tend to have
     # larger residuals.
     SNR = 10
-    valid = (np.abs(elcs / lcs) < 1 / SNR) & (lcs > 0)
-
     xcenter = dataset.sources['x'].max() / 2.0
     ycenter = dataset.sources['y'].max() / 2.0
     pix_radius = 1000
     separations = np.sqrt((dataset.sources['x'] - xcenter) ** 2 \
                           + (dataset.sources['y'] - ycenter) ** 2)
-    central_mask = separations <= pix_radius
-    central = np.repeat(central_mask[:, np.newaxis], valid.shape[1], axis=1)
-    valid = np.logical_and(valid, central)
+    central_mask = np.asarray(separations <= pix_radius)
 
     # Select the stars with the highest number of valid datapoints.
     # (This works because Python interprets Booleans and 1, 0)
-    # Count the number of valid datapoints per star
-    nvalid = valid.sum(axis=1)
+    # Count the number of valid datapoints per star, one block of epochs at a time
+    nvalid = np.zeros(lcs.shape[0], dtype=int)
+    for block in get_block_slices(lcs.shape[1], lcs.shape[0], memory_limit=memory_limit):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            valid = (np.abs(elcs[:, block] / lcs[:, block]) < 1 / SNR) & (lcs[:, block] > 0)
+        nvalid += valid.sum(axis=1)
+    nvalid[~central_mask] = 0
 
     # Set the threshold number of valid points to require from a 75% percentile of the
     # maximum
@@ -126,15 +228,115 @@ def calculate_pscale(ref_image, obs_set, dataset, log=None, debug=True):
         'info', log=log
     )
 
-    # Compute the phot scale based on <950 stars
-    pscales, epscales = photometric_scale_factor_from_lightcurves(lcs[mask], mask, dataset, log=log, debug=True)
+    return mask
+
+def calculate_pscale(ref_image, obs_set, dataset, log=None, debug=True, reference_path=None, drift_threshold=0.01,
+                     recompute=False, memory_limit=256*1024**2):
+    """
+    Function to compute the pscale factor for a set of aperture photometry catalogs
+
+    If reference_path is given, the comparison stars, their median fluxes and the scale factors are stored there.
+    On later calls, only the scale factors of the images added since are computed, against the stored median
+    fluxes, so that the cost is proportional to the number of new images.  The median flux of each comparison
+    star is not updated, but the drift the new images would cause is estimated, as the median deviation of the
+    star from its scale-corrected median flux in the new images, weighted by their fraction of all images.
+    All scale factors are recomputed when the mean absolute drift of the comparison stars, accumulated since the
+    last full calculation, exceeds drift_threshold, or if recompute is set.
+
+    The lightcurves are processed in blocks of epochs sized to memory_limit, so that apart from the input and
+    output flux arrays, the memory used does not scale with the size of the dataset.
 
-    # Now apply the photometric scale factor to all star lightcurve
-    flux = np.zeros(dataset.raw_flux.shape)
-    dataset.flux = lcs / pscales[1]
-    ps = np.tile(pscales[1], (lcs.shape[0], 1))
-    eps = np.tile(epscales, (lcs.shape[0], 1))
-    dataset.flux_err = (elcs ** 2 / pscales[1] ** 2 + lcs ** 2 * epscales ** 2 / pscales[1] ** 4) ** 0.5
+    Params
+    ------
+    ref_image string Name of reference image
+    obs_set ObservationSet  Set of images in the dataset
+    dataset AperturePhotometryDataset
+    reference_path string [optional] Path to the stored PscaleReference of the dataset
+    drift_threshold float Maximum mean absolute relative drift of the comparison star median fluxes
+    recompute bool  Recompute all scale factors, e.g. when the photometry of stored images has changed
+    memory_limit int    Maximum memory in bytes used by a block of epochs
+
+    Return
+    ------
+    pscsales, epscales array    Photometric scale factors and errors for all images
+    flux, err_flux      array   Fluxes for all stars in all images
+    """
+
+    lcologs.log('Computing photometric scale factors', 'info', log=log)
+
+    # Image list used to synchronise the references to each image
+    # The first non-None image photometry catalog in the dictionary is used as the
+    # reference by default.
+    image_set = [str(image) for image in obs_set.table['file']]
+    ref_idx = image_set.index(ref_image)
+    lcologs.log('Using image number ' + str(ref_idx) + ', (' + obs_set.table['file'][ref_idx] + ') as reference', 'info', log=log)
+
+    # Timeseries photometry for all stars, read but not modified
+    lcs = dataset.raw_flux
+    elcs = dataset.raw_err_flux
+
+    reference = PscaleReference(file_path=reference_path, log=log)
+    full = recompute or not reference.is_valid_for(ref_image, lcs.shape[0], image_set)
+
+    if not full:
+        stored = {f: i for i, f in enumerate(reference.files)}
+        new = np.array([f not in stored for f in image_set])
+        lcologs.log('Computing photometric scale factors of ' + str(new.sum()) + ' new images', 'info', log=log)
+
+        pscales = np.zeros((3, len(image_set)))
+        epscales = np.zeros(len(image_set))
+        old_idx = [stored[f] for f in np.array(image_set)[~new]]
+        pscales[:, ~new] = reference.pscales[:, old_idx]
+        epscales[~new] = reference.epscales[old_idx]
+
+        if new.any():
+            comparison = lcs[np.ix_(reference.mask, new)]
+            pscales[:, new], epscales[new] = photometric_scale_factor_from_lightcurves(
+                comparison, reference.mask, dataset, log=log, median_flux=reference.median_flux,
+                memory_limit=memory_limit
+            )
+
+            # Drift of the median flux of each comparison star caused by the new images
+            deviations = comparison / reference.median_flux[:, None] / pscales[1, new] - 1.0
+            with np.errstate(invalid='ignore'):
+                shift = np.nanmedian(deviations, axis=1) * new.sum() / len(image_set)
+            reference.shift = reference.shift + np.nan_to_num(shift)
+            drift = np.mean(np.abs(reference.shift))
+            lcologs.log('Estimated drift of the comparison star median fluxes: ' + str(drift), 'info', log=log)
+
+            if drift > drift_threshold:
+                lcologs.log('Drift exceeds ' + str(drift_threshold) + ', recomputing all photometric scale factors',
+                            'info', log=log)
+                full = True
+
+    if full:
+        mask = select_comparison_stars(dataset, lcs, elcs, log=log, memory_limit=memory_limit)
+        median_flux = reference_median_flux(lcs, stars=mask, memory_limit=memory_limit)
+
+        # Compute the phot scale based on <950 stars
+        pscales, epscales = photometric_scale_factor_from_lightcurves(lcs, mask, dataset, log=log, debug=debug,
+                                                                      median_flux=median_flux, stars=mask,
+                                                                      memory_limit=memory_limit)
+
+        reference.ref_image = ref_image
+        reference.mask = mask
+        reference.median_flux = median_flux
+        reference.shift = np.zeros(mask.sum())
+
+    if reference_path:
+        reference.files = np.array(image_set)
+        reference.pscales = pscales
+        reference.epscales = epscales
+        reference.save(reference_path, log=log)
+
+    # Now apply the photometric scale factor to all star lightcurve, one block of epochs at a time
+    dataset.flux = np.zeros(lcs.shape)
+    dataset.flux_err = np.zeros(lcs.shape)
+    for block in get_block_slices(lcs.shape[1], lcs.shape[0], memory_limit=memory_limit):
+        ps = pscales[1, block]
+        dataset.flux[:, block] = lcs[:, block] / ps
+        dataset.flux_err[:, block] = (elcs[:, block] ** 2 / ps ** 2
+                                      + lcs[:, block] ** 2 * epscales[block] ** 2 / ps ** 4) ** 0.5
     dataset.pscales = pscales
     dataset.epscales = epscales
 
@@ -142,8 +344,8 @@ def calculate_pscale(ref_image, obs_set, dataset, log=None, debug=True):
         fig, axs = plt.subplots(nrows=1, ncols=2, figsize=(10, 5))
         plt.subplots_adjust(left=0.1, right=0.95, wspace=0.2)
         im = 0
-        axs[0].hist((elcs / lcs)[:,im], bins=100, range=(-2,2), edgecolor='green', facecolor='green')
-        med = np.nanmedian((elcs / lcs)[:,im])
+        axs[0].hist(elcs[:,im] / lcs[:,im], bins=100, range=(-2,2), edgecolor='green', facecolor='green')
+        med = np.nanmedian(elcs[:,im] / lcs[:,im])
         ylim = axs[0].get_ylim()
         axs[0].plot([(epscales[im]/pscales[1,im])]*2, ylim, 'k-', label='$\\sigma_{PS}/PS$')
         axs[0].plot([med]*2, ylim, 'm-.', label='Median $\\sigma_{f}/f$')
@@ -152,8 +354,8 @@ def calculate_pscale(ref_image, obs_set, dataset, log=None, debug=True):
         axs[0].set_title('Fractional flux errors for image ' + str(im))
         axs[0].legend()
 
-        flux_frac = [np.nanmedian((elcs / lcs)[:,im]) for im in range(0,lcs.shape[1],1)]
-        eps_frac = [np.nanmedian(epscales[im]/pscales[1,im]) for im in range(0,lcs.shape[1],1)]
+        flux_frac = [np.nanmedian(elcs[:,im] / lcs[:,im]) for im in range(0,lcs.shape[1],1)]
+        eps_frac = epscales / pscales[1]
         axs[1].plot(flux_frac, eps_frac, 'bd')
         xlim = axs[1].get_xlim()
         ylim = axs[1].get_ylim()
@@ -167,3 +369,179 @@ def calculate_pscale(ref_image, obs_set, dataset, log=None, debug=True):
         plt.savefig('lightcurve_phot_uncertainties.png')
 
     return dataset
+
+def get_spatial_terms(x, y, degree):
+    """
+    Polynomial terms x^a * y^b of total degree 1 to degree, of normalized pixel positions
+
+    Parameters
+    ----------
+    x, y : array, the pixel positions normalized to [-1, 1]
+    degree : int, the maximum degree of the terms, 0 for none
+
+    Returns
+    -------
+    terms : array, of shape (len(x), number of terms)
+    """
+
+    terms = [x**a * y**(order - a) for order in range(1, degree + 1) for a in range(order, -1, -1)]
+
+    return np.array(terms).reshape(len(terms), len(x)).T
+
+def calculate_ensemble_pscale(ref_image, obs_set, dataset, log=None, spatial_degree=0, snr=10.0, error_floor=0.001,
+                              clip=5.0, niter=5, tol=1e-8, memory_limit=256*1024**2):
+    """
+    Function to compute the photometric scale factors by ensemble photometry, as an alternative to calculate_pscale.
+    Rather than normalizing each image by the median flux ratio of a subset of stars, the zero point of every
+    image and the mean flux of every star are solved for jointly, from all measurements of sufficient SNR:
+
+        log(flux_ij) = log(F_i) + z_j [+ spatial polynomial of the star position, per image]
+
+    The problem is posed as a weighted sparse linear least-squares problem, with the design matrix preconditioned
+    by the norm of its columns, and solved iteratively with LSQR.  Measurements deviating by more than clip times
+    the robust standard deviation of the normalized residuals are rejected, and the problem solved again starting
+    from the previous solution, until no more measurements are rejected or for niter iterations.
+    The zero points and spatial terms are relative to those of the reference image.
+
+    Params
+    ------
+    ref_image string Name of reference image
+    obs_set ObservationSet  Set of images in the dataset
+    dataset AperturePhotometryDataset
+    spatial_degree int  Degree of the spatial polynomial of the zero point of each image, 0 for a constant
+    snr float   Minimum signal-to-noise ratio of the measurements used
+    error_floor float   Relative uncertainty added in quadrature to that of each measurement
+    clip float  Outlier rejection threshold, in units of the robust standard deviation of the residuals
+    niter int   Maximum number of rejection iterations
+    tol float   Relative tolerance of the LSQR solution
+    memory_limit int    Maximum memory in bytes used by a block of epochs
+
+    Return
+    ------
+    dataset AperturePhotometryDataset, with the corrected fluxes and their uncertainties, the photometric scale
+        factors of the images at the center of the frame between the 16 and 84 percentiles of the scale factors
+        implied by the individual stars, their uncertainties, and the spatial terms of the images
+    """
+
+    lcologs.log('Computing photometric scale factors by ensemble photometry', 'info', log=log)
+
+    image_set = [str(image) for image in obs_set.table['file']]
+    ref_idx = image_set.index(ref_image)
+    lcs = dataset.raw_flux
+    elcs = dataset.raw_err_flux
+    nstars, nepochs = lcs.shape
+
+    # Spatial terms from the star positions normalized to [-1, 1]
+    positions = []
+    for axis in ['x', 'y']:
+        pos = np.asarray(dataset.sources[axis], dtype=float)
+        positions.append(2.0 * (pos - pos.min()) / max(np.ptp(pos), 1.0) - 1.0)
+    terms = get_spatial_terms(positions[0], positions[1], spatial_degree)
+    nterms = terms.shape[1]
+
+    # Gather the valid measurements in log flux, one block of epochs at a time, ordered by epoch
+    stars, epochs, values, weights = [], [], [], []
+    for block in get_block_slices(nepochs, nstars, memory_limit=memory_limit):
+        flux = lcs[:, block].T
+        err = elcs[:, block].T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            valid = np.isfinite(flux) & np.isfinite(err) & (err > 0) & (flux > snr * err)
+        epoch_idx, star_idx = np.nonzero(valid)
+        stars.append(star_idx)
+        epochs.append(epoch_idx + block.start)
+        values.append(np.log(flux[valid]))
+        weights.append(1.0 / np.sqrt((err[valid] / flux[valid])**2 + error_floor**2))
+    stars = np.concatenate(stars)
+    epochs = np.concatenate(epochs)
+    values = np.concatenate(values)
+    weights = np.concatenate(weights)
+    nmeas = len(values)
+
+    # Sparse design matrix, with a mean flux column per star, then a zero point column and nterms spatial
+    # columns per image.  The zero points and spatial terms are degenerate with the mean fluxes, and the minimum
+    # norm solution of LSQR is shifted to the reference image afterwards.
+    nnz = 2 + nterms
+    ncols = nstars + nepochs * (1 + nterms)
+    indices = np.empty((nmeas, nnz), dtype=np.int64)
+    indices[:, 0] = stars
+    indices[:, 1] = nstars + epochs
+    indices[:, 2:] = nstars + nepochs + epochs[:, None] * nterms + np.arange(nterms)
+    data = np.ones((nmeas, nnz))
+    data[:, 2:] = terms[stars]
+    design = sparse.csr_matrix((data.ravel(), indices.ravel(), np.arange(0, nmeas * nnz + 1, nnz)),
+                               shape=(nmeas, ncols))
+    del data, indices
+    squared = design.copy()
+    squared.data **= 2
+
+    # Start from the weighted mean log flux of each star
+    solution = np.zeros(ncols)
+    with np.errstate(invalid='ignore'):
+        solution[:nstars] = np.nan_to_num(np.bincount(stars, weights=weights**2 * values, minlength=nstars)
+                                          / np.bincount(stars, weights=weights**2, minlength=nstars))
+
+    use = np.ones(nmeas, dtype=bool)
+    for iteration in range(niter + 1):
+        # Rejected measurements are given a zero weight, and the columns scaled to unit norm.  The weighted
+        # matrix is applied as an operator, so that it is not copied
+        row_weights = np.where(use, weights, 0.0)
+        column_norm = np.sqrt(squared.T @ row_weights**2)
+        column_scale = 1.0 / np.where(column_norm > 0, column_norm, 1.0)
+        matrix = LinearOperator(
+            (nmeas, ncols), dtype=float,
+            matvec=lambda x: row_weights * (design @ (column_scale * x.ravel())),
+            rmatvec=lambda y: column_scale * (design.T @ (row_weights * y.ravel()))
+        )
+
+        result = lsqr(matrix, row_weights * values, atol=tol, btol=tol, iter_lim=10 * ncols,
+                      x0=solution / column_scale)
+        solution = result[0] * column_scale
+
+        chi = (values - design @ solution) * weights
+        sigma = 1.4826 * np.median(np.abs(chi[use]))
+        new_use = np.abs(chi) <= clip * sigma
+        lcologs.log('Ensemble photometry iteration ' + str(iteration) + ': ' + str(result[2])
+                    + ' LSQR iterations, ' + str(use.sum()) + ' of ' + str(nmeas)
+                    + ' measurements used, robust residual ' + str(sigma), 'info', log=log)
+        if np.array_equal(new_use, use) or iteration == niter:
+            break
+        use = new_use
+
+    # Zero points and spatial terms relative to the reference image, undefined for images without measurements
+    zero_points = solution[nstars:nstars + nepochs]
+    spatial = solution[nstars + nepochs:].reshape(nepochs, nterms)
+    nused = np.bincount(epochs[use], minlength=nepochs)
+    undefined = nused <= nterms
+    zero_points[undefined] = np.nan
+    spatial[undefined] = np.nan
+    ref_epoch = ref_idx if not undefined[ref_idx] else np.flatnonzero(~undefined)[0]
+    zero_points = zero_points - zero_points[ref_epoch]
+    spatial = spatial - spatial[ref_epoch]
+
+    # Distribution of the scale factor of each image implied by each star, at the center of the frame
+    pscales = np.exp(zero_points)
+    star_pscales = pscales[epochs[use]] * np.exp(chi[use] / weights[use])
+    bounds = np.concatenate(([0], np.cumsum(nused)))
+    percentiles = np.full((3, nepochs), np.nan)
+    epscales = np.full(nepochs, np.nan)
+    for j in np.flatnonzero(~undefined):
+        epoch_pscales = star_pscales[bounds[j]:bounds[j + 1]]
+        percentiles[:, j] = np.percentile(epoch_pscales, [16, 50, 84])
+        epscales[j] = np.median(np.abs(epoch_pscales - pscales[j]))
+    lcologs.log('PSCALE values: ' + repr(pscales), 'info', log=log)
+    lcologs.log('PSCALE uncertainties: ' + repr(epscales), 'info', log=log)
+
+    # Now apply the photometric correction to all star lightcurves, one block of epochs at a time
+    dataset.flux = np.zeros(lcs.shape)
+    dataset.flux_err = np.zeros(lcs.shape)
+    for block in get_block_slices(nepochs, nstars, memory_limit=memory_limit):
+        correction = np.exp(zero_points[block] + terms @ spatial[block].T)
+        dataset.flux[:, block] = lcs[:, block] / correction
+        dataset.flux_err[:, block] = (elcs[:, block] ** 2
+                                      + lcs[:, block] ** 2 * (epscales[block] / pscales[block]) ** 2) ** 0.5 \
+                                     / correction
+    dataset.pscales = np.r_[percentiles[:1], pscales[None, :], percentiles[2:]]
+    dataset.epscales = epscales
+    dataset.pscale_spatial = spatial
+
+    return dataset
@@ -0,0 +1,247 @@
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+from astropy.table import Table
+from skimage import transform as tf
+
+from image_reduction.infrastructure import logs as lcologs
+from image_reduction.infrastructure.data_classes import ObservationSet
+from image_reduction.photometry import dia_photometry as lcodia
+
+# Mask values of the stamp cube
+BAD_PIXEL = 1
+OUT_OF_FRAME = 2
+
+def get_stamp_origins(reference_wcs, targets, size):
+    """
+    Function to compute the origins in the reference image of the stamps centered on a set of targets
+
+    Parameters
+    ----------
+    reference_wcs : astropy.wcs, the refined WCS of the reference image
+    targets : array, the RA, Dec of the targets in degrees, one row per target
+    size : int, the size of the stamps in pixels
+
+    Returns
+    -------
+    origins : array, the x,y pixel positions of the stamp corners in the reference image, one row per target
+    """
+
+    targets = np.atleast_2d(targets)
+    xx, yy = reference_wcs.world_to_pixel_values(targets[:, 0], targets[:, 1])
+
+    return np.c_[np.floor(xx + 0.5) - size // 2, np.floor(yy + 0.5) - size // 2].astype(int)
+
+def extract_frame_stamps(image_path, reference_wcs, origins, size):
+    """
+    Function to extract the stamps of all targets from one frame, aligned to the pixel grid of the reference
+    image using the refined WCS of both images.  Only the section of the frame covered by each stamp is read
+    and interpolated.
+
+    Parameters
+    ----------
+    image_path : str, the path to the frame
+    reference_wcs : astropy.wcs, the refined WCS of the reference image
+    origins : array, the origins of the stamps in the reference image, from get_stamp_origins
+    size : int, the size of the stamps in pixels
+
+    Returns
+    -------
+    stamps : dict, the image name ('file'), status ('status') and the science ('sci'), error ('err') and mask
+             ('mask') stamps, of shape (ntargets, size, size).  The stamps of a frame without a refined WCS are
+             masked as OUT_OF_FRAME
+    """
+
+    ntargets = len(origins)
+    stamps = {
+        'file': os.path.basename(image_path),
+        'status': 'OK',
+        'sci': np.zeros((ntargets, size, size), dtype=np.float32),
+        'err': np.zeros((ntargets, size, size), dtype=np.float32),
+        'mask': np.full((ntargets, size, size), OUT_OF_FRAME, dtype=np.uint8)
+    }
+
+    try:
+        with fits.open(image_path, memmap=True) as hdulist:
+            names = [hdu.name for hdu in hdulist]
+            data = hdulist[names.index('SCI')].data if 'SCI' in names else hdulist[0].data
+            errors = hdulist[names.index('ERR')].data if 'ERR' in names else None
+            bpm = hdulist[names.index('BPM')].data if 'BPM' in names else None
+            frame_wcs, refined = lcodia.get_refined_wcs(hdulist)
+            if not refined:
+                stamps['status'] = 'No refined WCS'
+                return stamps
+            ny, nx = data.shape
+
+            corners = np.array([[0, 0], [size - 1, 0], [0, size - 1], [size - 1, size - 1]], dtype=float)
+            for i, origin in enumerate(origins):
+                transform = lcodia.wcs_affine_transform(reference_wcs, (size, size), frame_wcs, origin=origin)
+
+                # Section of the frame covered by the stamp, with a margin for the cubic interpolation
+                frame_corners = transform(corners)
+                x0 = max(int(np.floor(frame_corners[:, 0].min())) - 3, 0)
+                y0 = max(int(np.floor(frame_corners[:, 1].min())) - 3, 0)
+                x1 = min(int(np.ceil(frame_corners[:, 0].max())) + 4, nx)
+                y1 = min(int(np.ceil(frame_corners[:, 1].max())) + 4, ny)
+                if x1 <= x0 or y1 <= y0:
+                    continue
+
+                section = np.eye(3)
+                section[:2, 2] = [-x0, -y0]
+                inverse_map = section @ transform.params
+
+                sci = np.asarray(data[y0:y1, x0:x1], dtype=float)
+                err = np.asarray(errors[y0:y1, x0:x1], dtype=float) if errors is not None else np.abs(sci)**0.5
+                sci, variance = lcodia.warp_layers([sci, err**2], inverse_map, (size, size), order=3)
+
+                coverage = tf.warp(np.ones((y1 - y0, x1 - x0)), inverse_map, output_shape=(size, size), order=1,
+                                   cval=0.0)
+                mask = np.where(coverage < 0.999, OUT_OF_FRAME, 0).astype(np.uint8)
+                if bpm is not None:
+                    bad = tf.warp((np.asarray(bpm[y0:y1, x0:x1]) > 0).astype(float), inverse_map,
+                                  output_shape=(size, size), order=1) > 0
+                    mask[bad & (mask == 0)] = BAD_PIXEL
+
+                stamps['sci'][i] = sci
+                stamps['err'][i] = np.abs(variance)**0.5
+                stamps['mask'][i] = mask
+
+    except Exception as error:
+        stamps['status'] = 'Extraction failed: ' + repr(error)
+
+    return stamps
+
+def extract_stamp_cube(red_dir, targets, size=64, reference_image=None, output_dir=None, nprocess=1, log=None):
+    """
+    Function to extract aligned stamps around a set of targets from all frames of a dataset into memory-mappable
+    cubes, so that later analyses of the targets read the stamps rather than the full frames.
+    The stamps are on the pixel grid of the reference image, and aligned using the refined WCS of each frame.
+    Frames without a refined WCS are not extracted, and the reference image must have one.
+
+    The output directory contains the cubes sci.npy, err.npy (float32) and mask.npy (uint8, 1 for bad pixels
+    and 2 outside the frame), of shape (nframes, ntargets, size, size), in the order of the ObservationSet,
+    the per-epoch metadata in epochs.parquet and the stamp positions in targets.parquet.
+
+    Parameters
+    ----------
+    red_dir : str, the path to the reduction directory
+    targets : array, the RA, Dec of the targets in degrees, one row per target
+    size : int, the size of the stamps in pixels
+    reference_image : str, [optional] the name of the reference image, by default the first of the dataset
+    output_dir : str, [optional] the output directory, by default the stamps directory of red_dir
+    nprocess : int, the number of worker processes
+    log : object pipeline log
+
+    Returns
+    -------
+    output_dir : str, the output directory
+    """
+
+    obs_set = ObservationSet(file_path=os.path.join(red_dir, 'data_summary.txt'), log=log)
+    files = [str(f) for f in obs_set.table['file']]
+    if reference_image is None:
+        reference_image = files[0]
+    if output_dir is None:
+        output_dir = os.path.join(red_dir, 'stamps')
+    os.makedirs(output_dir, exist_ok=True)
+
+    with fits.open(os.path.join(red_dir, reference_image)) as hdulist:
+        reference_wcs, refined = lcodia.get_refined_wcs(hdulist)
+    if not refined:
+        raise ValueError('The reference image ' + reference_image + ' has no refined WCS')
+    targets = np.atleast_2d(np.asarray(targets, dtype=float))
+    origins = get_stamp_origins(reference_wcs, targets, size)
+
+    shape = (len(files), len(targets), size, size)
+    cubes = {
+        layer: np.lib.format.open_memmap(os.path.join(output_dir, layer + '.npy'), mode='w+', dtype=dtype,
+                                         shape=shape)
+        for layer, dtype in (('sci', np.float32), ('err', np.float32), ('mask', np.uint8))
+    }
+    lcologs.log('Extracting ' + str(len(targets)) + ' stamps of ' + str(size) + ' pixels from ' + str(len(files))
+                + ' frames', 'info', log=log)
+
+    # Each frame is written to the cubes as soon as its stamps are returned
+    image_paths = [os.path.join(red_dir, f) for f in files]
+    status = []
+    if nprocess > 1:
+        with ProcessPoolExecutor(max_workers=nprocess) as executor:
+            results = executor.map(extract_frame_stamps, image_paths, repeat(reference_wcs), repeat(origins),
+                                   repeat(size))
+            for i, stamps in enumerate(results):
+                for layer, cube in cubes.items():
+                    cube[i] = stamps[layer]
+                status.append(stamps['status'])
+    else:
+        for i, image_path in enumerate(image_paths):
+            stamps = extract_frame_stamps(image_path, reference_wcs, origins, size)
+            for layer, cube in cubes.items():
+                cube[i] = stamps[layer]
+            status.append(stamps['status'])
+
+    for cube in cubes.values():
+        cube.flush()
+
+    epochs = pd.DataFrame({'file': files, 'status': status})
+    for column in ['HJD', 'filter', 'exptime', 'airmass', 'fwhm', 'sky_bkgd']:
+        if column in obs_set.table.colnames:
+            epochs[column] = np.asarray(obs_set.table[column])
+    epochs.to_parquet(os.path.join(output_dir, 'epochs.parquet'), engine='pyarrow')
+
+    pd.DataFrame({
+        'ra': targets[:, 0],
+        'dec': targets[:, 1],
+        'x0': origins[:, 0],
+        'y0': origins[:, 1],
+        'reference_image': [reference_image] * len(targets)
+    }).to_parquet(os.path.join(output_dir, 'targets.parquet'), engine='pyarrow')
+
+    lcologs.log('Output stamp cubes to ' + output_dir + ', ' + str(status.count('OK')) + ' frames extracted',
+                'info', log=log)
+
+    return output_dir
+
+def load_stamp_cube(output_dir, mmap_mode='r'):
+    """
+    Function to load the stamp cubes of extract_stamp_cube, memory-mapped by default
+
+    Parameters
+    ----------
+    output_dir : str, the directory of the stamp cubes
+    mmap_mode : str, the numpy memory-map mode, None to read the cubes into memory
+
+    Returns
+    -------
+    cube : dict, the 'sci', 'err' and 'mask' cubes, and the 'epochs' and 'targets' Tables
+    """
+
+    cube = {layer: np.load(os.path.join(output_dir, layer + '.npy'), mmap_mode=mmap_mode)
+            for layer in ('sci', 'err', 'mask')}
+    cube['epochs'] = Table.from_pandas(pd.read_parquet(os.path.join(output_dir, 'epochs.parquet')))
+    cube['targets'] = Table.from_pandas(pd.read_parquet(os.path.join(output_dir, 'targets.parquet')))
+
+    return cube
+
+def get_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', help='Path to the reduction directory')
+    parser.add_argument('targets', nargs='+', help='Target coordinates as RA,Dec in decimal degrees')
+    parser.add_argument('--size', help='Size of the stamps in pixels', type=int, default=64)
+    parser.add_argument('--reference', help='Name of the reference image', default=None)
+    parser.add_argument('--output', help='Path to the output directory', default=None)
+    parser.add_argument('--nprocess', help='Number of worker processes', type=int, default=1)
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == '__main__':
+    args = get_args()
+    targets = [[float(c) for c in target.split(',')] for target in args.targets]
+    extract_stamp_cube(args.directory, targets, size=args.size, reference_image=args.reference,
+                       output_dir=args.output, nprocess=args.nprocess)
@@ -105,11 +105,13 @@ ref = np.argmax(counts)
 dia_phots = []
 dia_kers = []
 dia_ekers = []
+kernel_cache = {}
+reference_cache = {}
 #breakpoint()
 for ind,im in enumerate(tqdm(images[:])):#[::1]:
 
         agent = lcodiaphot.DIAPhotometryAnalyst( images[ref],directory,images[ind], directory,cats[ref], cats[ind],
-                 cutout_region,kernel_size)
+                 cutout_region,kernel_size, kernel_cache=kernel_cache, reference_cache=reference_cache)
         dia_phots.append(agent.dia_photometry)
         dia_kers.append(agent.kernel)
         dia_ekers.append(agent.kernel_errors)
@@ -1,7 +1,17 @@
 from prefect import task
+from types import SimpleNamespace
+import copy
+import os
+import shutil
 import numpy as np
+from astropy.wcs import WCS, utils
+from astropy.coordinates import SkyCoord
+from astropy.table import Table, Column
 
 from image_reduction.astrometry import wcs as lcowcs
+from image_reduction.astrometry import projection
+from image_reduction.astrometry import distortion
+from image_reduction.astrometry import crossmatching
 from image_reduction.logistics import image_tools
 
 
@@ -29,8 +39,360 @@ def test_find_images_shifts():
     assert np.allclose((shiftx, shifty), -np.array([shiftX, shiftY]), atol=1)
 
 
+def make_test_analyst(rng, nstars=3000, header_offset=(12.0, -7.0)):
+
+    # Catalog of stars around the field center, observed in a frame with a known WCS
+    true_wcs = make_test_wcs(crpix=(2040.5, 2052.5), rotation=0.03)
+    ra_center, dec_center = true_wcs.wcs.crval
+    ra = ra_center + rng.uniform(-0.2, 0.2, nstars) / np.cos(np.radians(dec_center))
+    dec = dec_center + rng.uniform(-0.2, 0.2, nstars)
+    sources = Table([
+        Column(name='ra', data=ra),
+        Column(name='dec', data=dec),
+        Column(name='gaia_id', data=np.arange(1, nstars + 1)),
+        Column(name='phot_g_mean_flux', data=rng.uniform(100, 10000, nstars)),
+    ])
+    positions = np.array(true_wcs.world_to_pixel(SkyCoord(ra, dec, unit='deg'))).T
+    detected = np.all((positions > 0) & (positions < 4096), axis=1)
+
+    # The header WCS of the frame is offset from the true solution
+    header_wcs = copy.deepcopy(true_wcs)
+    header_wcs.wcs.crpix = true_wcs.wcs.crpix + np.array(header_offset)
+
+    analyst = SimpleNamespace(
+        image_original_wcs=header_wcs,
+        sources=sources,
+        catalog_projection=projection.CatalogProjection(ra, dec, ra_center, dec_center),
+        ra_center=ra_center,
+        dec_center=dec_center,
+        image_source_catalog=np.c_[positions[detected] + rng.normal(0, 0.05, (detected.sum(), 2)),
+                                   rng.uniform(1, 100, detected.sum())],
+        image_data=np.zeros((4096, 4096)),
+        pixscale=0.389,
+        dir_path='.',
+        image_name='test.fits'
+    )
+
+    return analyst, true_wcs
+
+
 def test_refine_image_wcs():
 
-    pass
+    rng = np.random.default_rng(7)
+    analyst, true_wcs = make_test_analyst(rng)
+
+    new_wcs = lcowcs.refine_image_wcs.fn(analyst, star_limit=5000)
+
+    coords = SkyCoord(analyst.sources['ra'], analyst.sources['dec'], unit='deg')
+    expected = np.array(true_wcs.world_to_pixel(coords)).T
+    new_positions = np.array(new_wcs.world_to_pixel(coords)).T
+    assert np.allclose(new_positions, expected, atol=0.25)
+
+
+def test_catalog_projection():
+
+    rng = np.random.default_rng(3)
+    test_wcs = make_test_wcs(rotation=0.2)
+    ra = 266.0 + rng.uniform(-0.3, 0.3, 1000)
+    dec = -39.1 + rng.uniform(-0.3, 0.3, 1000)
+    coords = SkyCoord(ra, dec, unit='deg')
+
+    catalog_projection = projection.CatalogProjection(ra, dec, 266.0, -39.1)
+
+    x, y = catalog_projection.world_to_pixel(test_wcs)
+    expected = test_wcs.world_to_pixel(coords)
+    assert np.allclose(x, expected[0], atol=1e-6)
+    assert np.allclose(y, expected[1], atol=1e-6)
+
+    separations = coords.separation(SkyCoord(266.0, -39.1, unit='deg')).deg
+    assert np.allclose(catalog_projection.separations, separations, atol=1e-9)
+
+    # Projection through a WCS with SIP distortion
+    pixels = np.array(expected)
+    pixels[0] = pixels[0] + 2e-7 * (pixels[0] - 2048.0)**2
+    sip_wcs = utils.fit_wcs_from_points(pixels, coords, sip_degree=2)
+    x, y = catalog_projection.world_to_pixel(sip_wcs)
+    expected = sip_wcs.world_to_pixel(coords)
+    assert np.allclose(x, expected[0], atol=1e-6)
+    assert np.allclose(y, expected[1], atol=1e-6)
+
+def make_test_wcs(crval=(266.0433328, -39.1132223), crpix=(2048.0, 2048.0), rotation=0.0):
+
+    test_wcs = WCS(naxis=2)
+    test_wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    test_wcs.wcs.crval = crval
+    test_wcs.wcs.crpix = crpix
+    angle = np.radians(rotation)
+    scale = 0.389 / 3600.0
+    test_wcs.wcs.cd = scale * np.array([[-np.cos(angle), np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    test_wcs.pixel_shape = (4096, 4096)
+
+    return test_wcs
+
+
+def test_refine_image_wcs_from_reference():
+
+    rng = np.random.default_rng(42)
+    nstars = 2000
+
+    # Stars detected in the reference image, with its refined WCS
+    ref_wcs = make_test_wcs()
+    ref_positions = rng.uniform(100, 3996, (nstars, 2))
+    reference = lcowcs.ReferenceAstrometry()
+    reference.set_from_analyst(SimpleNamespace(
+        image_new_wcs=ref_wcs,
+        image_source_catalog=np.c_[ref_positions, rng.uniform(1, 100, nstars)]
+    ))
+
+    # The same stars seen in a frame which is shifted and slightly rotated compared with the reference
+    true_wcs = make_test_wcs(crpix=(2020.3, 2071.8), rotation=0.05)
+    coords = ref_wcs.pixel_to_world(ref_positions[:,0], ref_positions[:,1])
+    positions = np.array(true_wcs.world_to_pixel(coords)).T
+    keep = np.all((positions > 0) & (positions < 4096), axis=1)
+    analyst = SimpleNamespace(
+        image_source_catalog=np.c_[positions[keep] + rng.normal(0, 0.05, (keep.sum(), 2)),
+                                   rng.uniform(1, 100, keep.sum())],
+        image_data=np.zeros((4096, 4096)),
+        image_original_wcs=make_test_wcs(crpix=(2030.0, 2060.0))
+    )
+
+    new_wcs = lcowcs.refine_image_wcs_from_reference.fn(analyst, reference)
+
+    new_positions = np.array(new_wcs.world_to_pixel(coords[keep])).T
+    assert np.allclose(new_positions, positions[keep], atol=0.05)
+
+
+def test_fit_wcs_linear():
+
+    rng = np.random.default_rng(11)
+    true_wcs = make_test_wcs(crpix=(2040.5, 2052.5), rotation=0.1)
+    true_pixels = rng.uniform(0, 4096, (2, 500))
+    coords = true_wcs.pixel_to_world(true_pixels[0], true_pixels[1])
+    pixels = true_pixels + rng.normal(0, 0.1, true_pixels.shape)
+
+    # Corrupt a few matches, which should be clipped
+    pixels[:, :10] += 25.0
+
+    new_wcs = lcowcs.fit_wcs_linear(pixels, coords.ra.deg, coords.dec.deg, sip_degree=1, image_shape=(4100, 4096))
+    assert new_wcs.pixel_shape == (4096, 4100)
+    astropy_wcs = utils.fit_wcs_from_points(pixels[:, 10:], coords[10:], sip_degree=1)
+
+    new_pixels = np.array(new_wcs.world_to_pixel(coords))
+    astropy_pixels = np.array(astropy_wcs.world_to_pixel(coords))
+    assert np.allclose(new_pixels, true_pixels, atol=0.05)
+    assert np.allclose(new_pixels, astropy_pixels, atol=0.005)
+
+    # Recover a quadratic distortion through the SIP terms
+    pixels = true_pixels.copy()
+    pixels[0] += 2e-7 * (true_pixels[0] - 2048.0)**2
+    new_wcs = lcowcs.fit_wcs_linear(pixels, coords.ra.deg, coords.dec.deg, sip_degree=2)
+    assert np.allclose(np.array(new_wcs.world_to_pixel(coords)), pixels, atol=1e-3)
+
+
+def test_match_stars_consensus():
+
+    rng = np.random.default_rng(3)
+    cat_positions = rng.uniform(0, 4096, (1500, 2))
+
+    # Detections are an affine transform of a subset of the catalog, with noise and spurious sources
+    true_model = lcowcs.tf.AffineTransform(rotation=np.radians(0.05), translation=(2.5, -1.7))
+    det_positions = true_model.inverse(cat_positions[:1000]) + rng.normal(0, 0.05, (1000, 2))
+    det_positions = np.r_[det_positions, rng.uniform(0, 4096, (100, 2))]
+
+    det_idx, cat_idx, model, inliers = lcowcs.match_stars_consensus(det_positions, cat_positions)
+
+    assert (det_idx[inliers] == cat_idx[inliers]).all()
+    assert inliers.sum() > 950
+    assert np.allclose(model(det_positions[:1000]), true_model(det_positions[:1000]), atol=0.01)
+
+    # Repeated calls give the same result
+    det_idx2, cat_idx2, model2, inliers2 = lcowcs.match_stars_consensus(det_positions, cat_positions)
+    assert (inliers2 == inliers).all()
+    assert np.array_equal(model2.params, model.params)
+
+    # Including when the candidate pairs are subsampled
+    subsampled = [lcowcs.match_stars_consensus(det_positions, cat_positions, max_pairs=300) for i in range(2)]
+    assert np.array_equal(subsampled[0][0], subsampled[1][0])
+    assert np.array_equal(subsampled[0][2].params, subsampled[1][2].params)
+    assert np.allclose(subsampled[0][2](det_positions[:1000]), true_model(det_positions[:1000]), atol=0.05)
+
+    # The consensus matcher can be used in the WCS refinement
+    analyst, true_wcs = make_test_analyst(np.random.default_rng(7))
+    new_wcs = lcowcs.refine_image_wcs.fn(analyst, star_limit=5000, matcher='consensus')
+
+    coords = SkyCoord(analyst.sources['ra'], analyst.sources['dec'], unit='deg')
+    expected = np.array(true_wcs.world_to_pixel(coords)).T
+    new_positions = np.array(new_wcs.world_to_pixel(coords)).T
+    assert np.allclose(new_positions, expected, atol=0.25)
+
+
+def test_distortion_model_cache():
+
+    rng = np.random.default_rng(5)
+    true_wcs = make_test_wcs(crpix=(2048.5, 2048.5), rotation=0.1)
+    true_pixels = rng.uniform(0, 4096, (2, 500))
+    coords = true_wcs.pixel_to_world(true_pixels[0], true_pixels[1])
+    pixels = true_pixels.copy()
+    pixels[0] += 2e-7 * (true_pixels[0] - 2047.5)**2
+
+    cache_dir = os.path.join(os.getcwd(), 'tests', 'test_output', 'distortion_models')
+    cache = distortion.DistortionModelCache(cache_dir, ncandidates=3)
+
+    # Candidate fits of the camera distortion; poor fits are rejected
+    for i in range(3):
+        new_wcs = lcowcs.fit_wcs_linear(pixels, coords.ra.deg, coords.dec.deg, sip_degree=2,
+                                        crpix=(2048.5, 2048.5))
+        assert cache.get_model('lsc-domb-1m0-09-fa15') is None
+        assert cache.add_candidate('lsc-domb-1m0-09-fa15', 'image' + str(i) + '.fits', new_wcs,
+                                   {'ninliers': 500, 'rms': 0.01 * (i + 1)})
+    assert not cache.add_candidate('lsc-domb-1m0-09-fa15', 'bad.fits', new_wcs, {'ninliers': 500, 'rms': 2.0})
+
+    # The model is reloaded from disk and held fixed while fitting the linear terms of a rotated frame
+    cache = distortion.DistortionModelCache(cache_dir, ncandidates=3)
+    model = cache.get_model('lsc-domb-1m0-09-fa15')
+    assert np.allclose(model.a, new_wcs.sip.a)
+
+    frame_wcs = make_test_wcs(crpix=(2030.5, 2070.5), rotation=0.3)
+    coords = frame_wcs.pixel_to_world(true_pixels[0], true_pixels[1])
+    fixed_wcs = lcowcs.fit_wcs_linear(pixels, coords.ra.deg, coords.dec.deg, sip=model)
+    assert np.allclose(np.array(fixed_wcs.world_to_pixel(coords)), pixels, atol=1e-3)
+
+    shutil.rmtree(cache_dir)
+
+
+def test_project_frames():
+
+    rng = np.random.default_rng(13)
+    ra = rng.uniform(265.9, 266.2, 2000)
+    dec = rng.uniform(-39.25, -38.95, 2000)
+    catalog_projection = projection.CatalogProjection(ra, dec, 266.0433328, -39.1132223)
+
+    # Frames with different pointings, one of which has a SIP distortion
+    wcs_list = [make_test_wcs(crpix=(2048.0 + 10 * k, 2048.0 - 7 * k), rotation=0.05 * k) for k in range(4)]
+    coords = SkyCoord(ra, dec, unit='deg')
+    pixels = np.array(wcs_list[2].world_to_pixel(coords))
+    pixels[0] += 2e-7 * (pixels[0] - 2048.0)**2
+    wcs_list[2] = utils.fit_wcs_from_points(pixels, coords, sip_degree=3)
+    assert wcs_list[2].sip is not None
+    wcs_stack = projection.WCSStack()
+    wcs_stack.set_from_wcs_list(wcs_list)
+
+    file_path = os.path.join(os.getcwd(), 'tests', 'test_output', 'star_positions.npy')
+    positions = catalog_projection.project_frames(wcs_stack, file_path=file_path, star_chunk=700, frame_chunk=3)
+    positions = np.load(file_path, mmap_mode='r')
+
+    assert positions.shape == (2000, 4, 2)
+    assert positions.dtype == np.float32
+    for k, image_wcs in enumerate(wcs_list):
+        expected = np.array(image_wcs.world_to_pixel(SkyCoord(ra, dec, unit='deg'))).T
+        assert np.allclose(positions[:, k], expected, atol=1e-3)
+
+    del positions
+    os.remove(file_path)
+
+    # The linear WCS parameters can also be taken from the table of an ObservationSet
+    linear_wcs = [wcs_list[k] for k in (0, 1, 3)]
+    cd = np.array([projection.wcs_pixel_scale_matrix(image_wcs) for image_wcs in linear_wcs])
+    obs_set = SimpleNamespace(table=Table([
+        Column(name='CRPIX1', data=[image_wcs.wcs.crpix[0] for image_wcs in linear_wcs]),
+        Column(name='CRPIX2', data=[image_wcs.wcs.crpix[1] for image_wcs in linear_wcs]),
+        Column(name='CRVAL1', data=[image_wcs.wcs.crval[0] for image_wcs in linear_wcs]),
+        Column(name='CRVAL2', data=[image_wcs.wcs.crval[1] for image_wcs in linear_wcs]),
+        Column(name='CD1_1', data=cd[:,0,0]),
+        Column(name='CD1_2', data=cd[:,0,1]),
+        Column(name='CD2_1', data=cd[:,1,0]),
+        Column(name='CD2_2', data=cd[:,1,1])
+    ]))
+    wcs_stack.set_from_obs_set(obs_set)
+    positions = catalog_projection.project_frames(wcs_stack)
+    for k, image_wcs in enumerate(linear_wcs):
+        expected = np.array(image_wcs.world_to_pixel(SkyCoord(ra, dec, unit='deg'))).T
+        assert np.allclose(positions[:, k], expected, atol=1e-3)
+
+
+def test_model_image_cache():
+
+    rng = np.random.default_rng(17)
+    analyst, true_wcs = make_test_analyst(rng)
+
+    cache_dir = os.path.join(os.getcwd(), 'tests', 'test_output', 'model_cache')
+    model_cache = lcowcs.ModelImageCache(cache_dir=cache_dir)
+    new_wcs = lcowcs.refine_image_wcs.fn(analyst, star_limit=5000, model_cache=model_cache)
+    assert len(model_cache.ffts) == 1
+    assert len(os.listdir(cache_dir)) == 1
+
+    # WCS differing by a small fraction of the quantum share the same key
+    key = model_cache.get_key(analyst.image_original_wcs, analyst.image_data.shape, 10, 5000)
+    shifted_wcs = copy.deepcopy(analyst.image_original_wcs)
+    shifted_wcs.wcs.crpix = shifted_wcs.wcs.crpix + 0.01
+    assert model_cache.get_key(shifted_wcs, analyst.image_data.shape, 10, 5000) == key
+    shifted_wcs.wcs.crpix = shifted_wcs.wcs.crpix + 5.0
+    assert model_cache.get_key(shifted_wcs, analyst.image_data.shape, 10, 5000) != key
+
+    # A new cache reloads the transform from disk, and gives the same solution
+    model_cache = lcowcs.ModelImageCache(cache_dir=cache_dir)
+    cached_wcs = lcowcs.refine_image_wcs.fn(analyst, star_limit=5000, model_cache=model_cache)
+    assert np.allclose(cached_wcs.wcs.crval, new_wcs.wcs.crval)
+    assert np.allclose(cached_wcs.wcs.cd, new_wcs.wcs.cd)
+
+    # The shift measured from the cached transform is the same as from the images
+    reference = image_tools.build_image.fn(rng.uniform(0, 4096, (500, 2)), [1] * 500, (4096, 4096))
+    image = np.roll(reference, (13, -21), axis=(0, 1))
+    reference_fft = lcowcs.central_subimage_fft(reference)
+    assert np.allclose(lcowcs.find_images_shifts.fn(None, image, reference_fft=reference_fft),
+                       lcowcs.find_images_shifts.fn(reference, image))
+
+    shutil.rmtree(cache_dir)
+
+
+def test_spatial_index():
+
+    rng = np.random.default_rng(19)
+    ra = rng.uniform(269.5, 270.5, 5000)
+    dec = rng.uniform(-22.5, -21.5, 5000)
+    index = crossmatching.SpatialIndex(ra=ra, dec=dec, x=rng.uniform(0, 4096, 5000), y=rng.uniform(0, 4096, 5000))
+
+    # Nearest neighbour and cone searches agree with direct calculations of the separations
+    targets = SkyCoord(rng.uniform(269.6, 270.4, 20), rng.uniform(-22.4, -21.6, 20), unit='deg')
+    separations = targets[:, np.newaxis].separation(SkyCoord(ra, dec, unit='deg')[np.newaxis, :]).deg
+
+    idx, seps = index.query_nearest_sky(targets.ra.deg, targets.dec.deg)
+    assert (idx == separations.argmin(axis=1)).all()
+    assert np.allclose(seps, separations.min(axis=1), atol=1e-9)
+
+    cones = index.query_cone(targets.ra.deg, targets.dec.deg, 0.05)
+    for k, cone in enumerate(cones):
+        assert np.array_equal(cone, np.where(separations[k] <= 0.05)[0])
+
+    idx, seps = index.query_nearest_sky(targets.ra.deg, targets.dec.deg, radius=1e-6)
+    assert (idx == -1).all()
+    assert np.isinf(seps).all()
+
+    # Search in the pixel frame of the reference image
+    idx, seps = index.query_nearest_pixel(index.pixels[5, 0] + 0.1, index.pixels[5, 1], radius=1.0)
+    assert idx[0] == 5
+    cones = index.query_cone_pixel(index.pixels[:3, 0], index.pixels[:3, 1], 50.0)
+    for k, cone in enumerate(cones):
+        dist = np.sqrt(((index.pixels - index.pixels[k])**2).sum(axis=1))
+        assert np.array_equal(cone, np.where(dist <= 50.0)[0])
+
+    # Stars outside the reference image have NaN pixel positions, and the index round-trips with them
+    x = rng.uniform(0, 4096, 5000)
+    y = rng.uniform(0, 4096, 5000)
+    x[::7] = np.nan
+    y[::7] = np.nan
+    index = crossmatching.SpatialIndex(ra=ra, dec=dec, x=x, y=y)
+    idx, seps = index.query_nearest_pixel(x[8] + 0.1, y[8], radius=1.0)
+    assert idx[0] == 8
+    assert index.query_nearest_pixel(-100.0, -100.0, radius=1.0)[0][0] == -1
+    cone = index.query_cone_pixel(x[8], y[8], 50.0)[0]
+    with np.errstate(invalid='ignore'):
+        assert np.array_equal(cone, np.where(np.hypot(x - x[8], y - y[8]) <= 50.0)[0])
 
-    #Need discussion on how to test this kind of function
\ No newline at end of file
+    file_path = os.path.join(os.path.dirname(__file__), 'test_output', 'spatial_index.pkl')
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    index.save(file_path)
+    loaded = crossmatching.SpatialIndex(file_path=file_path)
+    assert loaded.matches_catalog(ra, dec, x=x, y=y)
+    assert np.array_equal(loaded.query_nearest_pixel(x[8] + 0.1, y[8])[0], idx)
+    os.remove(file_path)
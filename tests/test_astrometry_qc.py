@@ -0,0 +1,49 @@
+import numpy as np
+
+from image_reduction.data_quality import astrometry_qc
+
+
+def test_check_stars_within_frame():
+
+    image_shape = (100, 200)
+    star_positions = np.array([[10.0, 10.0], [150.0, 50.0], [-5.0, 50.0], [150.0, 120.0]])
+
+    assert astrometry_qc.in_frame_mask(image_shape, star_positions).tolist() == [True, True, False, False]
+    assert astrometry_qc.in_frame_fraction(image_shape, star_positions) == 0.5
+    assert astrometry_qc.check_stars_within_frame(image_shape, star_positions)
+    assert not astrometry_qc.check_stars_within_frame(image_shape, star_positions[2:])
+
+
+def test_check_frame_before_detection():
+
+    rng = np.random.default_rng(1)
+    image = rng.normal(100, 10, (100, 200))
+    star_positions = rng.uniform(0, 100, (50, 2))
+
+    status, qc = astrometry_qc.check_frame_before_detection(image, star_positions)
+    assert status
+    assert qc['valid_pixel_fraction'] == 1.0
+
+    # Header WCS placing the catalog outside the frame
+    status, qc = astrometry_qc.check_frame_before_detection(image, star_positions + 1000.0)
+    assert not status
+    assert qc['header_in_frame_fraction'] == 0.0
+
+    # Blank image
+    status, qc = astrometry_qc.check_frame_before_detection(np.zeros((100, 200)), star_positions)
+    assert not status
+
+
+def test_assess_wcs_fit():
+
+    rng = np.random.default_rng(2)
+    star_positions = rng.uniform(0, 1000, (400, 2))
+    det_positions = np.r_[star_positions[:300] + rng.normal(0, 0.3, (300, 2)), rng.uniform(0, 1000, (100, 2))]
+
+    qc = astrometry_qc.assess_wcs_fit((1000, 1000), star_positions, det_positions,
+                                      {'nmatches': 300, 'ninliers': 270, 'rms': 0.4})
+
+    assert qc['in_frame_fraction'] == 1.0
+    assert 0.75 <= qc['match_fraction'] < 0.8
+    assert qc['inlier_fraction'] == 0.9
+    assert qc['residual_rms'] == 0.4
@@ -1,5 +1,7 @@
 import os
 import unittest
+import numpy as np
+from astropy.table import Table, Column
 from image_reduction.infrastructure import data_classes
 
 class TestObservationSet(unittest.TestCase):
@@ -63,4 +65,44 @@ class TestObservationSet(unittest.TestCase):
         obs_set = data_classes.ObservationSet(file_path=test_path)
 
         assert(len(obs_set.table) == 1)
-        assert(len(obs_set.table.colnames) == 32)
\ No newline at end of file
+        assert(len(obs_set.table.colnames) == 32)
+
+class TestStarCatalog(unittest.TestCase):
+
+    def test_spatial_index(self):
+        rng = np.random.default_rng(3)
+        nstars = 1000
+
+        star_catalog = data_classes.StarCatalog()
+        star_catalog.ra_center = 270.0
+        star_catalog.dec_center = -22.0
+        star_catalog.sources = Table([
+            Column(name='x', data=rng.uniform(0, 4096, nstars)),
+            Column(name='y', data=rng.uniform(0, 4096, nstars)),
+            Column(name='ra', data=rng.uniform(269.8, 270.2, nstars)),
+            Column(name='dec', data=rng.uniform(-22.2, -21.8, nstars))
+        ])
+
+        # The index is stored with the catalog and reloaded with it
+        test_output_path = os.path.join(os.getcwd(), 'tests', 'test_output', 'star_catalog.fits')
+        star_catalog.save(test_output_path)
+        index_path = star_catalog.get_index_path(test_output_path)
+        assert(os.path.isfile(index_path))
+
+        new_catalog = data_classes.StarCatalog(file_path=test_output_path)
+        assert(new_catalog.index is not None)
+
+        idx, separations = new_catalog.get_index().query_nearest_pixel(
+            star_catalog.sources['x'][10] + 0.5, star_catalog.sources['y'][10]
+        )
+        assert(idx[0] == 10)
+        assert(np.isclose(separations[0], 0.5))
+
+        # An out of date index is rebuilt
+        star_catalog.sources['x'][10] += 100.0
+        star_catalog.sources.write(test_output_path, format='fits', overwrite=True)
+        new_catalog = data_classes.StarCatalog(file_path=test_output_path)
+        assert(new_catalog.index is None)
+
+        os.remove(test_output_path)
+        os.remove(index_path)
@@ -30,3 +30,138 @@ class PhotometricScaleFactor(unittest.TestCase):
         assert (pscales == np.ones((3,3))).all()
         assert (epscales == np.zeros(3)).all()
         assert (dataset.raw_flux.shape == flux.shape)
+
+    def test_calculate_pscale_incremental(self):
+
+        import os
+        from types import SimpleNamespace
+        from astropy.table import Table
+
+        rng = np.random.default_rng(7)
+        nstars = 200
+        nimages = 24
+        files = ['image' + str(i) + '.fits' for i in range(nimages)]
+        true_pscales = rng.uniform(0.7, 1.3, nimages)
+        star_flux = rng.uniform(1e4, 1e5, nstars)
+        raw_flux = star_flux[:, None] * true_pscales[None, :] * rng.normal(1.0, 0.005, (nstars, nimages))
+
+        def make_dataset(nused, raw_flux=raw_flux):
+            dataset = aperture_photometry.AperturePhotometryDataset()
+            dataset.sources = Table({'x': rng.uniform(0, 1000, nstars), 'y': rng.uniform(0, 1000, nstars)})
+            dataset.raw_flux = raw_flux[:, :nused].copy()
+            dataset.raw_err_flux = 0.01 * dataset.raw_flux
+            obs_set = SimpleNamespace(table=Table({'file': files[:nused]}))
+            return obs_set, dataset
+
+        reference_path = os.path.join(os.path.dirname(__file__), 'test_output', 'pscale_reference.npz')
+        os.makedirs(os.path.dirname(reference_path), exist_ok=True)
+
+        obs_set, dataset = make_dataset(20)
+        dataset = photometric_scale_factor.calculate_pscale(files[0], obs_set, dataset, debug=False,
+                                                            reference_path=reference_path)
+        first_pscales = dataset.pscales.copy()
+
+        # New images are computed against the stored median fluxes, the stored scale factors are kept
+        obs_set, dataset = make_dataset(22)
+        dataset = photometric_scale_factor.calculate_pscale(files[0], obs_set, dataset, debug=False,
+                                                            reference_path=reference_path)
+        assert np.array_equal(dataset.pscales[:, :20], first_pscales)
+        obs_set, full = make_dataset(22)
+        full = photometric_scale_factor.calculate_pscale(files[0], obs_set, full, debug=False)
+
+        # The scale factors match those of a full calculation, up to the normalization of the median fluxes
+        ratio = dataset.pscales[1] / full.pscales[1]
+        assert np.allclose(ratio, ratio[0], rtol=2e-3)
+        assert np.allclose(dataset.flux * ratio[0], full.flux, rtol=2e-3)
+
+        # A drift of the comparison stars triggers a full recalculation
+        drifted = raw_flux.copy()
+        drifted[: nstars // 2 + 10, 22:] *= 1.5
+        obs_set, dataset = make_dataset(24, raw_flux=drifted)
+        dataset = photometric_scale_factor.calculate_pscale(files[0], obs_set, dataset, debug=False,
+                                                            reference_path=reference_path, drift_threshold=0.01)
+        reference = photometric_scale_factor.PscaleReference(file_path=reference_path)
+        assert len(reference.files) == 24
+        assert np.all(reference.shift == 0.0)
+        assert not np.array_equal(dataset.pscales[:, :20], first_pscales)
+
+        os.remove(reference_path)
+
+    def test_calculate_pscale_chunked(self):
+
+        import tracemalloc
+        from types import SimpleNamespace
+        from astropy.table import Table
+
+        rng = np.random.default_rng(11)
+        nstars = 2000
+        nimages = 300
+        files = ['image' + str(i) + '.fits' for i in range(nimages)]
+        star_flux = rng.uniform(1e3, 1e5, nstars)
+        raw_flux = star_flux[:, None] * rng.uniform(0.7, 1.3, nimages)[None, :] \
+                   * rng.normal(1.0, 0.01, (nstars, nimages))
+        raw_flux[rng.random(raw_flux.shape) < 0.01] = np.nan
+        obs_set = SimpleNamespace(table=Table({'file': files}))
+        sources = Table({'x': rng.uniform(0, 4000, nstars), 'y': rng.uniform(0, 4000, nstars)})
+
+        results = []
+        peaks = []
+        for memory_limit in [1024**2, 1024**3]:
+            dataset = aperture_photometry.AperturePhotometryDataset()
+            dataset.sources = sources
+            dataset.raw_flux = raw_flux
+            dataset.raw_err_flux = 0.01 * raw_flux
+
+            tracemalloc.start()
+            results.append(photometric_scale_factor.calculate_pscale(files[0], obs_set, dataset, debug=False,
+                                                                     memory_limit=memory_limit))
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+        # Blocks of epochs give the same results
+        assert np.array_equal(results[0].pscales, results[1].pscales)
+        assert np.array_equal(results[0].epscales, results[1].epscales)
+        assert np.array_equal(results[0].flux, results[1].flux, equal_nan=True)
+        assert np.array_equal(results[0].flux_err, results[1].flux_err, equal_nan=True)
+
+        # Apart from the flux and flux_err outputs, little memory is used
+        assert peaks[0] < 2.5 * raw_flux.nbytes
+
+    def test_calculate_ensemble_pscale(self):
+
+        from types import SimpleNamespace
+        from astropy.table import Table
+
+        rng = np.random.default_rng(3)
+        nstars = 3000
+        nimages = 40
+        files = ['image' + str(i) + '.fits' for i in range(nimages)]
+        x = rng.uniform(0, 4000, nstars)
+        y = rng.uniform(0, 4000, nstars)
+        star_flux = 10**rng.uniform(3.5, 5.0, nstars)
+        zero_points = rng.normal(0.0, 0.2, nimages)
+        gradients = rng.normal(0.0, 0.02, nimages)
+        zero_points -= zero_points[0]
+        gradients -= gradients[0]
+
+        # Zero points varying linearly in x across the frame, and 1% of outliers
+        correction = np.exp(zero_points[None, :] + gradients[None, :] * (x / 2000.0 - 1.0)[:, None])
+        raw_err_flux = np.sqrt(star_flux)[:, None] * np.ones(nimages)
+        raw_flux = star_flux[:, None] * correction + rng.normal(0.0, 1.0, (nstars, nimages)) * raw_err_flux
+        raw_flux[rng.random(raw_flux.shape) < 0.01] *= 3.0
+        obs_set = SimpleNamespace(table=Table({'file': files}))
+
+        dataset = aperture_photometry.AperturePhotometryDataset()
+        dataset.sources = Table({'x': x, 'y': y})
+        dataset.raw_flux = raw_flux
+        dataset.raw_err_flux = raw_err_flux
+        dataset = photometric_scale_factor.calculate_ensemble_pscale(files[0], obs_set, dataset, spatial_degree=1)
+
+        assert dataset.pscales.shape == (3, nimages)
+        assert np.allclose(np.log(dataset.pscales[1]), zero_points, atol=2e-3)
+        assert np.allclose(dataset.pscale_spatial[:, 0], gradients, atol=2e-3)
+        assert np.all(dataset.pscales[0] < dataset.pscales[1]) and np.all(dataset.pscales[1] < dataset.pscales[2])
+
+        # The corrected lightcurves of the stars are flat
+        flat = np.nanmedian(np.abs(dataset.flux / star_flux[:, None] - 1.0))
+        assert flat < 0.01
@@ -1,7 +1,10 @@
 import numpy as np
+import scipy.signal as ss
 
 import image_reduction.photometry.photometric_scale_factor as lcopscale
 from image_reduction.photometry import psf as lcopsf
+from image_reduction.photometry import dia_photometry as lcodia
+from image_reduction.astrometry import crossmatching
 
 def test_aperture_photometry():
 
@@ -33,3 +36,579 @@ def test_Gaussian2d():
                                     [0.53526143, 0.77880078, 0.8824969 , 0.77880078, 0.53526143],
                                     [0.36787944, 0.53526143, 0.60653066, 0.53526143, 0.36787944]]))
 
+
+
+def naive_U_matrix(image, kernel_size):
+
+    m, n = image.shape
+    U = np.zeros(((m - kernel_size + 1) * (n - kernel_size + 1), kernel_size ** 2))
+    line = 0
+    for i in range(m - kernel_size + 1):
+        for j in range(n - kernel_size + 1):
+            U[line] = image[i:i + kernel_size, j:j + kernel_size].ravel()
+            line += 1
+
+    return U
+
+
+def make_dia_test_images(rng, size=61, kernel_size=7):
+
+    XX, YY = np.indices((size, size))
+    reference = np.full((size, size), 100.0)
+    for x, y in rng.uniform(5, size - 5, (20, 2)):
+        reference += lcopsf.Gaussian2d(rng.uniform(500, 5000), x, y, 1.5, 1.5, XX, YY)
+
+    XK, YK = np.indices((kernel_size, kernel_size))
+    kernel = lcopsf.Gaussian2d(1, kernel_size // 2, kernel_size // 2, 1.2, 0.9, XK, YK)
+    kernel /= kernel.sum()
+    image = ss.fftconvolve(reference, kernel, mode='same') + 0.01 * XX + 3.0
+
+    return reference, image, kernel
+
+
+def test_build_the_U_windows():
+
+    rng = np.random.default_rng(4)
+    image = rng.normal(size=(23, 19))
+
+    assert np.array_equal(lcodia.build_the_U_windows(image, 5), naive_U_matrix(image, 5))
+
+    square = rng.normal(size=(21, 21))
+    indi, indj = lcodia.build_the_U_indexes(square, np.eye(5))
+    assert np.array_equal(square[indi, indj], naive_U_matrix(square, 5))
+
+
+def test_run_difference_image():
+
+    rng = np.random.default_rng(5)
+    kernel_size = 7
+    reference, image, true_kernel = make_dia_test_images(rng, kernel_size=kernel_size)
+
+    dia_image, image_model, dia_mask, kernel, bkg_coeffs, kernel_errors = lcodia.run_difference_image(
+        reference, image, kernel_size
+    )
+
+    # Same solution as with the U matrix built pixel by pixel
+    half = kernel_size // 2
+    U = naive_U_matrix(reference - reference.mean(), kernel_size)
+    Y, X = np.indices(reference.shape)
+    bkg = np.c_[np.ones(U.shape[0]), X[half:-half, half:-half].ravel(), Y[half:-half, half:-half].ravel()]
+    solution = np.linalg.lstsq(np.c_[U, bkg], (image - image.mean())[half:-half, half:-half].ravel())[0]
+
+    assert np.allclose(kernel, np.flip(solution[:-3].reshape(kernel.shape)))
+    assert np.allclose(kernel, true_kernel, atol=1e-3)
+    assert np.abs(dia_image[half:-half, half:-half]).max() < 0.1
+
+
+def test_run_difference_image_cholesky():
+
+    rng = np.random.default_rng(6)
+    kernel_size = 7
+    reference, image, true_kernel = make_dia_test_images(rng, size=81, kernel_size=kernel_size)
+    mask = np.zeros(reference.shape, dtype=bool)
+    mask[60:63, 10:12] = True
+
+    lstsq = lcodia.run_difference_image(reference, image, kernel_size, mask=mask, solver='lstsq')
+    cholesky = lcodia.run_difference_image(reference, image, kernel_size, mask=mask, solver='cholesky',
+                                           block_rows=5)
+
+    # Difference image, model, kernel and background are identical
+    for i in [0, 1, 3, 4]:
+        assert np.allclose(lstsq[i], cholesky[i], atol=1e-8)
+    assert np.array_equal(lstsq[2], cholesky[2])
+
+    assert np.all(np.isfinite(cholesky[5]))
+
+
+def test_reference_kernel_solver():
+
+    rng = np.random.default_rng(7)
+    kernel_size = 7
+    reference, image, true_kernel = make_dia_test_images(rng, size=81, kernel_size=kernel_size)
+
+    images = [image, 1.5 * image + 2.0, image + rng.normal(0, 0.1, image.shape)]
+    masks = [None, np.zeros(image.shape, dtype=bool), np.zeros(image.shape, dtype=bool)]
+    masks[2][40, 5:7] = True
+
+    solver = lcodia.ReferenceKernelSolver(reference, kernel_size, block_rows=7)
+    results = solver.solve_many(images, masks=masks)
+
+    for image, mask, result in zip(images, masks, results):
+        expected = lcodia.run_difference_image(reference, image, kernel_size, mask=mask, solver='cholesky')
+        for i in [0, 1, 3, 4, 5]:
+            assert np.allclose(result[i], expected[i], atol=1e-8)
+        assert np.array_equal(result[2], expected[2])
+
+    # Epochs with the same mask share a factorization
+    assert len(solver.factors) == 2
+    assert np.allclose(solver.solve(images[0])[3], true_kernel, atol=1e-3)
+    assert len(solver.factors) == 2
+
+
+def test_run_difference_image_varying_kernel():
+
+    rng = np.random.default_rng(8)
+    kernel_size = 7
+    reference, image, kernel1 = make_dia_test_images(rng, size=81, kernel_size=kernel_size)
+
+    # Kernel widening linearly from left to right
+    XK, YK = np.indices((kernel_size, kernel_size))
+    kernel2 = lcopsf.Gaussian2d(1, kernel_size // 2, kernel_size // 2, 1.8, 1.6, XK, YK)
+    kernel2 /= kernel2.sum()
+    weight = np.indices(reference.shape)[1] / (reference.shape[1] - 1)
+    image = ((1 - weight) * ss.fftconvolve(reference, kernel1, mode='same')
+             + weight * ss.fftconvolve(reference, kernel2, mode='same') + 3.0)
+
+    half = kernel_size // 2
+    constant = lcodia.run_difference_image(reference, image, kernel_size, solver='cholesky')
+    varying = lcodia.run_difference_image(reference, image, kernel_size, kernel_degree=1, tile_size=16)
+    one_tile = lcodia.run_difference_image(reference, image, kernel_size, kernel_degree=1, tile_size=100)
+
+    inner = (slice(half, -half), slice(half, -half))
+    assert np.abs(varying[0][inner]).max() < 0.1 * np.abs(constant[0][inner]).max()
+    assert varying[3].shape == (3, kernel_size, kernel_size)
+    assert varying[5].shape == (3, kernel_size, kernel_size)
+    # Weight of kernel2 at the cutout center and per unit of the normalized x coordinate
+    center_weight = 0.5
+    slope = (reference.shape[1] - 2 * half - 1) / 2 / (reference.shape[1] - 1)
+    assert np.allclose(varying[3][0], (1 - center_weight) * kernel1 + center_weight * kernel2, atol=1e-4)
+    assert np.allclose(varying[3][1], slope * (kernel2 - kernel1), atol=1e-4)
+    assert np.allclose(varying[3][2], 0, atol=1e-4)
+
+    # Tiling does not change the solution
+    for i in [0, 1, 3, 4]:
+        assert np.allclose(varying[i], one_tile[i], atol=1e-6)
+
+
+def test_run_difference_image_alard_lupton():
+
+    rng = np.random.default_rng(9)
+    kernel_size = 17
+    reference, image, true_kernel = make_dia_test_images(rng, size=121, kernel_size=kernel_size)
+
+    basis = lcodia.alard_lupton_basis(kernel_size)
+    assert basis.shape == (49, kernel_size, kernel_size)
+
+    delta = lcodia.run_difference_image(reference, image, kernel_size, solver='cholesky')
+    alard_lupton = lcodia.run_difference_image(reference, image, kernel_size, kernel_basis='alard_lupton')
+
+    half = kernel_size // 2
+    assert alard_lupton[3].shape == (kernel_size, kernel_size)
+    assert alard_lupton[5].shape == (kernel_size, kernel_size)
+    assert np.allclose(alard_lupton[3], true_kernel, atol=1e-2)
+    assert np.abs(alard_lupton[0][half:-half, half:-half]).max() < 0.05
+    assert np.allclose(alard_lupton[1], delta[1], rtol=1e-3)
+
+
+def test_run_tiled_difference_image():
+
+    rng = np.random.default_rng(10)
+    kernel_size = 7
+    reference, image, true_kernel = make_dia_test_images(rng, size=101, kernel_size=kernel_size)
+
+    single = lcodia.run_difference_image(reference, image, kernel_size, solver='cholesky')
+    serial = lcodia.run_tiled_difference_image(reference, image, kernel_size, tile_size=40, overlap=10)
+    parallel = lcodia.run_tiled_difference_image(reference, image, kernel_size, tile_size=40, overlap=10,
+                                                 nprocess=2)
+
+    assert serial[0].shape == single[0].shape
+    assert serial[3].shape == (3, 3, kernel_size, kernel_size)
+    assert np.allclose(serial[3], true_kernel, atol=1e-3)
+    assert np.abs(serial[0]).max() < 0.1
+    assert np.array_equal(serial[2], single[2])
+    for i in [0, 1, 3, 4, 5]:
+        assert np.allclose(serial[i], parallel[i])
+
+
+def test_warp_layers():
+
+    from skimage import transform as tf
+
+    rng = np.random.default_rng(11)
+    image = rng.normal(100, 10, (40, 50))
+    variance = rng.normal(0, 1, (40, 50))**2 + 5
+    transform = tf.AffineTransform(rotation=0.01, translation=(1.3, -0.7))
+
+    warped = lcodia.warp_layers([image, variance], transform.inverse, image.shape, order=3)
+
+    for layer, result in zip([image, variance], warped):
+        assert np.array_equal(result, tf.warp(layer, transform.inverse, output_shape=image.shape, order=3))
+
+
+def make_dia_fits(file_path, stars, crpix, sigma, shape=(200, 200), exptime=100.0, refined_wcs=True):
+
+    from astropy.io import fits
+    from astropy.wcs import WCS
+
+    image_wcs = WCS(naxis=2)
+    image_wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    image_wcs.wcs.crval = [270.0, -30.0]
+    image_wcs.wcs.crpix = crpix
+    image_wcs.wcs.cdelt = [-0.389 / 3600.0, 0.389 / 3600.0]
+
+    rows, cols = np.indices(shape)
+    data = np.full(shape, 100.0)
+    xx, yy = image_wcs.world_to_pixel_values(stars['ra'], stars['dec'])
+    for x, y, flux in zip(xx, yy, stars['flux']):
+        data += lcopsf.Gaussian2d(flux / (2 * np.pi * sigma**2), y, x, sigma, sigma, rows, cols)
+
+    header = image_wcs.to_header()
+    header['EXPTIME'] = exptime
+    hdulist = fits.HDUList([
+        fits.PrimaryHDU(data=data, header=header),
+        fits.ImageHDU(data=np.sqrt(data), name='ERR'),
+        fits.ImageHDU(data=np.zeros(shape, dtype=np.int16), name='BPM')
+    ])
+    if refined_wcs:
+        hdulist.append(fits.ImageHDU(header=image_wcs.to_header(), name='LCO MICROLENSING PHOTOMETRY UPDATED WCS'))
+    hdulist.writeto(file_path, overwrite=True)
+
+
+def test_run_dia_epoch():
+
+    import os
+    import pickle
+    import shutil
+    from types import SimpleNamespace
+    from astropy.table import Table
+    from image_reduction.IO import parquet
+
+    red_dir = os.path.join(os.path.dirname(__file__), 'test_output', 'dia_stage')
+    os.makedirs(red_dir, exist_ok=True)
+    parquet.make_output_directories(red_dir)
+
+    rng = np.random.default_rng(12)
+    stars = {
+        'ra': 270.0 + rng.uniform(-0.008, 0.008, 40) / np.cos(np.radians(30.0)),
+        'dec': -30.0 + rng.uniform(-0.008, 0.008, 40),
+        'flux': rng.uniform(5000, 50000, 40)
+    }
+    stars['ra'][0], stars['dec'][0] = 270.0, -30.0
+
+    make_dia_fits(os.path.join(red_dir, 'ref.fits'), stars, [100.0, 100.0], 1.5)
+    variable = dict(stars, flux=stars['flux'].copy())
+    variable['flux'][0] += 2000.0
+    make_dia_fits(os.path.join(red_dir, 'image.fits'), variable, [101.3, 99.3], 2.0)
+
+    kernel_size = 9
+    reference = lcodia.DIAReference(os.path.join(red_dir, 'ref.fits'), 270.0, -30.0, 120, kernel_size)
+    star_index, positions = reference.get_star_positions(stars['ra'], stars['dec'])
+    assert 0 in star_index
+
+    options = {'kernel_size': kernel_size, 'solver': 'cholesky', 'kernel_degree': 0, 'kernel_basis': 'delta',
+               'radius': 8.0, 'detect_threshold': 5.0, 'psf_fwhm': 1.5 * 2.3548}
+    result = lcodia.run_dia_epoch(os.path.join(red_dir, 'image.fits'), reference, positions, options)
+
+    assert result['status'] == 'OK'
+    assert np.isclose(result['kernel_sum'], 1.0, rtol=1e-2)
+    target = np.where(star_index == 0)[0][0]
+    assert np.isclose(result['diff_flux'][target], 2000.0, rtol=3e-2)
+    isolated = np.hypot(*(positions - positions[target]).T) > 20.0
+    assert np.abs(result['diff_flux'][isolated]).max() < 100.0
+
+    lcodia.store_dia_photometry(red_dir, result, star_index)
+    dia_flux = parquet.load_dia_flux(red_dir)
+    assert len(dia_flux) == len(star_index)
+
+    # The reference is factorized once per process, also for the copies sent to the workers
+    assert pickle.loads(pickle.dumps(reference)).get_kernel_solver() is reference.get_kernel_solver()
+
+    # PSF fluxes are in the units of the aperture fluxes
+    small_aperture = dict(options, radius=3.0, detect_threshold=0.0)
+    aperture = lcodia.run_dia_epoch(os.path.join(red_dir, 'image.fits'), reference, positions, small_aperture)
+    psf = lcodia.run_dia_epoch(os.path.join(red_dir, 'image.fits'), reference, positions,
+                               dict(small_aperture, photometry='psf'))
+    assert aperture['diff_flux'][target] < 0.9 * 2000.0
+    assert np.isclose(psf['diff_flux'][target], aperture['diff_flux'][target], rtol=3e-2)
+
+    # Images without a refined WCS are not aligned with their header WCS
+    make_dia_fits(os.path.join(red_dir, 'unrefined.fits'), variable, [101.3, 99.3], 2.0, refined_wcs=False)
+    unrefined = lcodia.run_dia_epoch(os.path.join(red_dir, 'unrefined.fits'), reference, positions, options)
+    assert 'refined WCS' in unrefined['status']
+
+    # Failed images are not stored, so that they are processed again
+    failed = lcodia.run_dia_epoch(os.path.join(red_dir, 'missing.fits'), reference, positions, options)
+    assert failed['status'] != 'OK'
+    lcodia.store_dia_photometry(red_dir, failed, star_index)
+    assert not os.path.isfile(os.path.join(red_dir, 'dia_flux', 'missing.fits.parquet'))
+
+    # The variable star is detected as a transient and matched to its catalog entry
+    index = crossmatching.SpatialIndex(ra=stars['ra'], dec=stars['dec'])
+    lcodia.store_dia_candidates(red_dir, result, reference, index, 1.0 / 3600.0)
+    candidates = parquet.load_dia_candidates(red_dir)
+    assert candidates['star_index'][0] == 0
+    assert np.hypot(candidates['x'][0] - positions[target][0], candidates['y'][0] - positions[target][1]) < 0.5
+    assert candidates['snr'][0] > 5.0
+
+    obs_set = SimpleNamespace(table=Table({'file': ['ref.fits', 'image.fits']}))
+    reference_flux = stars['flux'] / 100.0
+    flux, flux_err = lcodia.compute_dia_flux(dia_flux, obs_set, len(stars['flux']), reference_flux, 100.0)
+
+    assert flux.shape == (40, 2)
+    assert np.all(np.isnan(flux[:, 0]))
+    assert np.isclose(flux[0, 1], variable['flux'][0] / 100.0, rtol=2e-2)
+
+    shutil.rmtree(red_dir)
+
+
+
+def test_run_dia_epoch_non_finite_pixels():
+
+    import os
+    import shutil
+    import pytest
+    from astropy.io import fits
+
+    red_dir = os.path.join(os.path.dirname(__file__), 'test_output', 'dia_non_finite')
+    os.makedirs(red_dir, exist_ok=True)
+
+    rng = np.random.default_rng(4)
+    stars = {
+        'ra': 270.0 + rng.uniform(-0.008, 0.008, 40) / np.cos(np.radians(30.0)),
+        'dec': -30.0 + rng.uniform(-0.008, 0.008, 40),
+        'flux': rng.uniform(5000, 50000, 40)
+    }
+    make_dia_fits(os.path.join(red_dir, 'ref.fits'), stars, [100.0, 100.0], 1.5)
+    make_dia_fits(os.path.join(red_dir, 'image.fits'), stars, [101.3, 99.3], 2.0)
+    with fits.open(os.path.join(red_dir, 'image.fits'), mode='update') as hdulist:
+        hdulist[0].data[100, 100] = np.nan
+
+    # The non-finite pixel is masked rather than spread through the kernel solution
+    image = lcodia.load_dia_image(os.path.join(red_dir, 'image.fits'))
+    assert image['mask'][100, 100] and np.isfinite(image['data']).all()
+
+    kernel_size = 9
+    reference = lcodia.DIAReference(os.path.join(red_dir, 'ref.fits'), 270.0, -30.0, 60, kernel_size)
+    star_index, positions = reference.get_star_positions(stars['ra'], stars['dec'])
+    options = {'kernel_size': kernel_size, 'solver': 'lstsq', 'kernel_degree': 0, 'kernel_basis': 'delta',
+               'radius': 8.0}
+    result = lcodia.run_dia_epoch(os.path.join(red_dir, 'image.fits'), reference, positions, options)
+    assert result['status'] == 'OK'
+    assert np.isclose(result['kernel_sum'], 1.0, rtol=3e-2)
+
+    # A non-finite kernel solution is an error
+    aligned = reference.image.copy()
+    aligned[30, 30] = np.nan
+    with pytest.raises(ValueError):
+        lcodia.run_difference_image(reference.image, aligned, kernel_size, solver='lstsq')
+
+    shutil.rmtree(red_dir)
+
+def test_build_deep_reference():
+
+    import os
+    import shutil
+    from types import SimpleNamespace
+    from astropy.io import fits
+    from astropy.table import Table
+    from image_reduction.photometry import deep_reference
+
+    red_dir = os.path.join(os.path.dirname(__file__), 'test_output', 'deep_reference')
+    os.makedirs(red_dir, exist_ok=True)
+
+    rng = np.random.default_rng(3)
+    stars = {
+        'ra': 270.0 + rng.uniform(-0.008, 0.008, 40) / np.cos(np.radians(30.0)),
+        'dec': -30.0 + rng.uniform(-0.008, 0.008, 40),
+        'flux': rng.uniform(5000, 50000, 40)
+    }
+
+    files = ['frame' + str(i) + '.fits' for i in range(5)]
+    crpix = [[100.0, 100.0], [101.4, 99.3], [98.8, 100.6], [100.5, 101.7], [99.2, 98.9]]
+    for file, pix in zip(files, crpix):
+        make_dia_fits(os.path.join(red_dir, file), stars, pix, 1.5)
+
+    # Most frames are taken through thinner clouds, and are scaled to the photometry of the first one
+    for file in files[1:4]:
+        with fits.open(os.path.join(red_dir, file), mode='update') as hdulist:
+            hdulist[0].data = (hdulist[0].data - 100.0) * 1.3 + 100.0
+            hdulist['ERR'].data *= 1.3
+
+    # A cosmic ray in one frame, rejected by the median
+    with fits.open(os.path.join(red_dir, files[2]), mode='update') as hdulist:
+        hdulist[0].data[60:63, 80:83] += 5000.0
+
+    # The best frame failed its astrometry and has no refined WCS
+    make_dia_fits(os.path.join(red_dir, 'no_astrometry.fits'), stars, [103.0, 97.0], 1.5, refined_wcs=False)
+
+    obs_set = SimpleNamespace(table=Table({
+        'file': files + ['bad_seeing.fits', 'high_airmass.fits', 'no_astrometry.fits'],
+        'fwhm': [1.0, 1.1, 1.2, 1.3, 1.4, 3.0, 0.9, 0.8],
+        'sky_bkgd': [100.0] * 8,
+        'airmass': [1.2] * 6 + [2.5, 1.2]
+    }))
+    frames = deep_reference.select_reference_frames(red_dir, obs_set, nframes=5)
+    assert frames == files
+
+    output_path = os.path.join(red_dir, 'deep_reference.fits')
+    deep_reference.build_deep_reference(red_dir, frames, obs_set, output_path)
+    with fits.open(output_path) as hdulist:
+        deep_image = hdulist[0].data.astype(float)
+        deep_mask = hdulist['BPM'].data > 0
+        assert hdulist[0].header['NCOMBINE'] == 5
+        assert hdulist[0].header['GRIDIMG'] == files[0]
+    grid_image = fits.getdata(os.path.join(red_dir, files[0]))
+
+    assert not deep_mask[10:-10, 10:-10].any()
+    assert np.abs(deep_image - grid_image)[10:-10, 10:-10].max() < 0.02 * grid_image.max()
+    assert np.abs(deep_image - grid_image)[55:68, 75:88].max() < 0.02 * grid_image.max()
+    assert not os.path.isdir(os.path.join(red_dir, 'deep_reference_tmp'))
+
+    # The stack does not depend on the size of the tiles combined at once
+    deep_reference.build_deep_reference(red_dir, frames, obs_set, output_path, memory_limit=1)
+    assert np.array_equal(fits.getdata(output_path), deep_image)
+
+    shutil.rmtree(red_dir)
+
+
+def test_dia_analyst_multiple_stamps():
+
+    import os
+    import shutil
+    from astropy.io import fits
+    from astropy.table import Table
+    from astropy.wcs import WCS
+
+    red_dir = os.path.join(os.path.dirname(__file__), 'test_output', 'dia_stamps')
+    os.makedirs(red_dir, exist_ok=True)
+
+    rng = np.random.default_rng(5)
+    nstars = 400
+    stars = {
+        'ra': 270.0 + rng.uniform(-0.02, 0.02, nstars) / np.cos(np.radians(30.0)),
+        'dec': -30.0 + rng.uniform(-0.02, 0.02, nstars),
+        'flux': rng.uniform(5000, 50000, nstars)
+    }
+    targets = [[270.0 - 0.008, -30.0 - 0.008], [270.0 + 0.008, -30.0 + 0.008]]
+    stars['ra'][:2], stars['dec'][:2] = np.array(targets).T
+
+    # Analyst layout: SCI, catalog, BPM, ERR, updated WCS and catalog layers
+    def make_analyst_fits(file_name, stars, crpix):
+        make_dia_fits(os.path.join(red_dir, file_name), stars, crpix, 1.5, shape=(400, 400))
+        with fits.open(os.path.join(red_dir, file_name)) as hdulist:
+            data = hdulist[0].data
+            header = hdulist[0].header
+        image_wcs = WCS(header)
+        xx, yy = image_wcs.world_to_pixel_values(stars['ra'], stars['dec'])
+        catalog = Table({'id': np.arange(nstars), 'xcenter': xx, 'ycenter': yy})
+        fits.HDUList([
+            fits.PrimaryHDU(data=data, header=header),
+            fits.BinTableHDU(catalog),
+            fits.ImageHDU(data=np.zeros(data.shape, dtype=np.int16), name='BPM'),
+            fits.ImageHDU(data=np.sqrt(data), name='ERR'),
+            fits.ImageHDU(header=image_wcs.to_header(), name='UPDATED WCS'),
+            fits.BinTableHDU(catalog)
+        ]).writeto(os.path.join(red_dir, file_name), overwrite=True)
+
+        return catalog
+
+    ref_catalog = make_analyst_fits('ref.fits', stars, [200.0, 200.0])
+    variable = dict(stars, flux=stars['flux'].copy())
+    variable['flux'][:2] += [2000.0, 4000.0]
+    image_catalog = make_analyst_fits('image.fits', variable, [201.3, 199.6])
+
+    regions = [[ra, dec, 100] for ra, dec in targets]
+    kernel_cache = {}
+    reference_cache = {}
+    agent = lcodia.DIAPhotometryAnalyst('ref.fits', red_dir + '/', 'image.fits', red_dir + '/', ref_catalog,
+                                        image_catalog, regions, 9, log_path=red_dir, solver='cholesky',
+                                        kernel_cache=kernel_cache, reference_cache=reference_cache)
+
+    assert len(agent.stamps) == 2
+    assert len(reference_cache) == 2
+    for stamp, increment, target in zip(agent.stamps, [2000.0, 4000.0], [0, 1]):
+        phot = stamp['dia_photometry']
+        assert np.isclose(np.sum(stamp['kernel']), 1.0, rtol=2e-2)
+        assert np.isclose(phot['aperture_sum'][list(phot['id']).index(target)], increment, rtol=0.25)
+
+    # Each stamp matches its single-stamp solution
+    for region, stamp in zip(regions, agent.stamps):
+        single = lcodia.DIAPhotometryAnalyst('ref.fits', red_dir + '/', 'image.fits', red_dir + '/', ref_catalog,
+                                             image_catalog, region, 9, log_path=red_dir, solver='cholesky')
+        assert np.allclose(single.kernel, stamp['kernel'])
+        assert single.reference_layers is not None
+
+    # Later epochs take the reference stamps from the cache, without opening the reference
+    agent = lcodia.DIAPhotometryAnalyst('ref.fits', red_dir + '/', 'image.fits', red_dir + '/', ref_catalog,
+                                        image_catalog, regions, 9, log_path=red_dir, solver='cholesky',
+                                        kernel_cache=kernel_cache, reference_cache=reference_cache)
+    assert agent.reference_layers is None
+    assert all(stamp['dia_photometry'] is not None for stamp in agent.stamps)
+
+    shutil.rmtree(red_dir)
+
+
+def test_detect_transients():
+
+    rng = np.random.default_rng(8)
+    shape = (150, 150)
+    rows, cols = np.indices(shape)
+    variance = np.full(shape, 25.0)
+    dia_image = rng.normal(0.0, 5.0, shape)
+
+    sigma = 1.8
+    psf = lcodia.gaussian_psf(sigma * 2.3548)
+    sources = [(40.3, 60.6, 3000.0), (100.0, 110.2, -1500.0), (75.5, 20.0, 40.0)]
+    for x, y, flux in sources:
+        dia_image += lcopsf.Gaussian2d(flux / (2 * np.pi * sigma**2), y, x, sigma, sigma, rows, cols)
+
+    mask = np.zeros(shape, dtype=bool)
+    mask[10:20, 10:20] = True
+    dia_image[mask] = 1e6
+
+    candidates = lcodia.detect_transients(dia_image, variance, psf, mask=mask, threshold=5.0)
+
+    # The faint source is below the threshold and the masked pixels are ignored
+    assert len(candidates['x']) == 2
+    for i, (x, y, flux) in enumerate(sources[:2]):
+        assert np.hypot(candidates['x'][i] - x, candidates['y'][i] - y) < 0.3
+        assert np.abs(candidates['flux'][i] - flux) < 3.0 * candidates['flux_err'][i]
+    assert candidates['snr'][1] < 0.0
+
+
+def test_run_dia_psf_photometry():
+
+    rng = np.random.default_rng(21)
+    shape = (120, 120)
+    rows, cols = np.indices(shape)
+    sigma = 1.8
+
+    # A blended pair, an isolated star and a star on the edge
+    positions = np.array([[50.2, 60.7], [53.6, 61.1], [90.4, 30.8], [1.3, 100.5]])
+    fluxes = np.array([3000.0, -2000.0, 1500.0, 1000.0])
+    error = np.full(shape, 5.0)
+    dia_image = rng.normal(0.0, 5.0, shape)
+    for (x, y), flux in zip(positions, fluxes):
+        dia_image += lcopsf.Gaussian2d(flux / (2 * np.pi * sigma**2), y, x, sigma, sigma, rows, cols)
+
+    mask = np.zeros(shape, dtype=bool)
+    mask[28:34, 88:93] = True
+    dia_image[mask] = 1e6
+
+    phot_table = lcodia.run_dia_psf_photometry(dia_image, error, positions, sigma * 2.3548, mask=mask)
+
+    assert len(phot_table) == 4
+    assert np.all(np.abs(phot_table['aperture_sum'] - fluxes) < 4.0 * phot_table['aperture_sum_err'])
+    covariance = phot_table.meta['covariance'].toarray()
+    assert np.allclose(covariance, covariance.T)
+    assert covariance[0, 1] < 0.0
+    assert covariance[0, 2] == 0.0
+    # Masked and off-image pixels increase the uncertainty
+    isolated_error = 5.0 * np.sqrt(4.0 * np.pi * sigma**2)
+    assert phot_table['aperture_sum_err'][2] > 2.0 * isolated_error
+    assert phot_table['aperture_sum_err'][3] > isolated_error
+
+    # A kernel that is a shifted delta function moves the fitted PSF
+    kernel = np.zeros((5, 5))
+    kernel[2, 3] = 1.0
+    shifted = lcodia.run_dia_psf_photometry(dia_image, error, positions - [1.0, 0.0], sigma * 2.3548,
+                                            kernel=kernel, mask=mask)
+    assert np.allclose(shifted['aperture_sum'], phot_table['aperture_sum'], atol=1e-6)
+
+    # Stars at the same position cannot be separated, but do not prevent the fit of the others
+    coincident = np.vstack([positions, positions[2]])
+    phot_table = lcodia.run_dia_psf_photometry(dia_image, error, coincident, sigma * 2.3548, mask=mask)
+    assert np.all(np.isnan(phot_table['aperture_sum'][[2, 4]]))
+    assert np.all(np.isnan(phot_table['aperture_sum_err'][[2, 4]]))
+    assert np.all(np.abs(phot_table['aperture_sum'][[0, 1, 3]] - fluxes[[0, 1, 3]])
+                  < 4.0 * phot_table['aperture_sum_err'][[0, 1, 3]])
@@ -0,0 +1,86 @@
+import os
+import shutil
+import numpy as np
+import pytest
+from astropy.io import ascii, fits
+from astropy.table import Table
+from astropy.wcs import WCS
+
+from image_reduction.photometry import psf as lcopsf
+from image_reduction.tools import extract_stamps
+
+
+def make_frame(file_path, stars, crpix, shape=(200, 200), refined_wcs=True):
+
+    image_wcs = WCS(naxis=2)
+    image_wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    image_wcs.wcs.crval = [270.0, -30.0]
+    image_wcs.wcs.crpix = crpix
+    image_wcs.wcs.cdelt = [-0.389 / 3600.0, 0.389 / 3600.0]
+
+    rows, cols = np.indices(shape)
+    data = np.full(shape, 100.0)
+    xx, yy = image_wcs.world_to_pixel_values(stars[:, 0], stars[:, 1])
+    for x, y in zip(xx, yy):
+        data += lcopsf.Gaussian2d(5000.0, y, x, 1.5, 1.5, rows, cols)
+
+    bpm = np.zeros(shape, dtype=np.int16)
+    bpm[20:23, 150:153] = 1
+    header = image_wcs.to_header()
+    header['EXPTIME'] = 100.0
+    hdulist = fits.HDUList([
+        fits.PrimaryHDU(data=data, header=header),
+        fits.ImageHDU(data=np.sqrt(data), name='ERR'),
+        fits.ImageHDU(data=bpm, name='BPM')
+    ])
+    if refined_wcs:
+        hdulist.append(fits.ImageHDU(header=header, name='LCO MICROLENSING PHOTOMETRY UPDATED WCS'))
+    hdulist.writeto(file_path, overwrite=True)
+
+
+def test_extract_stamp_cube():
+
+    red_dir = os.path.join(os.path.dirname(__file__), 'test_output', 'stamps')
+    os.makedirs(red_dir, exist_ok=True)
+
+    rng = np.random.default_rng(4)
+    stars = np.c_[270.0 + rng.uniform(-0.008, 0.008, 30) / np.cos(np.radians(30.0)),
+                  -30.0 + rng.uniform(-0.008, 0.008, 30)]
+    files = ['frame0.fits', 'frame1.fits', 'frame2.fits']
+    for file, crpix in zip(files, [[100.0, 100.0], [102.4, 98.7], [97.3, 101.2]]):
+        make_frame(os.path.join(red_dir, file), stars, crpix)
+    ascii.write(Table({'file': files, 'HJD': [1.0, 2.0, 3.0], 'exptime': [100.0] * 3}),
+                os.path.join(red_dir, 'data_summary.txt'), overwrite=True)
+
+    # A target in the field, and one on the edge of the reference frame
+    image_wcs = WCS(fits.getheader(os.path.join(red_dir, files[0])))
+    targets = np.array([stars[0], image_wcs.pixel_to_world_values(5.0, 100.0)])
+    output_dir = extract_stamps.extract_stamp_cube(red_dir, targets, size=31, nprocess=2)
+    cube = extract_stamps.load_stamp_cube(output_dir)
+
+    assert cube['sci'].shape == (3, 2, 31, 31)
+    assert isinstance(cube['sci'], np.memmap)
+    assert list(cube['epochs']['status']) == ['OK'] * 3
+    assert list(cube['epochs']['HJD']) == [1.0, 2.0, 3.0]
+
+    # The reference stamps are sections of the reference frame, and the other frames are aligned to them
+    x0, y0 = cube['targets']['x0'][0], cube['targets']['y0'][0]
+    reference = fits.getdata(os.path.join(red_dir, files[0]))
+    assert np.allclose(cube['sci'][0, 0], reference[y0:y0 + 31, x0:x0 + 31], rtol=1e-5)
+    assert np.abs(cube['sci'][1:, 0] - cube['sci'][0, 0]).max() < 0.03 * cube['sci'][0, 0].max()
+    assert np.all(cube['mask'][:, 0] == 0)
+
+    # Pixels beyond the edge of each frame are flagged
+    assert np.all(cube['mask'][0, 1][:, :10] == extract_stamps.OUT_OF_FRAME)
+    assert np.all(cube['mask'][0, 1][:, 11:] == 0)
+
+    # A frame without a refined WCS is not extracted, and cannot be the reference
+    make_frame(os.path.join(red_dir, 'unrefined.fits'), stars, [101.0, 99.0], refined_wcs=False)
+    origins = extract_stamps.get_stamp_origins(image_wcs, targets, 31)
+    stamps = extract_stamps.extract_frame_stamps(os.path.join(red_dir, 'unrefined.fits'), image_wcs, origins, 31)
+    assert stamps['status'] == 'No refined WCS'
+    assert np.all(stamps['mask'] == extract_stamps.OUT_OF_FRAME)
+    with pytest.raises(ValueError):
+        extract_stamps.extract_stamp_cube(red_dir, targets, size=31, reference_image='unrefined.fits')
+
+    shutil.rmtree(red_dir)